@@ -0,0 +1,225 @@
+"""
+Benchmarks for corpus I/O.
+
+    python3 bench.py compression [files ...]
+        Size and read/write time of the corpus artifacts, plain and compressed with gzip, xz and bz2 through
+        util.smart_open().
+    python3 bench.py tsv [--replicas 100]
+        Time and memory of main.parse_tsv() against util.load_tsv() on little_prince_ko.tsv
+        repeated --replicas times.
+    python3 bench.py shm [--replicas 20] [--workers 2]
+        util.json2conllu() of little_prince_ko.conllu repeated --replicas times, serially, in a process pool that gets
+        one pickled chapter of token dicts per task, and in one that reads the corpus from shared_corpus.SharedCorpus.
+"""
+import argparse
+import os
+import gc
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from corpus_store import ColumnarCorpus
+from shared_corpus import SharedCorpus
+from util import COMPRESSED_OPENERS, chapter2conllu, conllu2json, json2conllu, load_tsv, smart_open
+
+DEFAULT_ARTIFACTS = ["little_prince_ko.tsv", "little_prince_ko.json", "little_prince_raw_sentences.json",
+                     "little_prince_stanza.json", "little_prince_merged.json", "little_prince_annotation_ready.json",
+                     "little_prince_ko.conllu", "little_prince_ko.conllulex"]
+
+
+def _best_of(repeat, function):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def bench_compression(file_paths, repeat=3):
+    """
+    Write and read back every file in every format, streaming text through smart_open() as the pipeline does.
+
+    :return: rows of (file name, suffix, size in bytes, write seconds, read seconds)
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file_path in file_paths:
+            with smart_open(file_path, encoding="utf-8") as f:
+                text = f.read()
+            for suffix in [""] + list(COMPRESSED_OPENERS):
+                target = os.path.join(tmp_dir, os.path.basename(file_path) + suffix)
+
+                def write():
+                    with smart_open(target, "w", encoding="utf-8") as g:
+                        g.write(text)
+
+                def read():
+                    with smart_open(target, encoding="utf-8") as g:
+                        assert g.read() == text
+
+                write_time = _best_of(repeat, write)
+                read_time = _best_of(repeat, read)
+                rows.append((os.path.basename(file_path), suffix or "plain", os.path.getsize(target),
+                             write_time, read_time))
+    return rows
+
+
+def bench_tsv(file_path="little_prince_ko.tsv", replicas=100, repeat=3):
+    """
+    Load a TSV made of the rows of file_path repeated replicas times, after checking that all loaders agree on it.
+
+    :return: rows of (loader name, seconds, MB allocated for the result)
+    """
+    from main import parse_tsv  # imports stanza
+
+    loaders = [("parse_tsv", parse_tsv), ("load_tsv", load_tsv)]
+    with smart_open(file_path, encoding="utf-8") as f:
+        header, body = f.read().split("\n", 1)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        replica = os.path.join(tmp_dir, "replica.tsv")
+        with open(replica, "w", encoding="utf-8") as f:
+            f.write(header + "\n" + body * replicas)
+        reference = parse_tsv(file_path)
+        assert load_tsv(file_path).to_docs() == reference
+
+        for name, loader in loaders:
+            seconds = _best_of(repeat, lambda: loader(replica))
+            gc.collect()
+            tracemalloc.start()
+            result = loader(replica)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del result
+            rows.append((name, seconds, size / 1e6))
+    return rows
+
+
+def json_tokens(corpus, start_row, stop_row):
+    """
+    :return: rows start_row to stop_row of the corpus as the token dicts of util.conllu2json(), the input of
+        util.json2conllu()
+    """
+    ids = [major if minor == 0 else f"{major}.{minor}" for major, minor in
+           zip(corpus.id_major[start_row:stop_row].tolist(), corpus.id_minor[start_row:stop_row].tolist())]
+    heads = ["_" if head == -1 else head for head in corpus.head[start_row:stop_row].tolist()]
+    columns = [ids, corpus.form.tolist(start_row, stop_row), corpus.lemma.tolist(start_row, stop_row),
+               corpus.upos.tolist(start_row, stop_row), corpus.xpos.tolist(start_row, stop_row),
+               corpus.feats.tolist(start_row, stop_row), heads, corpus.deprel.tolist(start_row, stop_row),
+               corpus.deps.tolist(start_row, stop_row), corpus.misc.tolist(start_row, stop_row)]
+    return [{"id": _id, "text": form, "lemma": lemma, "upos": upos, "xpos": xpos, "feats": feats, "head": head,
+             "deprel": deprel, "deps": deps, "misc": misc, "start_char": -1, "end_char": -1, "p": None,
+             "gold_scene": None, "gold_function": None}
+            for _id, form, lemma, upos, xpos, feats, head, deprel, deps, misc in zip(*columns)]
+
+
+def _sentences(corpus, start, stop):
+    start_row, stop_row = corpus.sentence_offsets[[start, stop]].tolist()
+    tokens = json_tokens(corpus, start_row, stop_row)
+    offsets = (corpus.sentence_offsets[start:stop + 1] - start_row).tolist()
+    return [tokens[a:b] for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+def json_chapters(corpus):
+    """
+    :return: the corpus as util.conllu2json() gives it, one chapter per chapter of the corpus
+    """
+    offsets = corpus.chapter_offsets.tolist()
+    return [_sentences(corpus, start, stop) for start, stop in zip(offsets[:-1], offsets[1:])]
+
+
+def conllu_chapter(corpus, start, stop, outputs):
+    """
+    SharedCorpus.map_sentences() version of util.chapter2conllu(): converts the chapter made of sentences start to
+    stop, building its token dicts in the worker instead of receiving them pickled.
+    """
+    c = int(np.searchsorted(corpus.chapter_offsets, start, side="right")) - 1
+    return chapter2conllu(c, _sentences(corpus, start, stop))
+
+
+def bench_shm(file_path="little_prince_ko.conllu", replicas=20, workers=2, repeat=3):
+    """
+    Convert file_path repeated replicas times back to CoNLL-U with util.json2conllu(), the last stage of the pipeline:
+    serially, with workers processes that are sent one pickled chapter of token dicts per task (json2conllu(...,
+    workers=workers)), and with SharedCorpus.map_sentences(), after checking that all three write the same file.
+
+    :return: rows of (method, seconds, MB pickled to and from the workers)
+    """
+    corpus = ColumnarCorpus.from_conllu(file_path)
+    assert json_chapters(corpus) == conllu2json(file_path)
+    with open(file_path, encoding="utf-8") as f:
+        text = f.read()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        replica = os.path.join(tmp_dir, "replica.conllu")
+        with open(replica, "w", encoding="utf-8") as f:
+            f.write(text * replicas)
+        corpus = ColumnarCorpus.from_conllu(replica)
+        chapters = json_chapters(corpus)
+        out = os.path.join(tmp_dir, "out.conllu")
+
+        def serial():
+            json2conllu(chapters, out, workers=1)
+
+        def pickled():
+            json2conllu(chapters, out, workers=workers)
+
+        def shared():
+            with SharedCorpus(corpus) as shared_corpus, open(out, "wb") as f:
+                for chunk in shared_corpus.map_sentences(conllu_chapter, workers=workers):
+                    f.write(chunk)
+
+        outputs = []
+        for convert in [serial, pickled, shared]:
+            convert()
+            with open(out, "rb") as f:
+                outputs.append(f.read())
+        assert outputs[0] == outputs[1] == outputs[2]
+
+        with SharedCorpus(corpus) as shared_corpus:
+            shared_size = len(pickle.dumps((shared_corpus.spec, shared_corpus.chapter_ranges())))
+        results_size = len(pickle.dumps([chapter2conllu(c, chapter) for c, chapter in enumerate(chapters)]))
+        pickled_size = len(pickle.dumps(chapters)) + results_size
+        return [("serial", _best_of(repeat, serial), 0.0),
+                (f"pickled chapters, {workers} workers", _best_of(repeat, pickled), pickled_size / 1e6),
+                (f"shared memory, {workers} workers", _best_of(repeat, shared), (shared_size + results_size) / 1e6)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for corpus I/O.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    compression_parser = subparsers.add_parser("compression", help="plain vs gzip/xz/bz2 artifacts")
+    compression_parser.add_argument("files", nargs="*", help="files to compress; by default the corpus artifacts")
+    compression_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    tsv_parser = subparsers.add_parser("tsv", help="parse_tsv() vs the bulk TSV loader")
+    tsv_parser.add_argument("file", nargs="?", default="little_prince_ko.tsv")
+    tsv_parser.add_argument("--replicas", type=int, default=100, help="number of copies of the file to load")
+    tsv_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    shm_parser = subparsers.add_parser("shm", help="pickled chapters vs a shared-memory corpus in a process pool")
+    shm_parser.add_argument("file", nargs="?", default="little_prince_ko.conllu")
+    shm_parser.add_argument("--replicas", type=int, default=20, help="number of copies of the file to process")
+    shm_parser.add_argument("--workers", type=int, default=2, help="number of worker processes")
+    shm_parser.add_argument("--repeat", type=int, default=3, help="best of this many runs")
+    args = parser.parse_args()
+
+    if args.benchmark == "compression":
+        files = args.files or [file_path for file_path in DEFAULT_ARTIFACTS if os.path.exists(file_path)]
+        print(f"{'file':<38}{'format':>7}{'MB':>8}{'ratio':>7}{'write s':>9}{'read s':>8}")
+        plain_size = {}
+        for name, file_format, size, write_time, read_time in bench_compression(files, repeat=args.repeat):
+            plain_size.setdefault(name, size)
+            print(f"{name:<38}{file_format:>7}{size / 1e6:>8.2f}{size / plain_size[name]:>7.3f}"
+                  f"{write_time:>9.3f}{read_time:>8.3f}")
+    elif args.benchmark == "tsv":
+        print(f"{'loader':<18}{'s':>8}{'speedup':>9}{'MB':>9}")
+        tsv_rows = bench_tsv(args.file, replicas=args.replicas, repeat=args.repeat)
+        for name, seconds, size in tsv_rows:
+            print(f"{name:<18}{seconds:>8.2f}{tsv_rows[0][1] / seconds:>9.1f}{size:>9.1f}")
+    elif args.benchmark == "shm":
+        print(f"{'method':<32}{'s':>8}{'speedup':>9}{'MB pickled':>12}")
+        shm_rows = bench_shm(args.file, replicas=args.replicas, workers=args.workers, repeat=args.repeat)
+        for name, seconds, size in shm_rows:
+            print(f"{name:<32}{seconds:>8.2f}{shm_rows[0][1] / seconds:>9.1f}{size:>12.2f}")
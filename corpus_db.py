@@ -0,0 +1,306 @@
+"""
+SQLite corpus store.
+
+Keeps a CoNLL-U(-Lex) treebank in a SQLite database, so that annotators can update single tokens while others read,
+and exports only re-render the sentences that changed:
+ * chapters(chapter_no, name)
+ * sentences(sentence_no, chapter_no, sent_id, comments, blank_after, version)
+ * tokens(token_no, sentence_no, position, the ten CoNLL-U columns, lex, p, scene, function), where lex holds the
+   CoNLL-U-Lex columns 11-19 joined by tabs and p/scene/function are read off Adp_lemma/Scene/Funct in MISC,
+ * adp_nodes(token_no, anchor_no, sentence_no) for the abstract ADP nodes (5.1) and the token they hang off (5),
+ * rendered(sentence_no, format, version, block), the cached CoNLL-U and CoNLL-U-Lex text of each sentence.
+
+Every token update bumps the version of its sentence, which invalidates its cached blocks. The database runs in WAL
+mode, so readers and exports see a consistent snapshot while somebody else is writing.
+
+Usage:
+    python3 corpus_db.py load little_prince_ko.conllulex little_prince.db
+    python3 corpus_db.py update little_prince.db lpp.ko01-001 5.1 scene=locus function=locus
+    python3 corpus_db.py export little_prince.db little_prince_ko.conllulex
+"""
+import argparse
+import json
+import sqlite3
+
+from corpus_store import CONLLU_COLUMNS, misc_value, read_conllu_sentences
+from util import Romanizer, col19_tag, format_sent_id, sentence2conllu
+
+TOKEN_COLUMNS = CONLLU_COLUMNS + ["lex", "p", "scene", "function"]
+SNACS_MISC_KEYS = {"p": "Adp_lemma", "scene": "Scene", "function": "Funct"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chapters (
+    chapter_no INTEGER PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sentences (
+    sentence_no INTEGER PRIMARY KEY,
+    chapter_no INTEGER NOT NULL REFERENCES chapters,
+    sent_id TEXT,
+    comments TEXT NOT NULL,
+    blank_after INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS tokens (
+    token_no INTEGER PRIMARY KEY,
+    sentence_no INTEGER NOT NULL REFERENCES sentences,
+    position INTEGER NOT NULL,
+    id TEXT NOT NULL, form TEXT, lemma TEXT, upos TEXT, xpos TEXT, feats TEXT,
+    head TEXT, deprel TEXT, deps TEXT, misc TEXT, lex TEXT,
+    p TEXT, scene TEXT, function TEXT
+);
+CREATE TABLE IF NOT EXISTS adp_nodes (
+    token_no INTEGER PRIMARY KEY REFERENCES tokens,
+    anchor_no INTEGER REFERENCES tokens,
+    sentence_no INTEGER NOT NULL REFERENCES sentences
+);
+CREATE TABLE IF NOT EXISTS rendered (
+    sentence_no INTEGER NOT NULL REFERENCES sentences,
+    format TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    block TEXT NOT NULL,
+    PRIMARY KEY (sentence_no, format)
+);
+CREATE INDEX IF NOT EXISTS sentences_sent_id ON sentences (sent_id);
+CREATE INDEX IF NOT EXISTS tokens_sentence ON tokens (sentence_no, position);
+CREATE INDEX IF NOT EXISTS tokens_p ON tokens (p);
+CREATE INDEX IF NOT EXISTS tokens_scene ON tokens (scene);
+CREATE INDEX IF NOT EXISTS tokens_function ON tokens (function);
+"""
+
+
+def set_misc_value(misc, key, value):
+    """
+    :return: misc with key set to value, or removed if value is "_". New keys are inserted in alphabetical order.
+    """
+    items = [] if misc == "_" else [item for item in misc.split("|") if item.partition("=")[0] != key]
+    if value != "_":
+        position = next((n for n, item in enumerate(items) if item.lower() > key.lower()), len(items))
+        items.insert(position, f"{key}={value}")
+    return "|".join(items) or "_"
+
+
+def snacs_columns(misc):
+    return {"p": misc_value(misc, "Adp_lemma", "Adp") or "_",
+            "scene": misc_value(misc, "Scene") or "_",
+            "function": misc_value(misc, "Funct") or "_"}
+
+
+def read_json_sentences(annotation_json_obj):
+    """
+    Yields (comment lines, token lines, blank_after) for every sentence of annotation-ready JSON, converted the same
+    way util.json2conllu() does.
+    """
+    r = Romanizer()
+    for c, chapter in enumerate(annotation_json_obj):
+        for s, sent in enumerate(chapter):
+            sentence_text, token_lines = sentence2conllu(sent, r)
+            yield ([f"# sent_id = {format_sent_id(c, s)}", f"# text = {sentence_text}"],
+                   [tok.conllu_line() for tok in token_lines], True)
+
+
+class CorpusDB:
+    def __init__(self, file_path):
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def load_conllu(self, file_path):
+        self.load_sentences(read_conllu_sentences(file_path))
+
+    def load_json(self, annotation_json_obj):
+        """
+        :param annotation_json_obj: JSON object or path, e.g. little_prince_annotation_ready.json
+        """
+        if isinstance(annotation_json_obj, str):
+            with open(annotation_json_obj, encoding="utf-8") as f:
+                annotation_json_obj = json.load(f)
+        self.load_sentences(read_json_sentences(annotation_json_obj))
+
+    def load_sentences(self, sentences):
+        """
+        Replace the contents of the database with sentences, in one transaction.
+
+        :param sentences: (comment lines, token lines, blank_after) per sentence, as from read_conllu_sentences()
+        """
+        chapter_rows, sentence_rows, token_rows, adp_rows = [], [], [], []
+        for sentence_no, [comments, token_lines, blank_after] in enumerate(sentences):
+            sent_id = None
+            for comment in comments:
+                if comment.startswith("# sent_id = "):
+                    sent_id = comment[len("# sent_id = "):]
+            chapter = sent_id.rsplit("-", 1)[0] if sent_id else ""
+            if not chapter_rows or chapter_rows[-1][1] != chapter:
+                chapter_rows.append((len(chapter_rows), chapter))
+            sentence_rows.append((sentence_no, len(chapter_rows) - 1, sent_id, "\n".join(comments), blank_after))
+
+            token_nos = {}
+            for position, line in enumerate(token_lines):
+                cols = line.split("\t")
+                if len(cols) < 10:
+                    raise ValueError(f"Expected at least 10 columns, got {len(cols)}: {line!r}")
+                token_no = len(token_rows)
+                token_nos[cols[0]] = token_no
+                snacs = snacs_columns(cols[9])
+                token_rows.append((token_no, sentence_no, position, *cols[:10], "\t".join(cols[10:]),
+                                   snacs["p"], snacs["scene"], snacs["function"]))
+                if "." in cols[0]:
+                    adp_rows.append((token_no, token_nos.get(cols[0].split(".")[0]), sentence_no))
+
+        with self.connection:
+            for table in ["rendered", "adp_nodes", "tokens", "sentences", "chapters"]:
+                self.connection.execute(f"DELETE FROM {table}")
+            self.connection.executemany("INSERT INTO chapters VALUES (?, ?)", chapter_rows)
+            self.connection.executemany("INSERT INTO sentences VALUES (?, ?, ?, ?, ?, 0)", sentence_rows)
+            self.connection.executemany(f"INSERT INTO tokens VALUES ({', '.join('?' * 17)})", token_rows)
+            self.connection.executemany("INSERT INTO adp_nodes VALUES (?, ?, ?)", adp_rows)
+
+    def get_token(self, sent_id, token_id):
+        """
+        :return: dict of the token columns, or None if there is no such token
+        """
+        row = self.connection.execute(
+            f"SELECT {', '.join('t.' + c for c in TOKEN_COLUMNS)} FROM tokens t "
+            "JOIN sentences s ON s.sentence_no = t.sentence_no WHERE s.sent_id = ? AND t.id = ?",
+            (sent_id, token_id)).fetchone()
+        return None if row is None else dict(zip(TOKEN_COLUMNS, row))
+
+    def update_token(self, sent_id, token_id, **values):
+        """
+        Change columns of one token. p, scene and function are written through to MISC and, when the corpus has
+        CoNLL-U-Lex columns, to columns 14, 15 and 19; a new MISC updates p, scene and function in turn.
+
+        :param sent_id: sentence of the token
+        :param token_id: CoNLL-U id of the token, e.g. "5" or "5.1"
+        :param values: new column values, by name from TOKEN_COLUMNS
+        """
+        unknown = set(values) - set(TOKEN_COLUMNS) | ({"id", "lex"} & set(values))
+        if unknown:
+            raise ValueError(f"Cannot update {', '.join(sorted(unknown))}")
+
+        with self.connection:
+            row = self.connection.execute(
+                f"SELECT t.token_no, t.sentence_no, {', '.join('t.' + c for c in TOKEN_COLUMNS)} FROM tokens t "
+                "JOIN sentences s ON s.sentence_no = t.sentence_no WHERE s.sent_id = ? AND t.id = ?",
+                (sent_id, token_id)).fetchone()
+            if row is None:
+                raise KeyError(f"No token {token_id} in sentence {sent_id}")
+            token_no, sentence_no = row[:2]
+            token = dict(zip(TOKEN_COLUMNS, row[2:]))
+
+            token.update({c: v for c, v in values.items() if c not in SNACS_MISC_KEYS})
+            if "misc" in values:
+                token.update(snacs_columns(token["misc"]))
+            for column, key in SNACS_MISC_KEYS.items():
+                if column == "p" and misc_value(token["misc"], "Adp") is not None:
+                    key = "Adp"  # written by util.Romanizer
+                if column in values:
+                    token[column] = values[column]
+                    token["misc"] = set_misc_value(token["misc"], key, values[column])
+            if token["lex"] and ("scene" in values or "function" in values or "misc" in values):
+                cols = [token[c] for c in CONLLU_COLUMNS] + token["lex"].split("\t")
+                cols[13], cols[14] = token["function"], token["scene"]
+                cols[18] = col19_tag(cols)
+                token["lex"] = "\t".join(cols[10:])
+
+            self.connection.execute(
+                f"UPDATE tokens SET {', '.join(c + ' = ?' for c in TOKEN_COLUMNS[1:])} WHERE token_no = ?",
+                [token[c] for c in TOKEN_COLUMNS[1:]] + [token_no])
+            self.connection.execute("UPDATE sentences SET version = version + 1 WHERE sentence_no = ?",
+                                    (sentence_no,))
+
+    def find_adpositions(self, p=None, scene=None, function=None):
+        """
+        :return: (sent_id, token id, form, p, scene, function) of the abstract ADP nodes matching all given values
+        """
+        conditions, params = [], []
+        for column, value in [("p", p), ("scene", scene), ("function", function)]:
+            if value is not None:
+                conditions.append(f"t.{column} = ?")
+                params.append(value)
+        return self.connection.execute(
+            "SELECT s.sent_id, t.id, t.form, t.p, t.scene, t.function FROM adp_nodes a "
+            "JOIN tokens t ON t.token_no = a.token_no JOIN sentences s ON s.sentence_no = a.sentence_no "
+            f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''} ORDER BY t.token_no", params).fetchall()
+
+    def render_sentence(self, sentence_no, comments, lex):
+        lines = [comments] if comments else []
+        for cols in self.connection.execute(
+                f"SELECT {', '.join(CONLLU_COLUMNS)}, lex FROM tokens WHERE sentence_no = ? ORDER BY position",
+                (sentence_no,)):
+            if lex and not cols[-1]:
+                raise ValueError("The corpus was loaded without CoNLL-U-Lex columns")
+            lines.append("\t".join(cols if lex else cols[:-1]))
+        return "\n".join(lines)
+
+    def export(self, file_path, lex=None):
+        """
+        Write the corpus as .conllu or .conllulex, sentence by sentence. Sentences unchanged since the last export
+        are copied from the cache, and only the others are rendered from their tokens.
+
+        :param file_path: output file
+        :param lex: whether to write CoNLL-U-Lex columns; by default when file_path ends with .conllulex
+        :return: the number of sentences that had to be rendered
+        """
+        lex = file_path.endswith(".conllulex") if lex is None else lex
+        file_format = "conllulex" if lex else "conllu"
+        fresh = []
+        self.connection.execute("BEGIN")  # read everything from one snapshot
+        try:
+            with open(file_path, "w", encoding="utf-8", newline="") as f:
+                for sentence_no, comments, blank_after, version, block in self.connection.execute(
+                        "SELECT s.sentence_no, s.comments, s.blank_after, s.version, r.block FROM sentences s "
+                        "LEFT JOIN rendered r ON r.sentence_no = s.sentence_no AND r.format = ? "
+                        "AND r.version = s.version ORDER BY s.sentence_no", (file_format,)):
+                    if block is None:
+                        block = self.render_sentence(sentence_no, comments, lex)
+                        fresh.append((sentence_no, file_format, version, block))
+                    f.write(block + ("\n\n" if blank_after else "\n"))
+        finally:
+            self.connection.execute("COMMIT")
+
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO rendered VALUES (?, ?, ?, ?)", fresh)
+        return len(fresh)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite store for the K-SNACS treebank.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    load_parser = subparsers.add_parser("load", help="load a .conllu, .conllulex or annotation-ready .json")
+    load_parser.add_argument("source")
+    load_parser.add_argument("database")
+    update_parser = subparsers.add_parser("update", help="change columns of one token")
+    update_parser.add_argument("database")
+    update_parser.add_argument("sent_id")
+    update_parser.add_argument("token_id")
+    update_parser.add_argument("values", nargs="+", help="column=value, e.g. scene=locus")
+    export_parser = subparsers.add_parser("export", help="write a .conllu or .conllulex")
+    export_parser.add_argument("database")
+    export_parser.add_argument("target")
+    args = parser.parse_args()
+
+    with CorpusDB(args.database) as db:
+        if args.command == "load":
+            if args.source.endswith(".json"):
+                db.load_json(args.source)
+            else:
+                db.load_conllu(args.source)
+            n_sentences, n_tokens, n_adps = [db.connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                                             for table in ["sentences", "tokens", "adp_nodes"]]
+            print(f"{n_sentences} sentences, {n_tokens} tokens, {n_adps} abstract ADP nodes.")
+        elif args.command == "update":
+            db.update_token(args.sent_id, args.token_id, **dict(value.split("=", 1) for value in args.values))
+        else:
+            n_rendered = db.export(args.target)
+            print(f"Rendered {n_rendered} sentences.")
@@ -0,0 +1,174 @@
+"""
+Supersense and adposition statistics for a .conllu/.conllulex treebank.
+
+Every adposition node carries Adp(_lemma)/Scene/Funct in MISC. The treebank is read once into a ColumnarCorpus and
+all tables are computed from the integer label codes with np.bincount:
+ * scene x function confusion matrix,
+ * construal rates (scene != function), overall, per adposition and per chapter,
+ * per-adposition scene and function distributions,
+ * per-chapter counts,
+ * XPOS by adposition, with the XPOS that util.p2xpos() expects.
+
+Usage:
+    python3 corpus_stats.py little_prince_ko.conllulex --out stats
+    python3 corpus_stats.py old.conllulex little_prince_ko.conllulex --out stats_diff
+
+Large treebanks are best converted to .npz with corpus_store.py first, which is also accepted here.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+from corpus_store import ColumnarCorpus
+from util import p2xpos
+
+
+def crosstab(row_ids, n_rows, col_ids, n_cols, weights=None):
+    return np.bincount(row_ids * n_cols + col_ids, weights=weights, minlength=n_rows * n_cols).reshape(n_rows, n_cols)
+
+
+def _remap(categorical, labels, mask):
+    """Codes of categorical on mask rows, renumbered to indices into labels (-1 if not in labels)."""
+    index = {label: n for n, label in enumerate(labels)}
+    lut = np.array([index.get(v, -1) for v in categorical.vocab.tolist()], dtype=np.int64)
+    return lut[categorical.codes[mask]]
+
+
+def _by_frequency(categorical, mask):
+    counts = np.bincount(categorical.codes[mask], minlength=len(categorical.vocab))
+    vocab = categorical.vocab.tolist()
+    return [vocab[code] for code in np.argsort(-counts, kind="stable") if counts[code] and vocab[code] != "_"]
+
+
+def _table(counts, rows, columns):
+    return {"rows": list(rows), "columns": list(columns), "counts": counts}
+
+
+def compute_stats(corpus: ColumnarCorpus):
+    """
+    :param corpus: treebank
+    :return: dict of tables; every table has row labels, column labels and a 2-D counts array
+    """
+    adp_mask = (corpus.adp.codes != corpus.adp.code_of("_")) & \
+               (corpus.scene.codes != corpus.scene.code_of("_")) & \
+               (corpus.function.codes != corpus.function.code_of("_"))
+
+    adps = _by_frequency(corpus.adp, adp_mask)
+    labels = sorted((set(corpus.scene.vocab.tolist()) | set(corpus.function.vocab.tolist())) - {"_"})
+    xposes = _by_frequency(corpus.xpos, adp_mask)
+    chapters = corpus.chapter_names.tolist()
+
+    adp_ids = _remap(corpus.adp, adps, adp_mask)
+    scene_ids = _remap(corpus.scene, labels, adp_mask)
+    function_ids = _remap(corpus.function, labels, adp_mask)
+    xpos_ids = _remap(corpus.xpos, xposes, adp_mask)
+    construal = (scene_ids != function_ids).astype(np.int64)
+
+    chapter_of_token = corpus.chapter_of_sentence()[corpus.sentence_of_token()]
+    adp_chapter_ids = chapter_of_token[adp_mask]
+    n_chapters = len(chapters)
+
+    per_adp = np.stack([np.bincount(adp_ids, minlength=len(adps)),
+                        np.bincount(adp_ids, weights=construal, minlength=len(adps)).astype(np.int64)], axis=1)
+    per_chapter = np.stack([np.bincount(corpus.chapter_of_sentence(), minlength=n_chapters),
+                            np.bincount(chapter_of_token, minlength=n_chapters),
+                            np.bincount(adp_chapter_ids, minlength=n_chapters),
+                            np.bincount(adp_chapter_ids, weights=construal, minlength=n_chapters).astype(np.int64)],
+                           axis=1)
+
+    # p2xpos consistency: compare the XPOS of each adposition node with the one p2xpos() derives from p and function
+    pairs, pair_ids = np.unique(adp_ids * len(labels) + function_ids, return_inverse=True)
+    expected = []
+    for pair in pairs.tolist():
+        try:
+            expected.append(p2xpos(adps[pair // len(labels)], labels[pair % len(labels)]))
+        except KeyError:
+            expected.append(None)
+    expected_ids = np.array([xposes.index(x) if x in xposes else -1 for x in expected], dtype=np.int64)[pair_ids]
+    per_adp_xpos = np.stack([np.bincount(adp_ids, weights=expected_ids == xpos_ids, minlength=len(adps)),
+                             np.bincount(adp_ids, weights=expected_ids != xpos_ids, minlength=len(adps))],
+                            axis=1).astype(np.int64)
+
+    return {
+        "summary": _table(np.array([[corpus.n_chapters, corpus.n_sentences, corpus.n_tokens,
+                                     int(adp_mask.sum()), int(construal.sum())]]),
+                          ["total"], ["chapters", "sentences", "tokens", "adpositions", "construals"]),
+        "scene_function": _table(crosstab(scene_ids, len(labels), function_ids, len(labels)), labels, labels),
+        "adposition_construal": _table(per_adp, adps, ["adpositions", "construals"]),
+        "adposition_scene": _table(crosstab(adp_ids, len(adps), scene_ids, len(labels)), adps, labels),
+        "adposition_function": _table(crosstab(adp_ids, len(adps), function_ids, len(labels)), adps, labels),
+        "chapter_counts": _table(per_chapter, chapters, ["sentences", "tokens", "adpositions", "construals"]),
+        "adposition_xpos": _table(crosstab(adp_ids, len(adps), xpos_ids, len(xposes)), adps, xposes),
+        "adposition_p2xpos": _table(per_adp_xpos, adps, ["p2xpos_match", "p2xpos_mismatch"]),
+    }
+
+
+def construal_rates(stats):
+    summary = stats["summary"]["counts"][0]
+    per_adp = stats["adposition_construal"]
+    return {
+        "total": float(summary[4] / summary[3]) if summary[3] else 0.0,
+        **{adp: float(c / n) for adp, (n, c) in zip(per_adp["rows"], per_adp["counts"].tolist()) if n}
+    }
+
+
+def diff_stats(old, new):
+    """
+    Subtract old tables from new ones, over the union of their row and column labels.
+
+    :return: dict of tables of the same shape as compute_stats(), holding new - old
+    """
+    diff = {}
+    for name in new:
+        rows = old[name]["rows"] + [row for row in new[name]["rows"] if row not in old[name]["rows"]]
+        columns = old[name]["columns"] + [col for col in new[name]["columns"] if col not in old[name]["columns"]]
+        counts = np.zeros((len(rows), len(columns)), dtype=np.int64)
+        for sign, table in [(-1, old[name]), (1, new[name])]:
+            row_ids = np.array([rows.index(row) for row in table["rows"]], dtype=np.int64)
+            col_ids = np.array([columns.index(col) for col in table["columns"]], dtype=np.int64)
+            counts[np.ix_(row_ids, col_ids)] += sign * table["counts"]
+        diff[name] = _table(counts, rows, columns)
+    return diff
+
+
+def write_stats(stats, out_dir):
+    """
+    Writes one TSV per table, and all tables to stats.json.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    for name, table in stats.items():
+        with open(os.path.join(out_dir, f"{name}.tsv"), "w", encoding="utf-8") as f:
+            f.write("\t".join([""] + table["columns"]) + "\n")
+            for row, counts in zip(table["rows"], table["counts"].tolist()):
+                f.write("\t".join([row] + [str(count) for count in counts]) + "\n")
+
+    serializable = {name: {**table, "counts": table["counts"].tolist()} for name, table in stats.items()}
+    with open(os.path.join(out_dir, "stats.json"), "w", encoding="utf-8") as f:
+        json.dump(serializable, f, ensure_ascii=False, indent=4)
+
+
+def load_corpus(file_path):
+    if file_path.endswith(".npz"):
+        return ColumnarCorpus.load(file_path)
+    return ColumnarCorpus.from_conllu(file_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Supersense and adposition statistics of a treebank.")
+    parser.add_argument("treebanks", nargs="+", help="one treebank, or an old and a new version to diff")
+    parser.add_argument("--out", default="stats", help="output directory for the TSV and JSON tables")
+    args = parser.parse_args()
+
+    if len(args.treebanks) == 1:
+        stats = compute_stats(load_corpus(args.treebanks[0]))
+        rates = construal_rates(stats)
+        print(f"{stats['summary']['counts'][0][3]} adpositions, construal rate {rates['total']:.3f}")
+    elif len(args.treebanks) == 2:
+        stats = diff_stats(*[compute_stats(load_corpus(file_path)) for file_path in args.treebanks])
+        changed = int((stats["scene_function"]["counts"] != 0).sum())
+        print(f"{stats['summary']['counts'][0][3]:+d} adpositions, {changed} scene/function cells changed")
+    else:
+        parser.error("Give one treebank, or two to diff")
+    write_stats(stats, args.out)
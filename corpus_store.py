@@ -0,0 +1,393 @@
+"""
+Columnar corpus store.
+
+Holds a CoNLL-U(-Lex) treebank as flat NumPy arrays instead of nested lists of token dicts:
+ * int32 arrays for token ids and heads (abstract nodes such as 5.1 are split into id_major=5, id_minor=1),
+ * categorical codes plus a vocabulary for tag-like columns (UPOS, XPOS, FEATS, DEPREL, DEPS, the CoNLL-U-Lex
+   columns, and the Adp/Scene/Funct values read off MISC),
+ * string pools (one UTF-8 buffer plus offsets) for forms, lemmas, MISC and sentence comments,
+ * offset arrays for sentence and chapter boundaries.
+
+The store is saved as an uncompressed .npz, which load() memory-maps member by member, and it writes back the exact
+.conllu/.conllulex it was read from.
+
+Usage:
+    python3 corpus_store.py little_prince_ko.conllu little_prince_ko.npz
+"""
+import json
+import struct
+import sys
+import zipfile
+
+import numpy as np
+
+from util import Romanizer, format_sent_id, sentence2conllu
+
+CONLLU_COLUMNS = ["id", "form", "lemma", "upos", "xpos", "feats", "head", "deprel", "deps", "misc"]
+CATEGORICAL_COLUMNS = ["upos", "xpos", "feats", "deprel", "deps", "lex", "adp", "scene", "function"]
+POOLED_COLUMNS = ["form", "lemma", "misc"]
+
+
+class StringPool:
+    """
+    A list of strings packed into one UTF-8 byte buffer, where string i is data[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, data: np.ndarray, offsets: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def tolist(self, start=0, stop=None):
+        stop = len(self) if stop is None else stop
+        offsets = self.offsets[start:stop + 1].tolist()
+        if not offsets:
+            return []
+        buffer = self.data[offsets[0]:offsets[-1]].tobytes()
+        base = offsets[0]
+        return [buffer[a - base:b - base].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+
+    def to_arrays(self, name):
+        return {f"{name}__data": self.data, f"{name}__offsets": self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        return cls(arrays[f"{name}__data"], arrays[f"{name}__offsets"])
+
+
+class Categorical:
+    """
+    A column of repeated strings, stored as integer codes into a vocabulary.
+    """
+    def __init__(self, codes: np.ndarray, vocab: StringPool):
+        self.codes = codes
+        self.vocab = vocab
+
+    @classmethod
+    def from_strings(cls, strings):
+        index = {}
+        codes = [index.setdefault(s, len(index)) for s in strings]
+        dtype = np.uint8 if len(index) <= 1 << 8 else np.uint16 if len(index) <= 1 << 16 else np.int32
+        return cls(np.array(codes, dtype=dtype), StringPool.from_strings(list(index)))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.vocab[int(self.codes[i])]
+
+    def tolist(self, start=0, stop=None):
+        vocab = self.vocab.tolist()
+        return [vocab[code] for code in self.codes[start:stop].tolist()]
+
+    def code_of(self, value):
+        """Code of value in the vocabulary, or -1 if it never occurs."""
+        vocab = self.vocab.tolist()
+        return vocab.index(value) if value in vocab else -1
+
+    def to_arrays(self, name):
+        return {f"{name}__codes": self.codes, **self.vocab.to_arrays(f"{name}__vocab")}
+
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        return cls(arrays[f"{name}__codes"], StringPool.from_arrays(arrays, f"{name}__vocab"))
+
+
+def misc_value(misc, *keys):
+    """
+    :return: value of the first of keys that the MISC column misc has, or None if it has none of them
+    """
+    items = misc.split("|")
+    for key in keys:
+        for item in items:
+            if item.startswith(key + "="):
+                return item[len(key) + 1:]
+    return None
+
+
+def read_conllu_sentences(file_path):
+    """
+    Yields (comment lines, token lines, blank_after) for every sentence of a .conllu or .conllulex file.
+    """
+    with open(file_path, encoding="utf-8", newline="") as f:
+        lines = f.read().split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()  # the file ends with a newline
+    comments, tokens = [], []
+    for line in lines:
+        if line == "":
+            yield comments, tokens, True
+            comments, tokens = [], []
+        elif line.startswith("#"):
+            comments.append(line)
+        else:
+            tokens.append(line)
+    if comments or tokens:
+        yield comments, tokens, False
+
+
+class _CorpusBuilder:
+    """Collects parsed CoNLL-U lines column by column before they are packed into arrays."""
+    def __init__(self):
+        self.columns = {name: [] for name in CONLLU_COLUMNS + ["lex", "adp", "scene", "function"]}
+        self.sentence_offsets = [0]
+        self.comments = []
+        self.blank_after = []
+        self.chapter_names = []
+        self.chapter_offsets = []
+        self._comment_lines = []
+
+    def add_comment(self, line):
+        self._comment_lines.append(line)
+
+    def add_token(self, line):
+        cols = line.split("\t")
+        if len(cols) < 10:
+            raise ValueError(f"Expected at least 10 columns, got {len(cols)}: {line!r}")
+        for name, value in zip(CONLLU_COLUMNS, cols):
+            self.columns[name].append(value)
+        self.columns["lex"].append("\t".join(cols[10:]))
+        misc = cols[9]
+        self.columns["adp"].append(misc_value(misc, "Adp_lemma", "Adp") or "_")
+        self.columns["scene"].append(misc_value(misc, "Scene") or "_")
+        self.columns["function"].append(misc_value(misc, "Funct") or "_")
+
+    def end_sentence(self, blank_after=True):
+        sent_id = None
+        for comment in self._comment_lines:
+            if comment.startswith("# sent_id = "):
+                sent_id = comment[len("# sent_id = "):]
+        chapter = sent_id.rsplit("-", 1)[0] if sent_id else ""
+        if not self.chapter_names or self.chapter_names[-1] != chapter:
+            self.chapter_names.append(chapter)
+            self.chapter_offsets.append(len(self.comments))
+
+        self.comments.append("\n".join(self._comment_lines))
+        self.blank_after.append(blank_after)
+        self.sentence_offsets.append(len(self.columns["id"]))
+        self._comment_lines = []
+
+    def build(self):
+        ids = self.columns["id"]
+        id_major = np.empty(len(ids), dtype=np.int32)
+        id_minor = np.zeros(len(ids), dtype=np.int32)
+        for n, _id in enumerate(ids):
+            if "-" in _id:
+                raise ValueError(f"Multiword token ranges are not supported: {_id}")
+            if "." in _id:
+                major, minor = _id.split(".")
+                id_major[n] = int(major)
+                id_minor[n] = int(minor)
+            else:
+                id_major[n] = int(_id)
+        head = np.array([-1 if h == "_" else int(h) for h in self.columns["head"]], dtype=np.int32)
+
+        arrays = {
+            "id_major": id_major,
+            "id_minor": id_minor,
+            "head": head,
+            "sentence_offsets": np.array(self.sentence_offsets, dtype=np.int64),
+            "chapter_offsets": np.array(self.chapter_offsets + [len(self.comments)], dtype=np.int64),
+            "blank_after": np.array(self.blank_after, dtype=np.uint8),
+            "has_lex": np.array([any(self.columns["lex"])], dtype=np.uint8),
+        }
+        for name in POOLED_COLUMNS:
+            arrays.update(StringPool.from_strings(self.columns[name]).to_arrays(name))
+        for name in CATEGORICAL_COLUMNS:
+            arrays.update(Categorical.from_strings(self.columns[name]).to_arrays(name))
+        arrays.update(StringPool.from_strings(self.comments).to_arrays("comments"))
+        arrays.update(StringPool.from_strings(self.chapter_names).to_arrays("chapter_names"))
+        return ColumnarCorpus(arrays)
+
+
+class ColumnarCorpus:
+    """
+    A treebank as columns of NumPy arrays. Token i of sentence s is row sentence_offsets[s] + i, and sentences of
+    chapter c are chapter_offsets[c] to chapter_offsets[c + 1].
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.id_major = arrays["id_major"]
+        self.id_minor = arrays["id_minor"]
+        self.head = arrays["head"]
+        self.sentence_offsets = arrays["sentence_offsets"]
+        self.chapter_offsets = arrays["chapter_offsets"]
+        self.blank_after = arrays["blank_after"]
+        self.has_lex = bool(arrays["has_lex"][0])
+        self.form, self.lemma, self.misc = [StringPool.from_arrays(arrays, name) for name in POOLED_COLUMNS]
+        self.upos, self.xpos, self.feats, self.deprel, self.deps, self.lex, self.adp, self.scene, self.function = \
+            [Categorical.from_arrays(arrays, name) for name in CATEGORICAL_COLUMNS]
+        self.comments = StringPool.from_arrays(arrays, "comments")
+        self.chapter_names = StringPool.from_arrays(arrays, "chapter_names")
+
+    @property
+    def n_tokens(self):
+        return len(self.id_major)
+
+    @property
+    def n_sentences(self):
+        return len(self.sentence_offsets) - 1
+
+    @property
+    def n_chapters(self):
+        return len(self.chapter_offsets) - 1
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def sentence_of_token(self):
+        return np.repeat(np.arange(self.n_sentences, dtype=np.int32), np.diff(self.sentence_offsets))
+
+    def chapter_of_sentence(self):
+        return np.repeat(np.arange(self.n_chapters, dtype=np.int32), np.diff(self.chapter_offsets))
+
+    def sent_ids(self):
+        sent_ids = []
+        for comments in self.comments.tolist():
+            sent_id = None
+            for comment in comments.split("\n"):
+                if comment.startswith("# sent_id = "):
+                    sent_id = comment[len("# sent_id = "):]
+            sent_ids.append(sent_id)
+        return sent_ids
+
+    @classmethod
+    def from_conllu(cls, file_path):
+        """
+        Read a .conllu or .conllulex file.
+        """
+        return cls.from_sentences(read_conllu_sentences(file_path))
+
+    @classmethod
+    def from_sentences(cls, sentences):
+        """
+        :param sentences: (comment lines, token lines, blank_after) per sentence, as from read_conllu_sentences()
+        """
+        builder = _CorpusBuilder()
+        for comments, tokens, blank_after in sentences:
+            for line in comments:
+                builder.add_comment(line)
+            for line in tokens:
+                builder.add_token(line)
+            builder.end_sentence(blank_after=blank_after)
+        return builder.build()
+
+    @classmethod
+    def from_json(cls, annotation_json_obj):
+        """
+        Build the store from annotation-ready JSON, converting it the same way util.json2conllu() does.
+
+        :param annotation_json_obj: JSON object or path, e.g. little_prince_annotation_ready.json
+        """
+        if isinstance(annotation_json_obj, str):
+            with open(annotation_json_obj, encoding="utf-8") as f:
+                annotation_json_obj = json.load(f)
+        builder = _CorpusBuilder()
+        r = Romanizer()
+        for c, chapter in enumerate(annotation_json_obj):
+            for s, sent in enumerate(chapter):
+                sentence_text, token_lines = sentence2conllu(sent, r)
+                builder.add_comment(f"# sent_id = {format_sent_id(c, s)}")
+                builder.add_comment(f"# text = {sentence_text}")
+                for tok in token_lines:
+                    builder.add_token(tok.conllu_line())
+                builder.end_sentence(blank_after=True)
+        return builder.build()
+
+    def save(self, file_path):
+        """
+        Save as an uncompressed .npz, so that load() can memory-map it.
+        """
+        np.savez(file_path, **self.arrays)
+
+    @classmethod
+    def load(cls, file_path, mmap=True):
+        if mmap:
+            return cls(_mmap_npz(file_path))
+        with np.load(file_path) as npz:
+            return cls({name: npz[name] for name in npz.files})
+
+    def token_lines(self, start, stop):
+        """
+        CoNLL-U(-Lex) lines of tokens start to stop.
+        """
+        ids = [str(major) if minor == 0 else f"{major}.{minor}"
+               for major, minor in zip(self.id_major[start:stop].tolist(), self.id_minor[start:stop].tolist())]
+        heads = ["_" if head == -1 else str(head) for head in self.head[start:stop].tolist()]
+        columns = [ids, self.form.tolist(start, stop), self.lemma.tolist(start, stop),
+                   self.upos.tolist(start, stop), self.xpos.tolist(start, stop), self.feats.tolist(start, stop),
+                   heads, self.deprel.tolist(start, stop), self.deps.tolist(start, stop),
+                   self.misc.tolist(start, stop)]
+        if self.has_lex:
+            columns.append(self.lex.tolist(start, stop))
+        return ["\t".join(cols) for cols in zip(*columns)]
+
+    def iter_conllu_sentences(self):
+        """
+        Yields every sentence as a CoNLL-U(-Lex) block, including its comments and trailing blank line.
+        """
+        lines = self.token_lines(0, self.n_tokens)
+        comments = self.comments.tolist()
+        offsets = self.sentence_offsets.tolist()
+        blank_after = self.blank_after.tolist()
+        for s in range(self.n_sentences):
+            block = [comments[s]] if comments[s] else []
+            block += lines[offsets[s]:offsets[s + 1]]
+            yield "\n".join(block) + ("\n\n" if blank_after[s] else "\n")
+
+    def write_conllu(self, file_path):
+        with open(file_path, "w", encoding="utf-8", newline="") as f:
+            for block in self.iter_conllu_sentences():
+                f.write(block)
+
+
+def _mmap_npz(file_path):
+    """
+    Memory-map every array of an uncompressed .npz. np.load() ignores mmap_mode for .npz archives, but members
+    written by np.savez() are stored as plain .npy files inside the zip, so each can be mapped in place.
+    """
+    arrays = {}
+    with zipfile.ZipFile(file_path) as zf, open(file_path, "rb") as f:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{file_path} is compressed and cannot be memory-mapped")
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            name = info.filename[:-len(".npy")]
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+            else:
+                arrays[name] = np.memmap(file_path, dtype=dtype, mode="r", offset=f.tell(), shape=shape,
+                                         order="F" if fortran_order else "C")
+    return arrays
+
+
+if __name__ == "__main__":
+    source, target = sys.argv[1], sys.argv[2]
+    if source.endswith(".json"):
+        corpus = ColumnarCorpus.from_json(source)
+    else:
+        corpus = ColumnarCorpus.from_conllu(source)
+    corpus.save(target)
+    print(f"{corpus.n_chapters} chapters, {corpus.n_sentences} sentences, {corpus.n_tokens} tokens, "
+          f"{corpus.nbytes / 1e6:.2f} MB of arrays.")
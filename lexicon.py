@@ -0,0 +1,228 @@
+"""
+Corpus-derived lexicon, to tag known tokens without Stanza's POS and lemma processors.
+
+Every word of a treebank (a row with an integer id) contributes an analysis of its form: the Stanza-style lemma (the
+MSeg morphemes joined by "+", or the form itself for single-morpheme words), UPOS and XPOS. Words whose lemma cannot
+be rebuilt, because MSeg does not line up with XPOS, are left out. For forms that have a lemma, UPOS and XPOS in
+util.xpos_error_fix, that correction is used regardless of the counts. A form is confident when it was seen at least
+min_count times and its most frequent analysis makes up at least threshold of them. Other forms are looked up again
+with the previous form, as (previous form, form) pairs, which are confident under the same rule.
+
+Forms and pairs are stored as 64-bit BLAKE2b hashes in sorted arrays, next to the code of their analysis and its
+confidence, so the lexicon is a small .npz and a whole batch of tokens is looked up with one np.searchsorted().
+
+get_stanza_annotation(..., lexicon=Lexicon.load()) tags sentences whose tokens are all confident with the lexicon and
+runs only the dependency parser on them; other sentences go through the full pipeline.
+
+Usage:
+    python3 lexicon.py build little_prince_ko.conllu [--out lexicon.npz] [--min-count 2] [--threshold 0.95]
+    python3 lexicon.py evaluate [--sample 200] [--pretokenized]
+"""
+import argparse
+import hashlib
+import time
+from collections import Counter
+
+import numpy as np
+
+from corpus_store import ColumnarCorpus, StringPool, misc_value
+from util import xpos_error_fix
+
+LEXICON_PATH = "lexicon.npz"
+AMBIGUOUS = -1  # analysis code of forms that are known but not confident
+UNKNOWN = -2
+SENTENCE_START = "<s>"
+
+
+def form_key(*forms):
+    return int.from_bytes(hashlib.blake2b("\x1f".join(forms).encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def word_analysis(form, lemma, upos, xpos, misc):
+    """
+    :return: Stanza-style (lemma, UPOS, XPOS) of a treebank word, or None if its lemma cannot be rebuilt
+    """
+    if upos == "PUNCT":
+        return lemma, upos, xpos
+    mseg = misc_value(misc, "MSeg")
+    if mseg is not None:
+        morphemes = mseg.split("-")
+        return ("+".join(morphemes), upos, xpos) if len(morphemes) == len(xpos.split("+")) else None
+    if lemma == "_" and "+" not in xpos:
+        return form, upos, xpos
+    return None
+
+
+def _table(entries, analysis_codes):
+    """
+    :param entries: dict of key -> (analysis, confidence, count), analysis None if not confident
+    :return: sorted keys, analysis codes, confidences and counts as arrays
+    """
+    keys = np.array(list(entries), dtype=np.uint64)
+    order = np.argsort(keys)
+    values = list(entries.values())
+    codes = np.array([AMBIGUOUS if analysis is None else analysis_codes.setdefault(analysis, len(analysis_codes))
+                      for analysis, _, _ in values], dtype=np.int32)
+    confidence = np.array([confidence for _, confidence, _ in values], dtype=np.float32)
+    counts = np.array([count for _, _, count in values], dtype=np.int32)
+    return keys[order], codes[order], confidence[order], counts[order]
+
+
+class Lexicon:
+    """
+    Form -> (lemma, UPOS, XPOS) lookup over hashed forms, see the module docstring.
+    """
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.analyses = [tuple(analysis.split("\t")) for analysis in StringPool.from_arrays(arrays, "analyses").tolist()]
+
+    @classmethod
+    def build(cls, corpus: ColumnarCorpus, min_count=2, threshold=0.95, corrections=xpos_error_fix):
+        forms, lemmas, uposes = corpus.form.tolist(), corpus.lemma.tolist(), corpus.upos.tolist()
+        xposes, miscs = corpus.xpos.tolist(), corpus.misc.tolist()
+        id_minor = corpus.id_minor.tolist()
+        offsets = corpus.sentence_offsets.tolist()
+
+        form_counts, pair_counts = {}, {}
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            previous = SENTENCE_START
+            for row in range(start, stop):
+                if id_minor[row] != 0:
+                    continue
+                analysis = word_analysis(forms[row], lemmas[row], uposes[row], xposes[row], miscs[row])
+                if analysis is not None:
+                    form_counts.setdefault(forms[row], Counter())[analysis] += 1
+                    pair_counts.setdefault((previous, forms[row]), Counter())[analysis] += 1
+                previous = forms[row]
+
+        def entry(counts):
+            analysis, n = counts.most_common(1)[0]
+            total = sum(counts.values())
+            confident = total >= min_count and n / total >= threshold
+            return analysis if confident else None, n / total, total
+
+        form_entries = {form: entry(counts) for form, counts in form_counts.items()}
+        for form, correction in corrections.items():
+            if all(key in correction for key in ["lemma", "upos", "xpos"]):
+                count = form_entries[form][2] if form in form_entries else 0
+                form_entries[form] = (correction["lemma"], correction["upos"], correction["xpos"]), 1.0, count
+        pair_entries = {pair: entry(counts) for pair, counts in pair_counts.items()
+                        if form_entries[pair[1]][0] is None}
+
+        analysis_codes = {}
+        arrays = {}
+        for name, entries in [("form", {form_key(form): value for form, value in form_entries.items()}),
+                              ("pair", {form_key(*pair): value for pair, value in pair_entries.items()})]:
+            keys, codes, confidence, counts = _table(entries, analysis_codes)
+            arrays.update({f"{name}_keys": keys, f"{name}_analysis": codes, f"{name}_confidence": confidence,
+                           f"{name}_count": counts})
+        arrays.update(StringPool.from_strings(["\t".join(analysis) for analysis in analysis_codes]).to_arrays(
+            "analyses"))
+        return cls(arrays)
+
+    def save(self, file_path=LEXICON_PATH):
+        np.savez(file_path, **self.arrays)
+
+    @classmethod
+    def load(cls, file_path=LEXICON_PATH):
+        with np.load(file_path) as npz:
+            return cls({name: npz[name] for name in npz.files})
+
+    def __len__(self):
+        return len(self.arrays["form_keys"])
+
+    def _find(self, table, keys):
+        sorted_keys = self.arrays[f"{table}_keys"]
+        keys = np.array(keys, dtype=np.uint64)
+        if not len(sorted_keys):
+            return np.full(len(keys), UNKNOWN, dtype=np.int32)
+        where = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+        return np.where(sorted_keys[where] == keys, self.arrays[f"{table}_analysis"][where], UNKNOWN)
+
+    def lookup(self, sentences):
+        """
+        :param sentences: lists of token texts
+        :return: per sentence, the (lemma, UPOS, XPOS) of every token, or None if any token is not confident
+        """
+        tokens = [token for sentence in sentences for token in sentence]
+        previous = [previous for sentence in sentences for previous in [SENTENCE_START] + sentence[:-1]]
+        codes = self._find("form", [form_key(token) for token in tokens])
+        ambiguous = np.flatnonzero(codes == AMBIGUOUS)
+        if len(ambiguous):
+            codes[ambiguous] = self._find("pair", [form_key(previous[i], tokens[i]) for i in ambiguous.tolist()])
+
+        tagged = []
+        start = 0
+        codes = codes.tolist()
+        for sentence in sentences:
+            sentence_codes = codes[start:start + len(sentence)]
+            start += len(sentence)
+            known = sentence and min(sentence_codes) >= 0
+            tagged.append([self.analyses[code] for code in sentence_codes] if known else None)
+        return tagged
+
+
+def evaluate(lexicon, sentences, pretokenized=False, profile=None):
+    """
+    Parse sentences with the full pipeline and with the lexicon fast path, and compare.
+
+    :return: dict with the number of sentences tagged with the lexicon, the seconds taken by each run, the number of
+        sentences with identical parses, and per field the number of tokens that agree and that were compared
+    """
+    from main import build_lexicon_pipelines, build_stanza_pipeline, parse_sentences, parse_with_lexicon
+    from stanza_tune import field_agreement, sentence_matches
+
+    nlp = build_stanza_pipeline(pretokenized=pretokenized, profile=profile)
+    start = time.perf_counter()
+    full = parse_sentences(nlp, sentences, pretokenized=pretokenized)
+    full_time = time.perf_counter() - start
+
+    tokenizer, tagged_parser = build_lexicon_pipelines(pretokenized=pretokenized, profile=profile)
+    stats = Counter()
+    start = time.perf_counter()
+    fast = parse_with_lexicon(lexicon, sentences, lambda batch: parse_sentences(nlp, batch, pretokenized=pretokenized),
+                              tokenizer, tagged_parser, pretokenized=pretokenized, stats=stats)
+    fast_time = time.perf_counter() - start
+
+    agree, compared = field_agreement(full, fast)
+    return {"sentences": len(sentences), "bypassed": stats["bypassed"], "full_time": full_time,
+            "fast_time": fast_time, "identical": sum(map(sentence_matches, full, fast)),
+            "agree": agree, "compared": compared}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or evaluate the lexicon fast path for Stanza.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build the lexicon from a treebank")
+    build_parser.add_argument("treebank", nargs="?", default="little_prince_ko.conllu")
+    build_parser.add_argument("--out", default=LEXICON_PATH)
+    build_parser.add_argument("--min-count", type=int, default=2, help="occurrences needed to trust a form")
+    build_parser.add_argument("--threshold", type=float, default=0.95,
+                              help="share of its occurrences the most frequent analysis needs")
+    evaluate_parser = subparsers.add_parser("evaluate", help="compare the fast path with the full pipeline")
+    evaluate_parser.add_argument("--lexicon", default=LEXICON_PATH)
+    evaluate_parser.add_argument("--sample", type=int, default=200, help="number of sentences to parse")
+    evaluate_parser.add_argument("--pretokenized", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        lexicon = Lexicon.build(ColumnarCorpus.from_conllu(args.treebank), args.min_count, args.threshold)
+        lexicon.save(args.out)
+        n_confident = int((lexicon.arrays["form_analysis"] >= 0).sum())
+        print(f"{len(lexicon)} forms, {n_confident} confident, {len(lexicon.arrays['pair_keys'])} (previous form, "
+              f"form) pairs, {len(lexicon.analyses)} analyses; wrote {args.out}")
+    else:
+        from main import split_punctuation
+        from stanza_tune import sample_sentences
+
+        sample = sample_sentences(n=args.sample)
+        if args.pretokenized:
+            sample = [[piece for word in sentence.split() for piece in split_punctuation(word)] for sentence in sample]
+        result = evaluate(Lexicon.load(args.lexicon), sample, pretokenized=args.pretokenized)
+        n = result["sentences"]
+        print(f"{result['bypassed']} of {n} sentences ({result['bypassed'] / n:.1%}) tagged with the lexicon")
+        print(f"full pipeline {n / result['full_time']:.1f} sentences/s, fast path "
+              f"{n / result['fast_time']:.1f} sentences/s; {result['identical']} of {n} parses identical")
+        for field, compared in result["compared"].items():
+            print(f"{'tokenization' if field == 'text' else field:<14}{result['agree'][field] / compared:>8.3f}  "
+                  f"({compared} {'sentences' if field == 'text' else 'tokens'})")
@@ -1,20 +1,33 @@
+import argparse
 import csv
+import multiprocessing
 import os
 
 import stanza
 import json
 import re
-from util import p2xpos, decompose_hangul, compose_syllable
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, repeat
+import util
+from util import p2xpos, decompose_hangul, compose_syllable, smart_open, artifact_path
+from stanza_daemon import DEFAULT_SOCKET_PATH, daemon_is_running, parse_with_daemon
 from typing import List
 from tqdm import tqdm
 
 
-def parse_tsv(file_path):
+def parse_tsv(file_path, keep_last_sentence=False):
+    """
+    :param file_path: TSV in the layout of little_prince_ko.tsv
+    :param keep_last_sentence: keep the last sentence of every document but the last. It is dropped by default, which
+        is how the published treebank was built from little_prince_ko.tsv
+    :return: list of documents, each a list of sentences, each a list of token dicts
+    """
     # This will hold all documents
     docs = []
 
     # Open and read the tsv file
-    with open(file_path, 'r', encoding='utf-8') as file:
+    with smart_open(file_path, 'r', encoding='utf-8') as file:
         reader = csv.DictReader(file, delimiter='\t')
 
         current_doc_id = None
@@ -30,6 +43,8 @@ def parse_tsv(file_path):
 
             # If this is a new document, save the current doc and start a new one
             if current_doc_id is not None and doc_id != current_doc_id:
+                if keep_last_sentence and current_sent:
+                    current_doc.append(current_sent)
                 docs.append(current_doc)
                 current_doc = []
                 current_sent = []
@@ -65,46 +80,323 @@ def parse_tsv(file_path):
     return docs
 
 
-def read_original_annotation():
-    file_path = "little_prince_ko.tsv"
+def read_original_annotation(file_path="little_prince_ko.tsv"):
     little_prince = parse_tsv(file_path)
-    with open("little_prince_ko.json", "w", encoding='utf-8') as f:
+    with smart_open(artifact_path("little_prince_ko.json"), "w", encoding='utf-8') as f:
         json.dump(little_prince, f, indent=4, ensure_ascii=False)
     return little_prince
 
 
-def get_stanza_annotation(og_anno):
+STANZA_PROFILE_PATH = "stanza_profile.json"
+
+
+def load_stanza_profile(file_path=STANZA_PROFILE_PATH):
+    """
+    Read the pipeline configuration written by stanza_tune.py.
+
+    :return: dict with torch_threads, pipeline (extra stanza.Pipeline keyword arguments) and parallel_pipelines, or
+        an empty dict if there is no profile
+    """
+    if not os.path.exists(file_path):
+        return {}
+    with open(file_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_stanza_pipeline(pretokenized=False, profile=None):
+    """
+    :param pretokenized: whether the pipeline gets lists of tokens instead of raw sentences
+    :param profile: pipeline configuration, as from load_stanza_profile(), which is used if not given
+    """
+    profile = load_stanza_profile() if profile is None else profile
+    if profile.get("torch_threads"):
+        import torch
+        torch.set_num_threads(profile["torch_threads"])
+    if pretokenized:
+        return stanza.Pipeline(lang="ko", processors="tokenize,pos,lemma,depparse", tokenize_pretokenized=True,
+                               **profile.get("pipeline", {}))
+    return stanza.Pipeline(lang="ko", processors="tokenize,pos,lemma,depparse", tokenize_no_ssplit=True,
+                           **profile.get("pipeline", {}))
+
+
+_worker_nlp = None
+
+
+def init_stanza_worker(pretokenized=False, profile=None):
+    global _worker_nlp
+    _worker_nlp = build_stanza_pipeline(pretokenized=pretokenized, profile=profile)
+
+
+def parse_in_stanza_worker(sentences, pretokenized=False):
+    return parse_sentences(_worker_nlp, sentences, pretokenized=pretokenized)
+
+
+def parse_sentences(nlp, sentences, pretokenized=False):
+    """
+    Parse a batch of sentences with a single pipeline call.
+
+    :param nlp: pipeline from build_stanza_pipeline(), built with the same pretokenized setting
+    :param sentences: sentence strings, or lists of tokens if pretokenized
+    :param pretokenized: whether sentences are already tokenized
+    :return: one Document.to_dict() per sentence
+    """
+    if not sentences:
+        return []
+    if not pretokenized:
+        return [doc.to_dict() for doc in nlp.bulk_process(sentences)]
+
+    # A list of token lists is parsed as a single document, one sentence per list. Character offsets run across the
+    # whole document, so rebase them to make each sentence look as if it had been parsed on its own.
+    parsed = []
+    for sent in nlp(sentences).to_dict():
+        base = sent[0].get("start_char", 0) if sent else 0
+        for token in sent:
+            if "start_char" in token:
+                token["start_char"] -= base
+                token["end_char"] -= base
+        parsed.append([sent])
+    return parsed
+
+
+def build_lexicon_pipelines(pretokenized=False, profile=None):
+    """
+    Pipelines for parse_with_lexicon().
+
+    :return: a tokenize-only pipeline (None if pretokenized) and a depparse pipeline that takes lemmas, UPOS and XPOS
+        as given
+    """
+    profile = load_stanza_profile() if profile is None else profile
+    tokenizer = None if pretokenized else stanza.Pipeline(lang="ko", processors="tokenize", tokenize_no_ssplit=True)
+    batch_size = {key: value for key, value in profile.get("pipeline", {}).items() if key == "depparse_batch_size"}
+    tagged_parser = stanza.Pipeline(lang="ko", processors="depparse", depparse_pretagged=True, **batch_size)
+    return tokenizer, tagged_parser
+
+
+def parse_with_lexicon(lexicon, sentences, parse, tokenizer, tagged_parser, pretokenized=False, stats=None):
+    """
+    Parse sentences, tagging those whose tokens are all confident in the lexicon with it and running only the
+    dependency parser on them. The other sentences are parsed with parse().
+
+    :param lexicon: lexicon.Lexicon
+    :param sentences: sentence strings, or lists of tokens if pretokenized
+    :param parse: function parsing a list of sentences with the full pipeline, like parse_sentences()
+    :param tokenizer: tokenize-only pipeline from build_lexicon_pipelines(), unused if pretokenized
+    :param tagged_parser: depparse pipeline from build_lexicon_pipelines()
+    :param pretokenized: whether sentences are already tokenized
+    :param stats: Counter to which the number of sentences and of sentences tagged with the lexicon are added
+    :return: one Document.to_dict() per sentence
+    """
+    if not sentences:
+        return []
+    if pretokenized:
+        token_lists = []
+        for tokens in sentences:
+            ends = list(accumulate(len(token) + 1 for token in tokens))
+            token_lists.append([{"id": i + 1, "text": token, "start_char": end - len(token) - 1, "end_char": end - 1}
+                                for i, (token, end) in enumerate(zip(tokens, ends))])
+    else:
+        # a sentence the tokenizer splits in two cannot be tagged as one
+        token_lists = [doc[0] if len(doc) == 1 else [] for doc in
+                       (doc.to_dict() for doc in tokenizer.bulk_process(sentences))]
+
+    tags = lexicon.lookup([[token["text"] for token in tokens] for tokens in token_lists])
+    known = [i for i, tag in enumerate(tags) if tag is not None]
+    unknown = [i for i, tag in enumerate(tags) if tag is None]
+
+    parsed = [None] * len(sentences)
+    if known:
+        pretagged = stanza.Document([[{**token, "lemma": lemma, "upos": upos, "xpos": xpos}
+                                      for token, (lemma, upos, xpos) in zip(token_lists[i], tags[i])] for i in known])
+        for i, sent in zip(known, tagged_parser(pretagged).to_dict()):
+            parsed[i] = [sent]
+    for i, doc in zip(unknown, parse([sentences[i] for i in unknown])):
+        parsed[i] = doc
+
+    if stats is not None:
+        stats["sentences"] += len(sentences)
+        stats["bypassed"] += len(known)
+    return parsed
+
+
+punctuation_split_pattern = re.compile(r"[^\W_]+|[\W_]+")
+
+
+def split_punctuation(form):
+    """
+    Deterministically split a KOMA form into the tokens fed to Stanza in pretokenized mode: every maximal run of
+    punctuation becomes its own token.
+
+    For example, "있겠지......>하고" becomes "있겠지", "......>", "하고".
+    """
+    return punctuation_split_pattern.findall(form)
+
+
+def is_stacked_duplicate(og_token):
+    return og_token["token_id"][-2:] in ["-2", "-3"]
+
+
+def sentence_inputs(og_sent):
+    """
+    :param og_sent: sentence of the original annotations
+    :return: the raw sentence fed to Stanza, and the tokens fed to it in pretokenized mode
+    """
+    # There are duplicate entries for stacked postpositions, with -2 and -3 token ids. We do not count those.
+    forms = [w['form'] for w in og_sent if not is_stacked_duplicate(w)]
+    return ' '.join(forms), [piece for form in forms for piece in split_punctuation(form)]
+
+
+def restore_pretokenized_spacing(og_sent, stanza_sent):
+    """
+    Give the Stanza tokens of a sentence parsed in pretokenized mode the character offsets and SpaceAfter=No of the
+    raw sentence, as the Stanza tokenizer would have: a token split off a KOMA form by split_punctuation() is not
+    followed by a space unless it ends the form. Stanza otherwise puts a space after every token it was given.
+
+    :param og_sent: sentence of the original annotations
+    :param stanza_sent: Stanza tokens of the sentence, changed in place; left as they are if they are not the tokens
+        of sentence_inputs()
+    """
+    spans = []
+    offset = 0
+    for og_token in og_sent:
+        if is_stacked_duplicate(og_token):
+            continue
+        form = og_token["form"]
+        for match in punctuation_split_pattern.finditer(form):
+            spans.append((offset + match.start(), offset + match.end(), match.end() == len(form)))
+        offset += len(form) + 1
+    if len(spans) != len(stanza_sent):
+        return
+
+    for stanza_token, (start, end, space_after) in zip(stanza_sent, spans):
+        stanza_token["start_char"] = start
+        stanza_token["end_char"] = end
+        misc = [item for item in stanza_token.get("misc", "_").split("|") if item not in ["_", "SpaceAfter=No"]]
+        if not space_after:
+            misc.append("SpaceAfter=No")
+        if misc:
+            stanza_token["misc"] = "|".join(misc)
+        else:
+            stanza_token.pop("misc", None)
+
+
+def get_stanza_annotation(og_anno, use_daemon=False, socket_path=DEFAULT_SOCKET_PATH, pretokenized=False,
+                          selection=None, lexicon=None):
     """
     Retrieve Stanza annotation.
 
     Sentence segmentation is disabled.
     Tokenization using the GSD package, others the KAIST package.
 
+    If use_daemon is set and a stanza_daemon.py is listening on socket_path, sentences are sent there one chapter
+    at a time and the model load is skipped. Otherwise the pipeline is loaded in-process, as it is when the daemon
+    answers with an error or not within stanza_daemon.DEFAULT_TIMEOUT.
+
+    If pretokenized is set, the Stanza tokenizer is skipped and KOMA forms are fed as tokens, with punctuation split
+    off by split_punctuation(). Their character offsets and SpaceAfter=No are those of the raw sentence, see
+    restore_pretokenized_spacing(). Use align_pretokenized_with_stanza() on the result.
+
+    Thread counts and batch sizes come from stanza_profile.json, if stanza_tune.py has written one. If the profile
+    asks for several parallel pipelines, chapters are parsed in that many processes.
+
+    With a selection, only the selected sentences are parsed, and they replace their old parses in the existing
+    little_prince_raw_sentences.json and little_prince_stanza.json.
+
+    With a lexicon (see lexicon.py), sentences whose tokens are all confident in it are tagged from the lexicon and
+    only dependency-parsed; the rest go through the full pipeline, in-process or on the daemon.
+
     :param og_anno: original annotations
+    :param use_daemon: parse with a running Stanza daemon, if there is one
+    :param socket_path: Unix socket of the Stanza daemon
+    :param pretokenized: feed KOMA tokens to Stanza instead of raw sentences
+    :param selection: util.Selection of sentences to parse
+    :param lexicon: lexicon.Lexicon for the fast path
     :return: stanza annotations
     """
-    nlp = stanza.Pipeline(lang="ko", processors="tokenize,pos,lemma,depparse", tokenize_no_ssplit=True)
-
+    selected = None if selection is None else selection.sentences(og_anno)
     sentences_in_raw_text = []
-    dd = []
-    for d in tqdm(og_anno):
-        ss = []  # one document
+    og_sentences = []
+    inputs = []
+    for c, d in enumerate(og_anno):
+        if selected is not None:
+            if c not in selected:
+                continue
+            d = [d[n] for n in selected[c]]
         _ss = []
+        _tokens = []
+        og_sentences.append(d)
         for s in d:
-            sentence_text = ' '.join([w['form'] for w in s if w['token_id'][-2:] not in ["-2", "-3"]])
-            # There are duplicate entries for stacked postpositions, with -2 and -3 token ids. We do not count those.
+            sentence_text, tokens = sentence_inputs(s)
             _ss.append(sentence_text)
-
-            parsed = nlp(sentence_text)
-            ss += parsed.to_dict()  # parsed.to_dict comes with an extra layer of nested []
-
+            _tokens.append(tokens)
         sentences_in_raw_text.append(_ss)
-        dd.append(ss)
+        inputs.append(_tokens if pretokenized else _ss)
+
+    profile = load_stanza_profile()
+    executor = None
+    if use_daemon and daemon_is_running(socket_path):
+        fallback = []  # in-process pipeline, loaded once the daemon fails
+
+        def parse(sentences):
+            if not fallback:
+                try:
+                    return parse_with_daemon(sentences, socket_path, pretokenized=pretokenized)
+                except (OSError, RuntimeError) as e:  # socket.timeout and ConnectionError are OSErrors
+                    print(f"Stanza daemon failed ({type(e).__name__}: {e}), parsing in-process from here on")
+                    fallback.append(build_stanza_pipeline(pretokenized=pretokenized, profile=profile))
+            return parse_sentences(fallback[0], sentences, pretokenized=pretokenized)
+        parsed_chapters = map(parse, inputs)
+    elif profile.get("parallel_pipelines", 1) > 1 and lexicon is None:
+        # spawn, since forking a process that already runs torch threads can deadlock
+        executor = ProcessPoolExecutor(max_workers=profile["parallel_pipelines"],
+                                       mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_stanza_worker, initargs=(pretokenized, profile))
+        parsed_chapters = executor.map(parse_in_stanza_worker, inputs, repeat(pretokenized))
+    else:
+        nlp = build_stanza_pipeline(pretokenized=pretokenized, profile=profile)
+
+        def parse(sentences):
+            return parse_sentences(nlp, sentences, pretokenized=pretokenized)
+        parsed_chapters = map(parse, inputs)
+
+    lexicon_stats = Counter()
+    if lexicon is not None:
+        tokenizer, tagged_parser = build_lexicon_pipelines(pretokenized=pretokenized, profile=profile)
+        parsed_chapters = map(lambda sentences: parse_with_lexicon(lexicon, sentences, parse, tokenizer, tagged_parser,
+                                                                   pretokenized=pretokenized, stats=lexicon_stats),
+                              inputs)
 
-    with open("little_prince_raw_sentences.json", "w", encoding='utf-8') as f:
+    dd = []
+    try:
+        for parsed_chapter in tqdm(parsed_chapters, total=len(inputs)):
+            ss = []  # one document
+            for parsed in parsed_chapter:
+                ss += parsed  # parsed.to_dict comes with an extra layer of nested []
+            dd.append(ss)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if lexicon is not None:
+        print(f"{lexicon_stats['bypassed']} of {lexicon_stats['sentences']} sentences tagged with the lexicon")
+    if pretokenized:
+        for d, ss in zip(og_sentences, dd):
+            for og_sent, parsed in zip(d, ss):
+                restore_pretokenized_spacing(og_sent, parsed)
+
+    if selected is not None:
+        raw_sentences, parses = {}, {}
+        for (c, sentence_numbers), _ss, ss in zip(selected.items(), sentences_in_raw_text, dd):
+            if len(ss) != len(sentence_numbers):
+                raise ValueError(f"Stanza split the selected sentences of chapter {c + 1} into {len(ss)} sentences")
+            for s, sentence_text, parsed in zip(sentence_numbers, _ss, ss):
+                raw_sentences[(c, s)] = sentence_text
+                parses[(c, s)] = parsed
+        util.merge_sentences("little_prince_raw_sentences.json", raw_sentences)
+        return util.merge_sentences("little_prince_stanza.json", parses)
+
+    with smart_open(artifact_path("little_prince_raw_sentences.json"), "w", encoding='utf-8') as f:
         json.dump(sentences_in_raw_text, f, indent=4, ensure_ascii=False)
 
-    with open("little_prince_stanza.json", "w", encoding='utf-8') as f:
+    with smart_open(artifact_path("little_prince_stanza.json"), "w", encoding='utf-8') as f:
         json.dump(dd, f, indent=4, ensure_ascii=False)
 
     return dd
@@ -119,7 +411,7 @@ def just_korean_chars(mixed_text):
     return ''.join(korean_chars)
 
 
-def align_original_with_stanza(og_book, stanza_book):
+def align_original_with_stanza(og_book, stanza_book, selection=None):
     """
     Original annotations with the KOMA tagger do not separate punctuation, while stanza annotations do. Here we map
     KOMA tokens to stanza tokens (one to many).
@@ -135,96 +427,265 @@ def align_original_with_stanza(og_book, stanza_book):
         o: KOMA token id inside sentence
         s: Stanza token id inside sentence
 
+    With a selection, only the selected sentences are aligned, and they replace their old versions in the existing
+    little_prince_merged.json.
+
     :param og_book: original annotations, in JSON format
     :param stanza_book: stanza annotations, also in JSON format
+    :param selection: util.Selection of sentences to align
     :return: JSON object, where original annotation information is added to stanza entries.
     """
+    if selection is not None:
+        merged = {}
+        for c, sentence_numbers in selection.sentences(stanza_book).items():
+            merged_sentences = align_chapter(og_book[c], stanza_book[c], sentences=sentence_numbers)
+            merged.update(zip([(c, s) for s in sentence_numbers], merged_sentences))
+        return util.merge_sentences("little_prince_merged.json", merged)
 
     merged_book = [] # entire annotation book
     for n_chapter, [og_chapter, stanza_chapter] in enumerate(zip(og_book, stanza_book)):
-        merged_chapter = []  # contains merged sentences
-        og_tokens_in_chapter = [t for s in og_chapter for t in s] # flatten all tokens in og chapter
-        o = 0
-        for n_sent, stanza_sent in enumerate(stanza_chapter):
-            merged_sent = [] # contains merged tokens
-
-            s = 0
-            while s < len(stanza_sent):
-                og_token = og_tokens_in_chapter[o]
-                stanza_token = stanza_sent[s]
+        merged_book.append(align_chapter(og_chapter, stanza_chapter))
 
-                # stanza token is equivalent to og token
-                if stanza_token["text"] == og_token["form"]:
-                    merged_sent.append({**og_token, **stanza_token})
-                    # if next OG entry contains the same token, keep s constant--next OG token also needs
-                    # current Stanza parse.
-                    # There exists 4 cases '"저녁에는', '"제겐', '"어린아이들만이', '"나에겐' where an og-token with stacked postposition
-                    # start with a punct in its form, 0 cases where an og-token with stacked postposition with ends with one.
-                    # Check whether next OG token refers to the identical token, to escape cases
-                    # like a token 4-2 being followed by token 5-1.
-                    if '-' in og_token["token_id"] and '-' in og_tokens_in_chapter[o + 1]["token_id"] and \
-                            (og_token["token_id"].split('-')[0] == og_tokens_in_chapter[o + 1]["token_id"].split('-')[0]):
-                        o += 1
-                    # otherwise, move to next token
-                    else:
-                        o += 1
-                        s += 1
-                elif stanza_token["text"] in og_token["form"]: # only partial match
-                    og_token_form = og_token["form"]
-                    partial_s_tokens_together = ""
-                    local_stanza_tokens_list = []
-
-                    # parse through stanza tokens until we cover the entire og token
-                    # e.g. parse through stanza tokens: "있겠지", ".", "....", ".", ">하고", corresponding to og token "있겠지......>하고"
-                    # This assumes that stanza tokens will respect og sentence boundary
-                    while partial_s_tokens_together != og_token_form and s < len(stanza_sent):
-                        stanza_token = stanza_sent[s]
-                        partial_s_tokens_together += stanza_token["text"]
-
-                        # If p not in stanza token, then remove p and SNACS annotations
-                        if adp_in_text(og_token["p"], stanza_token["text"]):
-                            local_stanza_tokens_list.append({**og_token, **stanza_token})
-                        else:
-                            local_stanza_tokens_list.append({**og_token,
-                                                             **stanza_token,
-                                                             **{"p": "_", "gold_scene": "_", "gold_function": "_"}
-                                                             })
-
-                        s += 1
-                    # Done parsing.
-                    # Now check if next og token is duplicate, in case of stacked postpositions
-                    if '-' in og_token["token_id"] and '-' in og_tokens_in_chapter[o + 1]["token_id"] and \
-                            (og_token["token_id"].split('-')[0] == og_tokens_in_chapter[o + 1]["token_id"].split('-')[
-                                0]):
-                        # Yes, duplicate--we do not see any cases where og tokens with stacked tokens end with
-                        # punctuation, so we do not care about order
-                        # this way, we will always have ["punct", "punct", "main-word-adp-1", "main-word-adp-2"]
-                        o += 1
-                        og_token = og_tokens_in_chapter[o]
-                        local_stanza_tokens_list += [{**og_token, **_s} for _s in local_stanza_tokens_list if _s["upos"] != "PUNCT"]
-                    else:
-                        # Nothing to do if no stacked postposition
-                        pass
-
-                    # add to merged_sent, move to next og and stanza tokens
-                    merged_sent += local_stanza_tokens_list
-                    # advnace just o since s has been advanced in the while loop parsing through local stanza tokens
-                    o += 1
-
-                else: # no match
-                    print(json.dumps(og_token, indent=4, ensure_ascii=False))
-                    print(json.dumps(stanza_token, indent=4, ensure_ascii=False))
-                    print("Something's wrong, man!")
-                    s += 1
-            merged_chapter.append(merged_sent)
+    with smart_open(artifact_path("little_prince_merged.json"), "w", encoding="utf-8") as f:
+        json.dump(merged_book, f, ensure_ascii=False, indent=4)
+
+    return merged_book
+
+
+def align_chapter(og_chapter, stanza_chapter, mismatches=None, sentences=None):
+    """
+    Align one chapter, see align_original_with_stanza(). The KOMA token id o runs across the whole chapter.
+
+    :param og_chapter: original annotations of the chapter
+    :param stanza_chapter: stanza annotations of the chapter
+    :param mismatches: list to collect (n_sent, og_token, stanza_token) of tokens that could not be matched.
+        Mismatches are printed if not given.
+    :param sentences: numbers of the sentences to align, all if not given. Since o runs across the chapter, the
+        sentences before the last selected one are still aligned, without output, to find where it starts.
+    :return: merged chapter, or the merged selected sentences
+    """
+    merged_chapter = []  # contains merged sentences
+    og_tokens_in_chapter = [t for s in og_chapter for t in s] # flatten all tokens in og chapter
+    o = 0
+    selected = None if sentences is None else set(sentences)
+    n_aligned = len(stanza_chapter) if selected is None else max(selected, default=-1) + 1
+    for n_sent, stanza_sent in enumerate(stanza_chapter[:n_aligned]):
+        if selected is not None and n_sent not in selected:
+            _, o = align_sentence(og_tokens_in_chapter, o, stanza_sent, [])
+            continue
+        sentence_mismatches = None if mismatches is None else []
+        merged_sent, o = align_sentence(og_tokens_in_chapter, o, stanza_sent, sentence_mismatches)
+        if mismatches is not None:
+            mismatches += [(n_sent, og_token, stanza_token) for og_token, stanza_token in sentence_mismatches]
+        merged_chapter.append(merged_sent)
+    return merged_chapter
+
+
+def align_pretokenized_with_stanza(og_book, stanza_book, selection=None):
+    """
+    Alignment for Stanza annotations produced with get_stanza_annotation(..., pretokenized=True).
+
+    Stanza was fed split_punctuation() of every KOMA form, so in the common case the i-th KOMA token simply owns the
+    next len(split_punctuation(form)) Stanza tokens, and stacked postposition duplicates (-2, -3) share the Stanza
+    token of their -1 entry. Sentences where Stanza tokens do not line up with that, or where a stacked
+    postposition sits on a token with punctuation, go through align_sentence() instead.
+
+    With a selection, only the selected sentences are aligned, and they replace their old versions in the existing
+    little_prince_merged.json.
+
+    :param og_book: original annotations, in JSON format
+    :param stanza_book: pretokenized stanza annotations, also in JSON format
+    :param selection: util.Selection of sentences to align
+    :return: JSON object, where original annotation information is added to stanza entries.
+    """
+    if selection is not None:
+        merged = {}
+        n_fallback = 0
+        for c, sentence_numbers in selection.sentences(stanza_book).items():
+            merged_sentences, _n_fallback = align_pretokenized_chapter(og_book[c], stanza_book[c],
+                                                                       sentences=sentence_numbers)
+            merged.update(zip([(c, s) for s in sentence_numbers], merged_sentences))
+            n_fallback += _n_fallback
+        print(f"{n_fallback} of {len(merged)} sentences needed the fallback aligner.")
+        return util.merge_sentences("little_prince_merged.json", merged)
+
+    merged_book = []
+    n_fallback = 0
+    for og_chapter, stanza_chapter in zip(og_book, stanza_book):
+        merged_chapter, _n_fallback = align_pretokenized_chapter(og_chapter, stanza_chapter)
         merged_book.append(merged_chapter)
+        n_fallback += _n_fallback
+
+    print(f"{n_fallback} of {sum(len(c) for c in merged_book)} sentences needed the fallback aligner.")
 
-    with open("little_prince_merged.json", "w", encoding="utf-8") as f:
+    with smart_open(artifact_path("little_prince_merged.json"), "w", encoding="utf-8") as f:
         json.dump(merged_book, f, ensure_ascii=False, indent=4)
 
     return merged_book
 
 
+def align_pretokenized_chapter(og_chapter, stanza_chapter, mismatches=None, sentences=None):
+    """
+    Align one pretokenized chapter, see align_pretokenized_with_stanza().
+
+    :param og_chapter: original annotations of the chapter
+    :param stanza_chapter: pretokenized stanza annotations of the chapter
+    :param mismatches: list to collect (n_sent, og_token, stanza_token) of tokens the fallback aligner could not
+        match. Mismatches are printed if not given.
+    :param sentences: numbers of the sentences to align, all if not given
+    :return: merged chapter (or the merged selected sentences), and the number of sentences that needed the
+        fallback aligner
+    """
+    merged_chapter = []
+    n_fallback = 0
+    og_tokens_in_chapter = [t for s in og_chapter for t in s]
+    o = 0  # KOMA token id inside chapter where the sentence starts
+    selected = None if sentences is None else set(sentences)
+    for n_sent, [og_sent, stanza_sent] in enumerate(zip(og_chapter, stanza_chapter)):
+        if selected is not None and n_sent not in selected:
+            o += len(og_sent)
+            continue
+        merged_sent = map_pretokenized_sentence(og_sent, stanza_sent)
+        if merged_sent is None:
+            sentence_mismatches = None if mismatches is None else []
+            merged_sent, _ = align_sentence(og_tokens_in_chapter, o, stanza_sent, sentence_mismatches)
+            if mismatches is not None:
+                mismatches += [(n_sent, og_token, stanza_token) for og_token, stanza_token in sentence_mismatches]
+            n_fallback += 1
+        merged_chapter.append(merged_sent)
+        o += len(og_sent)
+    return merged_chapter, n_fallback
+
+
+def map_pretokenized_sentence(og_sent, stanza_sent):
+    """
+    Direct index mapping between the KOMA tokens of a sentence and its pretokenized Stanza tokens.
+
+    :return: merged sentence, or None if the sentence needs align_sentence()
+    """
+    pieces = [split_punctuation(og_token["form"]) for og_token in og_sent]
+    expected_texts = [piece for og_token, _pieces in zip(og_sent, pieces) if not is_stacked_duplicate(og_token)
+                      for piece in _pieces]
+    if [stanza_token["text"] for stanza_token in stanza_sent] != expected_texts:
+        return None
+
+    merged_sent = []
+    s = 0
+    for n, og_token in enumerate(og_sent):
+        if is_stacked_duplicate(og_token):
+            # same Stanza token as the -1 entry right before it
+            merged_sent.append({**og_token, **stanza_sent[s - 1]})
+        elif len(pieces[n]) == 1:
+            merged_sent.append({**og_token, **stanza_sent[s]})
+            s += 1
+        elif n + 1 < len(og_sent) and is_stacked_duplicate(og_sent[n + 1]):
+            return None
+        else:
+            # same as the partial match case of align_sentence()
+            for stanza_token in stanza_sent[s:s + len(pieces[n])]:
+                if adp_in_text(og_token["p"], stanza_token["text"]):
+                    merged_sent.append({**og_token, **stanza_token})
+                else:
+                    merged_sent.append({**og_token,
+                                        **stanza_token,
+                                        **{"p": "_", "gold_scene": "_", "gold_function": "_"}
+                                        })
+            s += len(pieces[n])
+    return merged_sent
+
+
+def align_sentence(og_tokens_in_chapter, o, stanza_sent, mismatches=None):
+    """
+    Align one Stanza sentence with the KOMA tokens of its chapter, starting from KOMA token o.
+    See align_original_with_stanza() for the details.
+
+    :param og_tokens_in_chapter: all original tokens in the chapter, flattened
+    :param o: KOMA token id inside chapter where this sentence starts
+    :param stanza_sent: stanza tokens of the sentence
+    :param mismatches: list to collect (og_token, stanza_token) of tokens that could not be matched. Mismatches are
+        printed if not given.
+    :return: merged sentence, and the KOMA token id where the next sentence starts
+    """
+    merged_sent = [] # contains merged tokens
+
+    s = 0
+    while s < len(stanza_sent):
+        og_token = og_tokens_in_chapter[o]
+        stanza_token = stanza_sent[s]
+
+        # stanza token is equivalent to og token
+        if stanza_token["text"] == og_token["form"]:
+            merged_sent.append({**og_token, **stanza_token})
+            # if next OG entry contains the same token, keep s constant--next OG token also needs
+            # current Stanza parse.
+            # There exists 4 cases '"저녁에는', '"제겐', '"어린아이들만이', '"나에겐' where an og-token with stacked postposition
+            # start with a punct in its form, 0 cases where an og-token with stacked postposition with ends with one.
+            # Check whether next OG token refers to the identical token, to escape cases
+            # like a token 4-2 being followed by token 5-1.
+            if '-' in og_token["token_id"] and '-' in og_tokens_in_chapter[o + 1]["token_id"] and \
+                    (og_token["token_id"].split('-')[0] == og_tokens_in_chapter[o + 1]["token_id"].split('-')[0]):
+                o += 1
+            # otherwise, move to next token
+            else:
+                o += 1
+                s += 1
+        elif stanza_token["text"] in og_token["form"]: # only partial match
+            og_token_form = og_token["form"]
+            partial_s_tokens_together = ""
+            local_stanza_tokens_list = []
+
+            # parse through stanza tokens until we cover the entire og token
+            # e.g. parse through stanza tokens: "있겠지", ".", "....", ".", ">하고", corresponding to og token "있겠지......>하고"
+            # This assumes that stanza tokens will respect og sentence boundary
+            while partial_s_tokens_together != og_token_form and s < len(stanza_sent):
+                stanza_token = stanza_sent[s]
+                partial_s_tokens_together += stanza_token["text"]
+
+                # If p not in stanza token, then remove p and SNACS annotations
+                if adp_in_text(og_token["p"], stanza_token["text"]):
+                    local_stanza_tokens_list.append({**og_token, **stanza_token})
+                else:
+                    local_stanza_tokens_list.append({**og_token,
+                                                     **stanza_token,
+                                                     **{"p": "_", "gold_scene": "_", "gold_function": "_"}
+                                                     })
+
+                s += 1
+            # Done parsing.
+            # Now check if next og token is duplicate, in case of stacked postpositions
+            if '-' in og_token["token_id"] and '-' in og_tokens_in_chapter[o + 1]["token_id"] and \
+                    (og_token["token_id"].split('-')[0] == og_tokens_in_chapter[o + 1]["token_id"].split('-')[
+                        0]):
+                # Yes, duplicate--we do not see any cases where og tokens with stacked tokens end with
+                # punctuation, so we do not care about order
+                # this way, we will always have ["punct", "punct", "main-word-adp-1", "main-word-adp-2"]
+                o += 1
+                og_token = og_tokens_in_chapter[o]
+                local_stanza_tokens_list += [{**og_token, **_s} for _s in local_stanza_tokens_list if _s["upos"] != "PUNCT"]
+            else:
+                # Nothing to do if no stacked postposition
+                pass
+
+            # add to merged_sent, move to next og and stanza tokens
+            merged_sent += local_stanza_tokens_list
+            # advnace just o since s has been advanced in the while loop parsing through local stanza tokens
+            o += 1
+
+        else: # no match
+            if mismatches is None:
+                print_mismatch(og_token, stanza_token)
+            else:
+                mismatches.append((og_token, stanza_token))
+            s += 1
+    return merged_sent, o
+
+
+def print_mismatch(og_token, stanza_token):
+    print(json.dumps(og_token, indent=4, ensure_ascii=False))
+    print(json.dumps(stanza_token, indent=4, ensure_ascii=False))
+    print("Something's wrong, man!")
+
+
 def adp_in_text(_p, _text):
     k_text = just_korean_chars(_text)
     if not k_text:
@@ -291,163 +752,280 @@ def create_adposition_abstract_node(full_token, _ord: int):
     return p_node, match_errors, xpos_errors
 
 
-def adjust_token_boundaries(merged_anno):
+def adjust_token_boundaries(merged_anno, selection=None):
     """
     Here, we adjust token boundaries by performing two tasks.
 
      1. join separated ellipses: ....(SE) + .(SF) -> .....(SE)
      2. duplicate postpositions as additional node: 마리만 -> 마리만(NNB+JXC) + 만(JXC)
 
+    Both are done sentence by sentence in adjust_sentence(); iterate over iter_adjusted_sentences() instead to avoid
+    holding the whole adjusted book in memory.
+
+    With a selection, only the selected sentences are adjusted, and they replace their old versions in the existing
+    little_prince_annotation_ready.json.
+
     :param merged_anno: Merged annotations
-    :return: Boundary adjusted annotations
-    """
-
-    # First, we join separated ellipses
-    _adjusted_doc = []
-    for chapter in merged_anno:
-        adjusted_chapter = []
-        for sentence in chapter:
-            i = 0
-            new_index = 1
-            id2nid = {}
-            adjusted_sentence = []
-            while i < len(sentence):
-                # Map id to newly formed id
-                # Could be part of separated elipsis
-                if sentence[i]["text"] == "." and i < len(sentence) - 1:
-                    # check if elipsis, and length of elipsis if yes
-                    j = 1
-                    while i + j < len(sentence):
-                        if sentence[i + j]["text"] == ".":
-                            j += 1
-                            continue
-                        else:
-                            break
-
-                    # sentence[i:i+j] is ellipsis
-                    merged_period_or_ellipsis_token = {
-                            "token_id": sentence[i]["token_id"],
-                            "form": sentence[i]["form"],
-                            "morph": sentence[i]["morph"],
-                            "p": "_",
-                            "gold_scene": "_",
-                            "gold_function": "_",
-                            "id": new_index,
-                            "text": ''.join([p["text"] for p in sentence[i:i + j]]),
-                            "lemma": ''.join([p["lemma"] for p in sentence[i:i + j]]),
-                            "upos": "PUNCT",
-                            "xpos": "sf", # should be sf, rather than sl or sr
-                            "head": sentence[i]["head"], # take the first head, as the second period often points to the previous elㅣipsis
-                            "deprel": sentence[i]["deprel"], # should probably be punct, but there are some artifacts that relates to head too
-                            "start_char": sentence[i]["start_char"],
-                            "end_char": sentence[i + j - 1]["end_char"]
-                        }
-
-                    adjusted_sentence.append(merged_period_or_ellipsis_token)
-                    id2nid[sentence[i]["id"]] = new_index
-                    i += j
-                    new_index += 1
-
-                elif "-2" in sentence[i]["token_id"] or "-3" in sentence[i]["token_id"]:
-                    token_with_new_index = {**sentence[i], "id": new_index} # use previous index, as it represents the same token
-                    adjusted_sentence.append(token_with_new_index)
-                    id2nid[sentence[i]["id"]] = new_index
-
-                    i += 1
-                    # do not increase index, as it was already increased before entering this stacked adp token
-                    new_index += 0
-
-                # no elㅣipsis in this token
-                else:
-                    token_with_new_index = {**sentence[i], "id": new_index}
-                    adjusted_sentence.append(token_with_new_index)
-                    id2nid[sentence[i]["id"]] = new_index
-                    i += 1
-                    new_index += 1
-
-            # We update the head when the sentence is finished parsing by
-            # using an original_id to new_id map,
-            # since the indices may have shifted due to ellipsis processing
-            for adj_token in adjusted_sentence:
-                if adj_token['head'] == 0: # root stays root
-                    pass
-                else:
-                    adj_token['head'] = id2nid[adj_token['head']]
-            adjusted_chapter.append(adjusted_sentence)
-        _adjusted_doc.append(adjusted_chapter)
+    :param selection: util.Selection of sentences to adjust
+    :return: Boundary adjusted annotations, and a Counter of xpos_errors and match_errors
+    """
+    adjusted_doc = [[] for _ in merged_anno]
+    adjusted = {}
+    errors = Counter(xpos_errors=0, match_errors=0)
+    for n_chapter, n_sent, adjusted_sentence, sentence_errors in iter_adjusted_sentences(merged_anno, selection):
+        adjusted_doc[n_chapter].append(adjusted_sentence)
+        adjusted[(n_chapter, n_sent)] = adjusted_sentence
+        errors.update(sentence_errors)
+
+    if selection is not None:
+        return util.merge_sentences("little_prince_annotation_ready.json", adjusted), errors
+
+    with smart_open(artifact_path("little_prince_annotation_ready.json"), "w", encoding="utf-8") as _f:
+        json.dump(adjusted_doc, _f, ensure_ascii=False, indent=4)
+
+    return adjusted_doc, errors
+
+
+def iter_adjusted_sentences(merged_anno, selection=None):
+    """
+    Adjust token boundaries sentence by sentence.
+
+    :param merged_anno: Merged annotations
+    :param selection: util.Selection of sentences to adjust, all if not given
+    :return: generator of (chapter number id, sentence number id, adjusted sentence, Counter of xpos_errors and
+        match_errors)
+    """
+    for n_chapter, chapter in enumerate(merged_anno):
+        for n_sent, sentence in enumerate(chapter):
+            if selection is not None and (n_chapter, n_sent) not in selection:
+                continue
+            adjusted_sentence, errors = adjust_sentence(sentence)
+            yield n_chapter, n_sent, adjusted_sentence, errors
+
+
+def adjust_sentence(sentence):
+    """
+    Join separated ellipses, remap heads and duplicate postpositions as additional nodes, for one merged sentence.
 
-    # Then, duplicate the postpositions
+    :param sentence: merged sentence
+    :return: adjusted sentence, and a Counter of xpos_errors and match_errors
+    """
+    # First, find the new token boundaries.
+    # Map id to newly formed id, since the indices shift due to ellipsis processing
+    spans = []  # (index of first merged token, number of merged tokens, new id, is period or ellipsis)
+    id2nid = {}
+    i = 0
+    new_index = 1
+    while i < len(sentence):
+        # Could be part of separated elipsis
+        if sentence[i]["text"] == "." and i < len(sentence) - 1:
+            # check if elipsis, and length of elipsis if yes
+            j = 1
+            while i + j < len(sentence) and sentence[i + j]["text"] == ".":
+                j += 1
+
+            # sentence[i:i+j] is ellipsis
+            spans.append((i, j, new_index, True))
+            id2nid[sentence[i]["id"]] = new_index
+            i += j
+            new_index += 1
+
+        elif "-2" in sentence[i]["token_id"] or "-3" in sentence[i]["token_id"]:
+            spans.append((i, 1, new_index, False))  # use previous index, as it represents the same token
+            id2nid[sentence[i]["id"]] = new_index
+            i += 1
+            # do not increase index, as it was already increased before entering this stacked adp token
+
+        # no elㅣipsis in this token
+        else:
+            spans.append((i, 1, new_index, False))
+            id2nid[sentence[i]["id"]] = new_index
+            i += 1
+            new_index += 1
+
+    # Then, build the new tokens, with heads mapped to the new ids, and duplicate the postpositions
     # If single postposition, duplicate the postposition to produce one additional node
     # If stacked postposition, duplicate each postposition to produce one additional node per stacked postposition
     # Postposition annotations are made at the additional postposition node
-    adjusted_doc = []
-    xpos_errors = 0
-    match_errors = 0
-    for chapter in _adjusted_doc:
-        adjusted_chapter = []
-        for sentence in chapter:
-            i = 0
-            adjusted_sentence = []
-            while i < len(sentence):
-                token = sentence[i]
-                if '-' not in token['token_id'] or '-1' in token['token_id']:
-                    # Add token and postposition if it exists
-                    full_token = json.loads(json.dumps(token)) # deepcopy
-                    full_token['p'] = "_"
-                    full_token["gold_scene"] = "_"
-                    full_token["gold_function"] = "_"
-                    del full_token["form"]
-                    del full_token["morph"]
-                    del full_token["token_id"]
-
-                    if token['p'] != "_" and token["upos"] not in ["PUNCT"]:
-                        p_node, _match_errors, _xpos_errors = create_adposition_abstract_node(token, 1)
-                        match_errors += _match_errors
-                        xpos_errors += _xpos_errors
-
-
-                        # Add to sentence (list of tokens)
-                        adjusted_sentence.append(full_token)
-                        adjusted_sentence.append(p_node)
-                    else:
-                        adjusted_sentence.append(full_token)
+    adjusted_sentence = []
+    errors = Counter(xpos_errors=0, match_errors=0)
+    for i, j, new_index, is_period_or_ellipsis in spans:
+        if is_period_or_ellipsis:
+            token = {
+                "token_id": sentence[i]["token_id"],
+                "form": sentence[i]["form"],
+                "morph": sentence[i]["morph"],
+                "p": "_",
+                "gold_scene": "_",
+                "gold_function": "_",
+                "id": new_index,
+                "text": ''.join([p["text"] for p in sentence[i:i + j]]),
+                "lemma": ''.join([p["lemma"] for p in sentence[i:i + j]]),
+                "upos": "PUNCT",
+                "xpos": "sf",  # should be sf, rather than sl or sr
+                "head": sentence[i]["head"],  # take the first head, as the second period often points to the previous elㅣipsis
+                "deprel": sentence[i]["deprel"],  # should probably be punct, but there are some artifacts that relates to head too
+                "start_char": sentence[i]["start_char"],
+                "end_char": sentence[i + j - 1]["end_char"]
+            }
+        else:
+            token = {**sentence[i], "id": new_index}
+        if token["head"] != 0:  # root stays root
+            token["head"] = id2nid[token["head"]]
+
+        if '-' not in token['token_id'] or '-1' in token['token_id']:
+            # Add token and postposition if it exists
+            full_token = {**token, "p": "_", "gold_scene": "_", "gold_function": "_"}
+            del full_token["form"]
+            del full_token["morph"]
+            del full_token["token_id"]
+            adjusted_sentence.append(full_token)
+
+            if token['p'] != "_" and token["upos"] not in ["PUNCT"]:
+                p_node, _match_errors, _xpos_errors = create_adposition_abstract_node(token, 1)
+                errors["match_errors"] += _match_errors
+                errors["xpos_errors"] += _xpos_errors
+                adjusted_sentence.append(p_node)
+
+        else:
+            # Pseudo-token for marking second or third stacked postposition
+            # We do not have access to head token id, so we use the first part of the pseudo-token id
+            # e.g. map id = "1-2" to id = 1
+            _ord = int(token['token_id'][-1])
+            p_node, _match_errors, _xpos_errors = create_adposition_abstract_node(token, _ord)
+            adjusted_sentence.append(p_node)
+
+    return adjusted_sentence, errors
+
+
+def align_and_adjust(og_book, stanza_book, pretokenized=False, workers=1, selection=None):
+    """
+    Alignment followed by token boundary adjustment, one chapter per task in a process pool.
 
-                else:
-                    # Pseudo-token for marking second or third stacked postposition
-                    # We do not have access to head token id, so we use the first part of the pseudo-token id
-                    # e.g. map id = "1-2" to id = 1
-                    p_node = json.loads(json.dumps(token))
+    Alignment only carries state within a chapter and adjustment within a sentence, so chapters are independent.
+    Results are merged in chapter order, and little_prince_merged.json and little_prince_annotation_ready.json come
+    out identical to running the aligner and adjust_token_boundaries() one after the other.
 
-                    _ord = int(p_node['token_id'][-1])
-                    p_node, _match_errors, _xpos_errors = create_adposition_abstract_node(token, _ord)
+    :param og_book: original annotations, in JSON format
+    :param stanza_book: stanza annotations, also in JSON format
+    :param pretokenized: whether stanza_book comes from get_stanza_annotation(..., pretokenized=True)
+    :param workers: number of worker processes
+    :param selection: util.Selection of sentences to align and adjust, which replace their old versions in the
+        existing artifacts; all sentences if not given
+    :return: merged annotations, boundary adjusted annotations, and a Counter of errors
+    """
+    merged_book = []
+    adjusted_doc = []
+    errors = Counter(xpos_errors=0, match_errors=0, mismatches=0, fallback_sentences=0)
+    if selection is None:
+        chapters = list(range(len(stanza_book)))
+        sentence_numbers = [None] * len(chapters)
+    else:
+        selected = selection.sentences(stanza_book)
+        chapters, sentence_numbers = list(selected), list(selected.values())
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for merged_chapter, adjusted_chapter, chapter_errors, mismatches in executor.map(
+                align_and_adjust_chapter, [og_book[c] for c in chapters], [stanza_book[c] for c in chapters],
+                repeat(pretokenized), sentence_numbers):
+            for _, og_token, stanza_token in mismatches:
+                print_mismatch(og_token, stanza_token)
+            merged_book.append(merged_chapter)
+            adjusted_doc.append(adjusted_chapter)
+            errors.update(chapter_errors)
+
+    if pretokenized:
+        print(f"{errors['fallback_sentences']} of {sum(len(c) for c in merged_book)} sentences needed the fallback aligner.")
+
+    if selection is not None:
+        merged = {(c, s): sentence for c, numbers, chapter in zip(chapters, sentence_numbers, merged_book)
+                  for s, sentence in zip(numbers, chapter)}
+        adjusted = {(c, s): sentence for c, numbers, chapter in zip(chapters, sentence_numbers, adjusted_doc)
+                    for s, sentence in zip(numbers, chapter)}
+        return (util.merge_sentences("little_prince_merged.json", merged),
+                util.merge_sentences("little_prince_annotation_ready.json", adjusted), errors)
+
+    with smart_open(artifact_path("little_prince_merged.json"), "w", encoding="utf-8") as f:
+        json.dump(merged_book, f, ensure_ascii=False, indent=4)
 
-                    adjusted_sentence.append(p_node)
-                i += 1
+    with smart_open(artifact_path("little_prince_annotation_ready.json"), "w", encoding="utf-8") as _f:
+        json.dump(adjusted_doc, _f, ensure_ascii=False, indent=4)
 
-            adjusted_chapter.append(adjusted_sentence)
-        adjusted_doc.append(adjusted_chapter)
+    return merged_book, adjusted_doc, errors
 
-    print(f"Encountered {xpos_errors} xpos_errors, {match_errors} match_errors.")
 
-    with open("little_prince_annotation_ready.json", "w", encoding="utf-8") as _f:
-        json.dump(adjusted_doc, _f, ensure_ascii=False, indent=4)
+def align_and_adjust_chapter(og_chapter, stanza_chapter, pretokenized=False, sentences=None):
+    """
+    Align and adjust one chapter.
 
-    return adjusted_doc
+    :param sentences: numbers of the sentences to align and adjust, all if not given
+    :return: merged chapter, adjusted chapter, Counter of errors, and (n_sent, og_token, stanza_token) mismatches
+    """
+    mismatches = []
+    errors = Counter(xpos_errors=0, match_errors=0, mismatches=0, fallback_sentences=0)
+    if pretokenized:
+        merged_chapter, errors["fallback_sentences"] = align_pretokenized_chapter(og_chapter, stanza_chapter,
+                                                                                  mismatches, sentences)
+    else:
+        merged_chapter = align_chapter(og_chapter, stanza_chapter, mismatches, sentences)
+    errors["mismatches"] = len(mismatches)
+
+    adjusted_chapter = []
+    for sentence in merged_chapter:
+        adjusted_sentence, sentence_errors = adjust_sentence(sentence)
+        adjusted_chapter.append(adjusted_sentence)
+        errors.update(sentence_errors)
+    return merged_chapter, adjusted_chapter, errors, mismatches
 
 
 if __name__ == "__main__":
-    original_annotations = read_original_annotation()
-    stanza_annotations = get_stanza_annotation(original_annotations)
-
-    # with open("little_prince_ko.json", encoding='utf-8') as f:
+    parser = argparse.ArgumentParser(description="Build the UD-ready K-SNACS annotations from little_prince_ko.tsv.")
+    parser.add_argument("--pretokenized", action="store_true",
+                        help="Feed KOMA tokens to Stanza instead of letting it re-tokenize the sentences")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Align and adjust chapters in this many processes")
+    parser.add_argument("--tsv", default="little_prince_ko.tsv",
+                        help="original annotations, optionally compressed (.gz, .xz, .bz2)")
+    parser.add_argument("--compress", choices=util.COMPRESSED_OPENERS, default="",
+                        help="compress the JSON artifacts, e.g. little_prince_merged.json.gz")
+    parser.add_argument("--select", nargs="+", metavar="ITEM",
+                        help="only process these chapters (3), sentences (lpp.ko03-005) or ranges "
+                             "(lpp.ko03-005:lpp.ko03-020), updating the artifacts of an earlier full run")
+    parser.add_argument("--select-file", help="file with one --select item per line, e.g. a list of sent_ids")
+    parser.add_argument("--lexicon", nargs="?", const="lexicon.npz",
+                        help="tag sentences of known tokens with this lexicon from lexicon.py build and only "
+                             "dependency-parse them")
+    args = parser.parse_args()
+    util.artifact_compression = args.compress
+    selection = util.Selection.from_arguments(args.select, args.select_file)
+
+    lexicon = None
+    if args.lexicon:
+        from lexicon import Lexicon
+        lexicon = Lexicon.load(args.lexicon)
+
+    original_annotations = read_original_annotation(args.tsv)
+    stanza_annotations = get_stanza_annotation(original_annotations, use_daemon=True, pretokenized=args.pretokenized,
+                                               selection=selection, lexicon=lexicon)
+
+    # with smart_open(artifact_path("little_prince_ko.json"), encoding='utf-8') as f:
     #     original_annotations = json.load(f)
-    # with open("little_prince_stanza.json", encoding='utf-8') as f:
+    # with smart_open(artifact_path("little_prince_stanza.json"), encoding='utf-8') as f:
     #     stanza_annotations = json.load(f)
 
-    merged_annotations = align_original_with_stanza(original_annotations, stanza_annotations)
-
-    # with open("little_prince_merged.json", encoding='utf-8') as f:
-    #     merged_annotations = json.load(f)
-    assert all([len(m_doc) == len(s_doc) for m_doc, s_doc in zip(merged_annotations, stanza_annotations)])
-
-    adjusted_annotations = adjust_token_boundaries(merged_annotations)
+    if args.workers > 1:
+        merged_annotations, adjusted_annotations, adjustment_errors = align_and_adjust(
+            original_annotations, stanza_annotations, pretokenized=args.pretokenized, workers=args.workers,
+            selection=selection)
+        assert all([len(m_doc) == len(s_doc) for m_doc, s_doc in zip(merged_annotations, stanza_annotations)])
+    else:
+        if args.pretokenized:
+            merged_annotations = align_pretokenized_with_stanza(original_annotations, stanza_annotations, selection)
+        else:
+            merged_annotations = align_original_with_stanza(original_annotations, stanza_annotations, selection)
+
+        # with smart_open(artifact_path("little_prince_merged.json"), encoding='utf-8') as f:
+        #     merged_annotations = json.load(f)
+        assert all([len(m_doc) == len(s_doc) for m_doc, s_doc in zip(merged_annotations, stanza_annotations)])
+
+        adjusted_annotations, adjustment_errors = adjust_token_boundaries(merged_annotations, selection)
+    print(f"Encountered {adjustment_errors['xpos_errors']} xpos_errors, {adjustment_errors['match_errors']} match_errors.")
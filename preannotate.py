@@ -0,0 +1,314 @@
+"""
+Adposition pre-annotation baseline.
+
+Proposes p, gold_scene and gold_function for new text, to be corrected by annotators instead of annotated from
+scratch. Every postposition morpheme (XPOS j*) of a word in a .conllu is a candidate; its form, from MSeg in MISC, is
+the candidate p. Two linear models, trained on the abstract ADP nodes of the gold .conllulex, label every candidate
+with a scene and a function, where "_" means the morpheme is not annotated as an adposition.
+
+Features are hashed into 2^18 dimensions: the candidate form and XPOS, the host word's form, lemma, UPOS, XPOS and
+deprel, its head, its neighbours, and conjunctions of the candidate with those. A batch of candidates is a matrix of
+feature indices, so scoring is one gather and sum over the weight matrix, and training is mini-batch AdaGrad on the
+softmax loss.
+
+Usage:
+    python3 preannotate.py train little_prince_ko.conllulex [--heldout 5]
+    python3 preannotate.py annotate new_text.conllu --out new_text.tsv
+The TSV has the layout of little_prince_ko.tsv, with the morphemes in its Sejong tags instead of the KAIST XPOS of
+the .conllu, and main.parse_tsv(path, keep_last_sentence=True) reads back every sentence.
+"""
+import argparse
+import csv
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from util import smart_open
+
+FEATURE_BITS = 18
+MODEL_PATH = "preannotate_model.npz"
+TSV_COLUMNS = ["doc_id", "sent_id", "token_id", "form", "morph", "p", "gold_scene", "gold_function"]
+# KAIST XPOS of the .conllu -> Sejong tag of the morph column of little_prince_ko.tsv
+SEJONG_TAGS = {
+    "ncn": "NNG", "ncpa": "NNG", "ncps": "NNG", "nq": "NNP", "nbn": "NNB", "nbu": "NNB", "npp": "NP", "npd": "NP",
+    "nnc": "NR", "nno": "NR", "pvg": "VV", "pvd": "VV", "paa": "VA", "pad": "VA", "px": "VX", "mag": "MAG",
+    "maj": "MAJ", "mma": "MM", "mmd": "MM", "ii": "IC", "jcs": "JKS", "jcc": "JKC", "jcm": "JKG", "jco": "JKO",
+    "jca": "JKB", "jct": "JKB", "jcv": "JKV", "jcr": "JKQ", "jcj": "JC", "jxt": "JX", "jxc": "JX", "jxf": "JX",
+    "jp": "VCP", "ep": "EP", "ef": "EF", "ecc": "EC", "ecs": "EC", "ecx": "EC", "etm": "ETM", "etn": "ETN",
+    "xp": "XPN", "xsn": "XSN", "xsv": "XSV", "xsm": "XSA",
+    "xsa": "XSN",  # adverb-deriving -히; Sejong has no tag of its own for it
+    "sf": "SF", "sp": "SP", "sl": "SS", "sr": "SS", "sd": "SO", "se": "SE", "su": "SW", "sy": "SW", "f": "SL",
+}
+
+
+def read_sentences(file_path):
+    """
+    :return: list of (sent_id, word rows, gold adpositions), where word rows are the columns of the integer id
+        tokens, and gold adpositions maps a word id to the (p, scene, function) of its abstract nodes, in order
+    """
+    sentences = []
+    sent_id, words, adps = None, [], {}
+    with smart_open(file_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("# sent_id = "):
+                sent_id = line[len("# sent_id = "):]
+            elif line.startswith("#"):
+                continue
+            elif line:
+                cols = line.split("\t")
+                if cols[0].isdigit():
+                    words.append(cols)
+                elif "." in cols[0]:
+                    misc = misc_dict(cols[9])
+                    p = misc.get("Adp_lemma", misc.get("Adp", cols[1]))
+                    adps.setdefault(cols[0].split(".")[0], []).append(
+                        (p, misc.get("Scene", "_"), misc.get("Funct", "_")))
+            elif words:
+                sentences.append((sent_id, words, adps))
+                sent_id, words, adps = None, [], {}
+    if words:
+        sentences.append((sent_id, words, adps))
+    return sentences
+
+
+def misc_dict(misc):
+    return dict(item.partition("=")[::2] for item in misc.split("|") if item != "_")
+
+
+def morphemes(word):
+    """
+    :return: (segment, XPOS) of every morpheme of a word row; segments are None if MSeg does not line up with XPOS
+    """
+    xposes = word[4].split("+")
+    mseg = misc_dict(word[9]).get("MSeg")
+    segments = mseg.split("-") if mseg else [word[1]]
+    if len(segments) != len(xposes):
+        segments = [None] * len(xposes)
+    return list(zip(segments, xposes))
+
+
+def candidates(word):
+    """
+    :return: (morpheme index, p, XPOS) of every postposition morpheme of a word row
+    """
+    return [(k, segment, xpos) for k, (segment, xpos) in enumerate(morphemes(word))
+            if xpos.startswith("j") and segment is not None]
+
+
+class FeatureHasher:
+    def __init__(self, bits=FEATURE_BITS):
+        self.mask = (1 << bits) - 1
+        self._cache = {}
+
+    def __call__(self, features):
+        indices = []
+        for feature in features:
+            index = self._cache.get(feature)
+            if index is None:
+                index = self._cache[feature] = zlib.crc32(feature.encode("utf-8")) & self.mask
+            indices.append(index)
+        return indices
+
+
+def candidate_features(words, i, k, p, xpos):
+    word = words[i]
+    word_morphemes = morphemes(word)
+    previous_xpos = word_morphemes[k - 1][1] if k > 0 else "^"
+    next_xpos = word_morphemes[k + 1][1] if k + 1 < len(word_morphemes) else "$"
+    lemma = word[2] if word[2] != "_" else (word_morphemes[0][0] or word[1])
+    head = words[int(word[6]) - 1] if word[6].isdigit() and 0 < int(word[6]) <= len(words) else None
+    head_lemma, head_upos = (head[2], head[3]) if head else ("ROOT", "ROOT")
+    before = words[i - 1] if i > 0 else ["", "<s>", "", "<s>", "<s>"]
+    after = words[i + 1] if i + 1 < len(words) else ["", "</s>", "", "</s>", "</s>"]
+    return ["bias", f"p={p}", f"px={xpos}", f"form={word[1]}", f"lemma={lemma}", f"upos={word[3]}",
+            f"xpos={word[4]}", f"deprel={word[7]}", f"prev_x={previous_xpos}", f"next_x={next_xpos}",
+            f"head_lemma={head_lemma}", f"head_upos={head_upos}", f"before={before[1]}", f"before_x={before[4]}",
+            f"after={after[1]}", f"after_x={after[4]}",
+            f"p+deprel={p}|{word[7]}", f"p+upos={p}|{word[3]}", f"p+lemma={p}|{lemma}",
+            f"p+prev_x={p}|{previous_xpos}", f"p+next_x={p}|{next_xpos}", f"p+head_upos={p}|{head_upos}",
+            f"p+head_lemma={p}|{head_lemma}", f"p+after_x={p}|{after[4]}"]
+
+
+def extract(sentences, hasher):
+    """
+    :return: feature index matrix, candidate (sentence, word, p) list, gold (scene, function) per candidate, and
+        the number of gold adpositions that no candidate covers
+    """
+    rows, instances, gold = [], [], []
+    uncovered = 0
+    for n, (_, words, adps) in enumerate(sentences):
+        for i, word in enumerate(words):
+            word_adps = list(adps.get(word[0], []))
+            for k, p, xpos in candidates(word):
+                rows.append(hasher(candidate_features(words, i, k, p, xpos)))
+                instances.append((n, i, p))
+                match = next((a for a in word_adps if a[0] == p), None)
+                if match is not None:
+                    word_adps.remove(match)
+                gold.append((match[1], match[2]) if match else ("_", "_"))
+            uncovered += len(word_adps)
+    X = np.array(rows, dtype=np.int32).reshape(len(rows), -1) if rows else np.zeros((0, 1), dtype=np.int32)
+    return X, instances, gold, uncovered
+
+
+class LinearModel:
+    """
+    Multinomial logistic regression over hashed features. X is an (instances, features) matrix of weight rows.
+    """
+    def __init__(self, labels, n_features=1 << FEATURE_BITS, weights=None):
+        self.labels = list(labels)
+        self.W = np.zeros((n_features, len(self.labels)), dtype=np.float32) if weights is None else weights
+
+    def scores(self, X):
+        return self.W[X].sum(axis=1)
+
+    def predict(self, X, batch_size=4096):
+        predictions = [self.scores(X[i:i + batch_size]).argmax(axis=1) for i in range(0, len(X), batch_size)]
+        codes = np.concatenate(predictions) if predictions else np.zeros(0, dtype=np.int64)
+        return [self.labels[code] for code in codes.tolist()]
+
+    def fit(self, X, y, epochs=15, batch_size=128, learning_rate=0.5, seed=0):
+        index = {label: n for n, label in enumerate(self.labels)}
+        targets = np.array([index[label] for label in y], dtype=np.int64)
+        history = np.full(self.W.shape, 1e-6, dtype=np.float32)  # AdaGrad sums of squared gradients
+        rng = np.random.default_rng(seed)
+        for _ in range(epochs):
+            order = rng.permutation(len(X))
+            for start in range(0, len(X), batch_size):
+                batch = order[start:start + batch_size]
+                scores = self.scores(X[batch])
+                probs = np.exp(scores - scores.max(axis=1, keepdims=True))
+                probs /= probs.sum(axis=1, keepdims=True)
+                probs[np.arange(len(batch)), targets[batch]] -= 1
+
+                rows, inverse = np.unique(X[batch].ravel(), return_inverse=True)
+                gradient = np.zeros((len(rows), len(self.labels)), dtype=np.float32)
+                np.add.at(gradient, inverse, np.repeat(probs, X.shape[1], axis=0) / len(batch))
+                history[rows] += gradient ** 2
+                self.W[rows] -= learning_rate * gradient / np.sqrt(history[rows])
+        return self
+
+
+def train(sentences, hasher):
+    X, _, gold, _ = extract(sentences, hasher)
+    scenes = [scene for scene, _ in gold]
+    functions = [function for _, function in gold]
+    scene_model = LinearModel(sorted(set(scenes))).fit(X, scenes)
+    function_model = LinearModel(sorted(set(functions))).fit(X, functions)
+    return scene_model, function_model
+
+
+def evaluate(scene_model, function_model, sentences, hasher):
+    """
+    :return: rows of (gold p, gold adpositions, found, scene correct, function correct, both correct), with a
+        total row first, and the number of candidates wrongly labelled as adpositions
+    """
+    X, instances, gold, uncovered = extract(sentences, hasher)
+    scenes, functions = scene_model.predict(X), function_model.predict(X)
+    counts = {}
+    false_positives = 0
+    for (_, _, p), (gold_scene, gold_function), scene, function in zip(instances, gold, scenes, functions):
+        if gold_scene == "_":
+            false_positives += scene != "_"
+            continue
+        found = scene != "_" and function != "_"
+        for key in ["total", p]:
+            c = counts.setdefault(key, Counter())
+            c["n"] += 1
+            c["found"] += found
+            c["scene"] += scene == gold_scene
+            c["function"] += function == gold_function
+            c["both"] += scene == gold_scene and function == gold_function
+    counts.setdefault("total", Counter())["n"] += uncovered
+    rows = [(p, c["n"], c["found"], c["scene"], c["function"], c["both"])
+            for p, c in sorted(counts.items(), key=lambda item: (item[0] != "total", -item[1]["n"]))]
+    return rows, false_positives
+
+
+def save_model(scene_model, function_model, file_path=MODEL_PATH):
+    np.savez(file_path, feature_bits=np.array([FEATURE_BITS]),
+             scene__W=scene_model.W, scene__labels=np.array(scene_model.labels),
+             function__W=function_model.W, function__labels=np.array(function_model.labels))
+
+
+def load_model(file_path=MODEL_PATH):
+    with np.load(file_path) as npz:
+        if int(npz["feature_bits"][0]) != FEATURE_BITS:
+            raise ValueError(f"{file_path} was trained with {int(npz['feature_bits'][0])} feature bits")
+        return [LinearModel(npz[f"{name}__labels"].tolist(), weights=npz[f"{name}__W"])
+                for name in ["scene", "function"]]
+
+
+def annotate(scene_model, function_model, sentences, hasher):
+    """
+    :return: TSV rows in the layout of little_prince_ko.tsv, with proposed p, gold_scene and gold_function, one doc_id
+        per chapter of sent_ids and sent_id numbered from 1 in each
+    """
+    X, instances, _, _ = extract(sentences, hasher)
+    predicted = {}
+    for (n, i, p), scene, function in zip(instances, scene_model.predict(X), function_model.predict(X)):
+        if scene != "_" and function != "_":
+            predicted.setdefault((n, i), []).append((p, scene, function))
+
+    rows = []
+    doc_id, sent_no, chapter = 0, 0, None
+    for n, (sent_id, words, _) in enumerate(sentences):
+        sent_chapter = sent_id.rsplit("-", 1)[0] if sent_id else None
+        if doc_id == 0 or sent_chapter != chapter:
+            doc_id, sent_no, chapter = doc_id + 1, 0, sent_chapter
+        sent_no += 1
+        for i, word in enumerate(words):
+            morph = " + ".join(f"{segment or word[1]}/{SEJONG_TAGS.get(xpos, xpos.upper())}"
+                               for segment, xpos in morphemes(word))
+            adps = predicted.get((n, i), [("_", "_", "_")])
+            for k, (p, scene, function) in enumerate(adps):
+                token_id = word[0] if len(adps) == 1 else f"{word[0]}-{k + 1}"
+                rows.append([doc_id, sent_no, token_id, word[1], morph, p, scene, function])
+    return rows
+
+
+def write_tsv(rows, file_path):
+    with open(file_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(TSV_COLUMNS)
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propose adpositions and SNACS labels for new text.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train_parser = subparsers.add_parser("train", help="train on a gold .conllulex and report held-out accuracy")
+    train_parser.add_argument("gold", nargs="?", default="little_prince_ko.conllulex")
+    train_parser.add_argument("--heldout", type=int, default=5, help="hold out every n-th sentence for evaluation")
+    train_parser.add_argument("--model", default=MODEL_PATH)
+    annotate_parser = subparsers.add_parser("annotate", help="pre-annotate a .conllu")
+    annotate_parser.add_argument("conllu")
+    annotate_parser.add_argument("--model", default=MODEL_PATH)
+    annotate_parser.add_argument("--out", required=True, help="TSV to write")
+    args = parser.parse_args()
+
+    feature_hasher = FeatureHasher()
+    if args.command == "train":
+        gold_sentences = read_sentences(args.gold)
+        train_sentences = [s for n, s in enumerate(gold_sentences) if n % args.heldout != args.heldout - 1]
+        heldout_sentences = [s for n, s in enumerate(gold_sentences) if n % args.heldout == args.heldout - 1]
+        start = time.perf_counter()
+        models = train(train_sentences, feature_hasher)
+        print(f"Trained on {len(train_sentences)} sentences in {time.perf_counter() - start:.1f}s")
+        report, n_false_positives = evaluate(*models, heldout_sentences, feature_hasher)
+        print(f"{'p':<8}{'n':>6}{'found':>8}{'scene':>8}{'funct':>8}{'both':>8}")
+        for p, n, found, scene, function, both in report:
+            print(f"{p:<8}{n:>6}{found / n:>8.3f}{scene / n:>8.3f}{function / n:>8.3f}{both / n:>8.3f}")
+        print(f"{n_false_positives} held-out morphemes wrongly proposed as adpositions")
+        save_model(*train(gold_sentences, feature_hasher), args.model)  # the saved model sees all gold data
+    else:
+        new_sentences = read_sentences(args.conllu)
+        start = time.perf_counter()
+        tsv_rows = annotate(*load_model(args.model), new_sentences, feature_hasher)
+        elapsed = time.perf_counter() - start
+        write_tsv(tsv_rows, args.out)
+        n_words = sum(len(words) for _, words, _ in new_sentences)
+        print(f"Pre-annotated {n_words} words in {elapsed:.2f}s ({n_words / elapsed:.0f} words/s)")
@@ -0,0 +1,142 @@
+"""
+Shared-memory corpus handoff for process pools.
+
+Giving each task of a process pool a chapter as nested lists of token dicts means pickling it to the worker and
+pickling the results back, which for a large corpus costs more than the per-sentence work itself. SharedCorpus
+instead copies the arrays of a ColumnarCorpus (string pools, categorical codes, offset tables) into one
+multiprocessing.shared_memory block, once. Workers attach to it by name and get zero-copy NumPy views, so a task is
+only a range of sentence numbers. Results are written into SharedArrays output buffers allocated by the parent.
+
+    with SharedCorpus(corpus) as shared, SharedArrays({"flags": np.zeros(corpus.n_tokens, np.uint8)}) as output:
+        shared.map_sentences(flag_tokens, output, workers=4)  # flag_tokens(corpus, start, stop, outputs) fills flags
+        flags = output.arrays["flags"].copy()
+
+python3 bench.py shm runs util.json2conllu(), the CoNLL-U conversion of the pipeline, both ways: with workers that
+are sent a pickled chapter of token dicts per task, and with bench.conllu_chapter() on map_sentences(), which builds
+the token dicts in the workers. With 20 copies of little_prince_ko.conllu and 2 workers on one core, shared memory
+halved the data pickled (43 MB, all of it the CoNLL-U sent back, against 92 MB) and took 4.85 s against 5.41 s,
+but serial conversion took 3.70 s: the per-sentence work has to be spread over more cores before a pool pays off.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from corpus_store import ColumnarCorpus
+
+ALIGNMENT = 64
+
+
+def _views(shm, layout):
+    return {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+            for name, dtype, shape, offset in layout}
+
+
+class SharedArrays:
+    """
+    NumPy arrays packed into one shared memory block. The block is freed when the SharedArrays that created it is
+    closed; a worker gets the same arrays from SharedArrays.attach(spec).
+    """
+    def __init__(self, arrays):
+        arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+        layout = []
+        size = 0
+        for name, array in arrays.items():
+            layout.append((name, array.dtype.str, array.shape, size))
+            size += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.spec = (self.shm.name, layout)
+        self.arrays = _views(self.shm, layout)
+        for name, array in arrays.items():
+            self.arrays[name][...] = array
+        self.owner = True
+
+    @classmethod
+    def attach(cls, spec):
+        """
+        :param spec: spec of a SharedArrays in another process
+        """
+        shared = cls.__new__(cls)
+        shared.shm = shared_memory.SharedMemory(name=spec[0])
+        shared.spec = spec
+        shared.arrays = _views(shared.shm, spec[1])
+        shared.owner = False
+        return shared
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    def close(self):
+        self.arrays = {}
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # views are still referenced elsewhere; the mapping goes away with them
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SharedCorpus(SharedArrays):
+    """
+    A ColumnarCorpus in shared memory, see the module docstring.
+    """
+    def __init__(self, corpus: ColumnarCorpus):
+        super().__init__(corpus.arrays)
+        self.corpus = ColumnarCorpus(self.arrays)
+
+    @classmethod
+    def attach(cls, spec):
+        shared = super().attach(spec)
+        shared.corpus = ColumnarCorpus(shared.arrays)
+        return shared
+
+    def close(self):
+        self.corpus = None
+        super().close()
+
+    def chapter_ranges(self):
+        offsets = self.corpus.chapter_offsets.tolist()
+        return list(zip(offsets[:-1], offsets[1:]))
+
+    def map_sentences(self, function, output=None, workers=1, ranges=None):
+        """
+        Run function(corpus, start, stop, outputs) on sentence ranges in a process pool. It reads sentences start to
+        stop of the ColumnarCorpus and writes its results into the dict of arrays outputs, at the rows of those
+        sentences.
+
+        :param function: module-level function, so that it can be sent to the workers
+        :param output: SharedArrays for the results, or None
+        :param workers: number of worker processes
+        :param ranges: (start, stop) sentence ranges, one per task; by default one chapter per task
+        :return: whatever function returned for each range, which should be small
+        """
+        ranges = self.chapter_ranges() if ranges is None else ranges
+        if not ranges:
+            return []
+        output_spec = None if output is None else output.spec
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker,
+                                 initargs=(self.spec, output_spec)) as executor:
+            return list(executor.map(_run_range, repeat(function), *zip(*ranges)))
+
+
+_worker_corpus = None
+_worker_output = None
+
+
+def _attach_worker(corpus_spec, output_spec):
+    global _worker_corpus, _worker_output
+    _worker_corpus = SharedCorpus.attach(corpus_spec)
+    _worker_output = None if output_spec is None else SharedArrays.attach(output_spec)
+
+
+def _run_range(function, start, stop):
+    outputs = {} if _worker_output is None else _worker_output.arrays
+    return function(_worker_corpus.corpus, start, stop, outputs)
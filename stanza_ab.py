@@ -0,0 +1,162 @@
+"""
+A/B comparison of two Stanza configurations, for checking Stanza and model upgrades.
+
+A configuration is a profile JSON as written by stanza_tune.py, a directory of Stanza models (passed to
+stanza.Pipeline as dir=), or "default". Both parse the same sentences of little_prince_ko.tsv with
+stanza_tune.run_trial(), at the same time if there are enough cores for both. The report has
+ * sentences/s, model load time and peak RSS of each configuration,
+ * agreement of B with A on tokenization, lemma, UPOS, XPOS, head and deprel,
+ * the mismatches, xpos_errors and match_errors (and fallback_sentences, if pretokenized) of aligning and adjusting
+   every sentence with main.align_and_adjust_chapter(), for each configuration.
+Each sentence is aligned on its own, so that its counts do not depend on how the sentences before it went.
+
+Every sentence where the parses or the error counts differ is written to --out as <sent_id>.json, with the parses,
+errors and mismatches of both configurations, next to report.json with the totals.
+
+Usage:
+    python3 stanza_ab.py A B [--sample 200] [--select ...] [--pretokenized] [--out stanza_ab]
+"""
+import argparse
+import json
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import util
+from main import align_and_adjust_chapter, read_original_annotation, sentence_inputs
+from stanza_tune import COMPARED_FIELDS, field_agreement, run_trial, sentence_matches
+
+ERROR_KINDS = ["mismatches", "xpos_errors", "match_errors", "fallback_sentences"]
+
+
+def load_configuration(name):
+    """
+    :param name: "default", a directory of Stanza models, or a profile JSON file
+    :return: profile, see main.load_stanza_profile()
+    """
+    if name == "default":
+        return {}
+    if os.path.isdir(name):
+        return {"pipeline": {"dir": name}}
+    with open(name, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def cores_needed(profile, n_cpus):
+    return profile.get("parallel_pipelines", 1) * (profile.get("torch_threads") or n_cpus)
+
+
+def sample_keys(og_book, n=200):
+    """
+    :return: (chapter, sentence) numbers of n sentences spread evenly over the book
+    """
+    keys = [(c, s) for c, chapter in enumerate(og_book) for s in range(len(chapter))]
+    step = max(1, len(keys) // n)
+    return keys[::step][:n]
+
+
+def downstream_errors(og_sent, parsed, pretokenized=False):
+    """
+    Align and adjust one sentence against its original annotation.
+
+    :param og_sent: sentence of the original annotations
+    :param parsed: Document.to_dict() of the sentence
+    :return: Counter of ERROR_KINDS, and the (og_token, stanza_token) mismatches
+    """
+    # the aligner adds the original annotation to the Stanza tokens, so give it a copy
+    stanza_sent = [token for sent in json.loads(json.dumps(parsed)) for token in sent]
+    try:
+        _, _, errors, mismatches = align_and_adjust_chapter([og_sent], [stanza_sent], pretokenized=pretokenized)
+    except AssertionError:  # an adposition that is not in the text of its token
+        return Counter(adjust_failures=1), []
+    return errors, [(og_token, stanza_token) for _, og_token, stanza_token in mismatches]
+
+
+def compare(og_book, keys, profile_a, profile_b, pretokenized=False, out_dir="stanza_ab"):
+    """
+    Parse the sentences keys of og_book with both configurations and compare, see the module docstring.
+
+    :param og_book: original annotations
+    :param keys: (chapter, sentence) numbers of the sentences to parse
+    :param profile_a: configuration A, see load_configuration()
+    :param profile_b: configuration B
+    :param pretokenized: feed KOMA tokens to Stanza instead of raw sentences
+    :param out_dir: directory for the per-sentence diffs and report.json
+    :return: the report
+    """
+    sentences = [sentence_inputs(og_book[c][s])[1 if pretokenized else 0] for c, s in keys]
+    n_cpus = os.cpu_count() or 1
+    workers = 2 if cores_needed(profile_a, n_cpus) + cores_needed(profile_b, n_cpus) <= n_cpus else 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        result_a, result_b = executor.map(lambda profile: run_trial(profile, sentences, pretokenized=pretokenized),
+                                          [profile_a, profile_b])
+
+    os.makedirs(out_dir, exist_ok=True)
+    totals = {"a": Counter(), "b": Counter()}
+    n_different = 0
+    for (c, s), parsed_a, parsed_b in zip(keys, result_a["parsed"], result_b["parsed"]):
+        errors_a, mismatches_a = downstream_errors(og_book[c][s], parsed_a, pretokenized=pretokenized)
+        errors_b, mismatches_b = downstream_errors(og_book[c][s], parsed_b, pretokenized=pretokenized)
+        totals["a"].update(errors_a)
+        totals["b"].update(errors_b)
+        if sentence_matches(parsed_a, parsed_b) and +errors_a == +errors_b:
+            continue
+        n_different += 1
+        sent_id = util.format_sent_id(c, s)
+        with open(os.path.join(out_dir, f"{sent_id}.json"), "w", encoding="utf-8") as f:
+            json.dump({"sent_id": sent_id, "text": sentence_inputs(og_book[c][s])[0],
+                       "a": {"parse": parsed_a, "errors": errors_a, "mismatches": mismatches_a},
+                       "b": {"parse": parsed_b, "errors": errors_b, "mismatches": mismatches_b}},
+                      f, ensure_ascii=False, indent=4)
+
+    agree, compared = field_agreement(result_a["parsed"], result_b["parsed"])
+    report = {
+        "sentences": len(keys),
+        "different_sentences": n_different,
+        "parallel": workers == 2,
+        "agreement": {field: agree[field] / compared[field] if compared[field] else None
+                      for field in COMPARED_FIELDS},
+        "a": {key: result_a[key] for key in ["sentences_per_second", "load_time", "peak_rss_mb"]},
+        "b": {key: result_b[key] for key in ["sentences_per_second", "load_time", "peak_rss_mb"]},
+    }
+    for side in ["a", "b"]:
+        report[side]["errors"] = {kind: totals[side][kind] for kind in ERROR_KINDS + ["adjust_failures"]}
+    with open(os.path.join(out_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two Stanza configurations or model directories.")
+    parser.add_argument("a", help='configuration A: "default", a Stanza model directory, or a stanza_profile.json')
+    parser.add_argument("b", help="configuration B")
+    parser.add_argument("--tsv", default="little_prince_ko.tsv", help="original annotations")
+    parser.add_argument("--sample", type=int, default=200, help="number of sentences to parse, spread over the book")
+    parser.add_argument("--select", nargs="+", metavar="ITEM",
+                        help="parse these chapters, sentences or ranges instead of a sample, as in main.py")
+    parser.add_argument("--select-file", help="file with one --select item per line")
+    parser.add_argument("--pretokenized", action="store_true", help="compare the pretokenized pipelines")
+    parser.add_argument("--out", default="stanza_ab", help="directory for the per-sentence diffs and report.json")
+    args = parser.parse_args()
+
+    original_annotations = read_original_annotation(args.tsv)
+    selection = util.Selection.from_arguments(args.select, args.select_file)
+    if selection is None:
+        sentence_keys = sample_keys(original_annotations, args.sample)
+    else:
+        sentence_keys = [(c, s) for c, numbers in selection.sentences(original_annotations).items() for s in numbers]
+
+    ab = compare(original_annotations, sentence_keys, load_configuration(args.a), load_configuration(args.b),
+                 pretokenized=args.pretokenized, out_dir=args.out)
+    print(f"{ab['sentences']} sentences, parsed {'in parallel' if ab['parallel'] else 'one after the other'}")
+    print(f"{'':<20}{'A':>10}{'B':>10}")
+    for key, label in [("sentences_per_second", "sentences/s"), ("load_time", "load time (s)"),
+                       ("peak_rss_mb", "peak RSS (MB)")]:
+        print(f"{label:<20}{ab['a'][key]:>10.1f}{ab['b'][key]:>10.1f}")
+    for kind in ab["a"]["errors"]:
+        print(f"{kind:<20}{ab['a']['errors'][kind]:>10}{ab['b']['errors'][kind]:>10}")
+    print("agreement of B with A:")
+    for field, agreement in ab["agreement"].items():
+        print(f"  {'tokenization' if field == 'text' else field:<18}" +
+              ("-" if agreement is None else f"{agreement:.3f}"))
+    print(f"{ab['different_sentences']} sentences differ; diffs written to {args.out}/")
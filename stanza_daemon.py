@@ -0,0 +1,273 @@
+"""
+Resident Stanza parsing daemon.
+
+Loading the Korean Stanza models dominates the run time of get_stanza_annotation() on the Little Prince, so this
+daemon keeps one pipeline loaded and serves parse requests over a local Unix domain socket.
+
+Every message, in either direction, is a 4-byte big-endian length followed by that many bytes of UTF-8 JSON:
+    {"op": "parse", "sentences": ["...", ...]}  ->  {"parsed": [<Document.to_dict()>, ...]}
+    {"op": "parse", "sentences": [["...", ...], ...], "pretokenized": true}  ->  same
+    {"op": "ping"}                              ->  {"ok": true}
+Failures, including parse requests whose sentences are not a list of strings (lists of strings if pretokenized), are
+answered with {"error": "..."}.
+
+Requests from concurrent clients are queued and parsed together in micro-batches by a single worker thread, which
+is the only thread that touches the pipeline.
+
+Usage:
+    python3 stanza_daemon.py [--socket /tmp/k-snacs-stanza.sock]
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+
+DEFAULT_SOCKET_PATH = "/tmp/k-snacs-stanza.sock"
+DEFAULT_TIMEOUT = 600.0  # seconds parse_with_daemon() waits for the parses of one request
+_HEADER = struct.Struct(">I")
+
+
+def send_message(sock, obj):
+    payload = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, n):
+    chunks = []
+    while n:
+        chunk = sock.recv(min(n, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a message")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock):
+    """
+    Read one length-prefixed JSON message.
+
+    :return: decoded message, or None if the peer closed the connection cleanly between messages
+    """
+    first = sock.recv(_HEADER.size)
+    if not first:
+        return None
+    header = first + _recv_exactly(sock, _HEADER.size - len(first))
+    (length,) = _HEADER.unpack(header)
+    return json.loads(_recv_exactly(sock, length).decode("utf-8"))
+
+
+class _ParseRequest:
+    def __init__(self, sentences, pretokenized):
+        self.sentences = sentences
+        self.pretokenized = pretokenized
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Funnels parse requests from all client threads into one worker.
+
+    The worker takes the oldest pending request, then keeps collecting requests for up to batch_window seconds or
+    until max_batch sentences are gathered, and hands them to parse(sentences, pretokenized) in one call per mode.
+    """
+    def __init__(self, parse, max_batch=64, batch_window=0.01):
+        self.parse = parse
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def submit(self, sentences, pretokenized=False):
+        request = _ParseRequest(sentences, pretokenized)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.result
+
+    def _next_batch(self, batch):
+        n_sentences = len(batch[0].sentences)
+        deadline = time.monotonic() + self.batch_window
+        while n_sentences < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            n_sentences += len(request.sentences)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                self._next_batch(batch)
+                for pretokenized in [False, True]:
+                    requests = [request for request in batch if request.pretokenized == pretokenized]
+                    if requests:
+                        self._parse_requests(requests, pretokenized)
+            except Exception as e:
+                # fail only this batch; the worker has to keep serving the requests after it
+                _fail([request for request in batch if not request.done.is_set()], e)
+
+    def _parse_requests(self, requests, pretokenized):
+        sentences = [sentence for request in requests for sentence in request.sentences]
+        try:
+            parsed = self.parse(sentences, pretokenized)
+        except Exception as e:
+            _fail(requests, e)
+            return
+
+        i = 0
+        for request in requests:
+            request.result = parsed[i:i + len(request.sentences)]
+            i += len(request.sentences)
+            request.done.set()
+
+
+def _fail(requests, e):
+    for request in requests:
+        request.error = f"{type(e).__name__}: {e}"
+        request.done.set()
+
+
+def invalid_sentences(sentences, pretokenized=False):
+    """
+    :return: why sentences cannot be parsed, or None if they are a list of strings (lists of strings if pretokenized)
+    """
+    if not isinstance(sentences, list):
+        return f"sentences must be a list, not {type(sentences).__name__}"
+    for sentence in sentences:
+        if pretokenized:
+            if not isinstance(sentence, list) or not all(isinstance(token, str) for token in sentence):
+                return "pretokenized sentences must be lists of strings"
+        elif not isinstance(sentence, str):
+            return "sentences must be strings"
+    return None
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except (ConnectionError, ValueError):
+                return
+            if message is None:
+                return
+
+            op = message.get("op", "parse")
+            if op == "ping":
+                send_message(self.request, {"ok": True})
+            elif op == "parse":
+                pretokenized = bool(message.get("pretokenized"))
+                error = invalid_sentences(message.get("sentences"), pretokenized)
+                if error is not None:
+                    send_message(self.request, {"error": error})
+                    continue
+                try:
+                    parsed = self.server.batcher.submit(message["sentences"], pretokenized)
+                    send_message(self.request, {"parsed": parsed})
+                except RuntimeError as e:
+                    send_message(self.request, {"error": str(e)})
+            else:
+                send_message(self.request, {"error": f"Unknown op {op!r}"})
+
+
+class StanzaDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher):
+        self.batcher = batcher
+        super().__init__(socket_path, _ConnectionHandler)
+
+
+def _connect(socket_path, timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def daemon_is_running(socket_path=DEFAULT_SOCKET_PATH):
+    try:
+        with _connect(socket_path, timeout=1.0) as sock:
+            send_message(sock, {"op": "ping"})
+            response = recv_message(sock)
+    except (OSError, ValueError):
+        return False
+    return bool(response and response.get("ok"))
+
+
+def parse_with_daemon(sentences, socket_path=DEFAULT_SOCKET_PATH, pretokenized=False, timeout=DEFAULT_TIMEOUT):
+    """
+    Parse sentences with a running daemon.
+
+    :param sentences: list of sentence strings, or lists of tokens if pretokenized
+    :param socket_path: daemon socket
+    :param pretokenized: whether sentences are already tokenized
+    :param timeout: seconds to wait for the daemon before raising socket.timeout, an OSError
+    :return: one Document.to_dict() per sentence, as returned by main.parse_sentences()
+    """
+    with _connect(socket_path, timeout=timeout) as sock:
+        send_message(sock, {"op": "parse", "sentences": sentences, "pretokenized": pretokenized})
+        response = recv_message(sock)
+    if response is None:
+        raise ConnectionError("Stanza daemon closed the connection without answering")
+    if "error" in response:
+        raise RuntimeError(response["error"])
+    return response["parsed"]
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, max_batch=64, batch_window=0.01):
+    if os.path.exists(socket_path):
+        if daemon_is_running(socket_path):
+            raise RuntimeError(f"A Stanza daemon is already listening on {socket_path}")
+        os.unlink(socket_path)  # stale socket left behind by a killed daemon
+
+    from main import build_stanza_pipeline, parse_sentences
+
+    start = time.perf_counter()
+    pipelines = {False: build_stanza_pipeline()}
+    print(f"Loaded Stanza pipeline in {time.perf_counter() - start:.1f}s, listening on {socket_path}")
+
+    def parse(sentences, pretokenized):
+        # the pretokenized pipeline is only loaded once somebody asks for it
+        if pretokenized not in pipelines:
+            pipelines[pretokenized] = build_stanza_pipeline(pretokenized=pretokenized)
+        return parse_sentences(pipelines[pretokenized], sentences, pretokenized=pretokenized)
+
+    server = StanzaDaemon(socket_path, MicroBatcher(parse, max_batch=max_batch, batch_window=batch_window))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep a Korean Stanza pipeline loaded and serve parse requests.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Unix domain socket path")
+    parser.add_argument("--max-batch", type=int, default=64, help="Most sentences parsed in one micro-batch")
+    parser.add_argument("--batch-window", type=float, default=0.01,
+                        help="Seconds to wait for more requests before parsing a micro-batch")
+    args = parser.parse_args()
+    serve(args.socket, max_batch=args.max_batch, batch_window=args.batch_window)
@@ -0,0 +1,172 @@
+"""
+CPU autotuner for the Stanza pipeline of get_stanza_annotation().
+
+Parses a sample of little_prince_raw_sentences.json under a grid of configurations:
+ * torch_threads: torch.set_num_threads() in every pipeline process,
+ * pipeline: per-processor batch sizes passed to stanza.Pipeline (pos_batch_size, depparse_batch_size, ...),
+ * parallel_pipelines: how many pipelines parse disjoint parts of the input in separate processes.
+The first trial runs Stanza's defaults and is the reference the other outputs are checked against.
+
+Every trial runs in freshly spawned processes, so that thread settings do not leak between trials and the peak RSS
+of each process can be read from getrusage(). The fastest configuration that reproduces the reference parses is
+written to stanza_profile.json, which build_stanza_pipeline() and get_stanza_annotation() load automatically.
+
+Usage:
+    python3 stanza_tune.py [--sample 200] [--threads 1 2 4] [--batch-sizes 1000 3000 5000] [--pipelines 1 2]
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from main import STANZA_PROFILE_PATH, build_stanza_pipeline, parse_sentences, split_punctuation
+
+COMPARED_FIELDS = ["text", "lemma", "upos", "xpos", "head", "deprel"]
+
+
+def sample_sentences(file_path="little_prince_raw_sentences.json", n=200):
+    """
+    :return: n sentences spread evenly over the book
+    """
+    with open(file_path, encoding="utf-8") as f:
+        sentences = [sentence for chapter in json.load(f) for sentence in chapter]
+    step = max(1, len(sentences) // n)
+    return sentences[::step][:n]
+
+
+def _run_chunk(profile, sentences, pretokenized):
+    start = time.perf_counter()
+    nlp = build_stanza_pipeline(pretokenized=pretokenized, profile=profile)
+    loaded = time.perf_counter()
+    parsed = parse_sentences(nlp, sentences, pretokenized=pretokenized)
+    done = time.perf_counter()
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+    return parsed, loaded - start, done - loaded, peak_rss_mb
+
+
+def run_trial(profile, sentences, pretokenized=False):
+    """
+    Parse sentences with the configuration in profile, in parallel_pipelines fresh processes.
+
+    :param profile: pipeline configuration, see main.load_stanza_profile()
+    :param sentences: sentence strings, or lists of tokens if pretokenized
+    :param pretokenized: whether sentences are already tokenized
+    :return: dict with the parses, load_time (seconds), sentences_per_second (excluding model loading) and
+        peak_rss_mb (summed over the pipeline processes)
+    """
+    n_pipelines = profile.get("parallel_pipelines", 1)
+    size = -(-len(sentences) // n_pipelines)
+    chunks = [sentences[i:i + size] for i in range(0, len(sentences), size)]
+    with ProcessPoolExecutor(max_workers=len(chunks), mp_context=multiprocessing.get_context("spawn")) as executor:
+        results = list(executor.map(_run_chunk, itertools.repeat(profile), chunks, itertools.repeat(pretokenized)))
+
+    parse_time = max(result[2] for result in results)  # the chunks are parsed at the same time
+    return {
+        "parsed": [parsed for result in results for parsed in result[0]],
+        "load_time": max(result[1] for result in results),
+        "sentences_per_second": len(sentences) / parse_time if parse_time else float("inf"),
+        "peak_rss_mb": sum(result[3] for result in results),
+    }
+
+
+def sentence_matches(reference, parsed):
+    """
+    :param reference: Document.to_dict() of a sentence
+    :param parsed: Document.to_dict() of the same sentence
+    :return: whether tokenization and all annotations agree
+    """
+    ref_tokens = [token for sent in reference for token in sent]
+    tokens = [token for sent in parsed for token in sent]
+    return len(ref_tokens) == len(tokens) and all(
+        ref_token.get(field) == token.get(field)
+        for ref_token, token in zip(ref_tokens, tokens) for field in COMPARED_FIELDS)
+
+
+def field_agreement(references, parses):
+    """
+    :param references: Document.to_dict() of every sentence
+    :param parses: Document.to_dict() of the same sentences from another pipeline
+    :return: Counters of agreeing and of compared items per field of COMPARED_FIELDS. For "text" these are sentences
+        (tokenized the same way or not), for the other fields the tokens of the sentences that are tokenized the same.
+    """
+    agree, compared = Counter(), Counter()
+    for reference, parsed in zip(references, parses):
+        ref_tokens = [token for sent in reference for token in sent]
+        tokens = [token for sent in parsed for token in sent]
+        compared["text"] += 1
+        if [token["text"] for token in ref_tokens] != [token["text"] for token in tokens]:
+            continue
+        agree["text"] += 1
+        for field in COMPARED_FIELDS[1:]:
+            agree[field] += sum(ref_token.get(field) == token.get(field) for ref_token, token in zip(ref_tokens, tokens))
+            compared[field] += len(tokens)
+    return agree, compared
+
+
+def configuration_grid(threads, batch_sizes, pipelines, n_cpus):
+    """
+    Yields profiles for all combinations that do not ask for more threads than there are CPUs.
+    """
+    for n_threads, batch_size, n_pipelines in itertools.product(threads, batch_sizes, pipelines):
+        if n_threads * n_pipelines > n_cpus:
+            continue
+        yield {"torch_threads": n_threads,
+               "pipeline": {"pos_batch_size": batch_size, "depparse_batch_size": batch_size},
+               "parallel_pipelines": n_pipelines}
+
+
+def autotune(sentences, grid, pretokenized=False):
+    """
+    :return: the fastest profile whose parses match the default configuration, its trial result, and
+        (profile, result, number of matching sentences) of all trials
+    """
+    print(f"Parsing {len(sentences)} sentences with the default configuration")
+    reference = run_trial({}, sentences, pretokenized=pretokenized)
+    trials = [({}, reference, len(sentences))]
+    print(f"default: {reference['sentences_per_second']:.1f} sentences/s, {reference['peak_rss_mb']:.0f} MB, "
+          f"loaded in {reference['load_time']:.1f}s")
+
+    for profile in grid:
+        result = run_trial(profile, sentences, pretokenized=pretokenized)
+        n_matching = sum(sentence_matches(ref, parsed) for ref, parsed in zip(reference["parsed"], result["parsed"]))
+        trials.append((profile, result, n_matching))
+        print(f"threads={profile['torch_threads']} batch={profile['pipeline']['pos_batch_size']} "
+              f"pipelines={profile['parallel_pipelines']}: {result['sentences_per_second']:.1f} sentences/s, "
+              f"{result['peak_rss_mb']:.0f} MB, {n_matching}/{len(sentences)} sentences match")
+
+    valid = [trial for trial in trials if trial[2] == len(sentences)]
+    best_profile, best_result, _ = max(valid, key=lambda trial: trial[1]["sentences_per_second"])
+    return best_profile, best_result, trials
+
+
+if __name__ == "__main__":
+    n_cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Pick Stanza thread counts, batch sizes and parallel pipelines.")
+    parser.add_argument("--sample", type=int, default=200, help="number of sentences to parse per configuration")
+    parser.add_argument("--threads", type=int, nargs="+",
+                        default=sorted({2 ** i for i in range(n_cpus.bit_length()) if 2 ** i <= n_cpus}))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1000, 3000, 5000],
+                        help="values tried for pos_batch_size and depparse_batch_size")
+    parser.add_argument("--pipelines", type=int, nargs="+", default=[1, 2] if n_cpus > 1 else [1])
+    parser.add_argument("--pretokenized", action="store_true", help="tune the pretokenized pipeline")
+    parser.add_argument("--out", default=STANZA_PROFILE_PATH, help="profile file to write")
+    args = parser.parse_args()
+
+    sample = sample_sentences(n=args.sample)
+    if args.pretokenized:
+        sample = [[piece for word in sentence.split() for piece in split_punctuation(word)] for sentence in sample]
+    best, best_result, _ = autotune(sample, configuration_grid(args.threads, args.batch_sizes, args.pipelines, n_cpus),
+                                    pretokenized=args.pretokenized)
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump({**best,
+                   "sentences_per_second": round(best_result["sentences_per_second"], 2),
+                   "peak_rss_mb": round(best_result["peak_rss_mb"], 1),
+                   "sample_size": len(sample),
+                   "cpus": n_cpus}, f, indent=4)
+    print(f"Wrote {args.out}: {json.dumps(best)}")
@@ -0,0 +1,108 @@
+"""
+Checks that main.adjust_sentence() adjusts the sentences of the corpus exactly as the two passes over the book it
+replaced did. The Stanza input is rebuilt from little_prince_ko.conllu, with its ellipses split into "." tokens as
+Stanza splits them.
+
+Usage:
+    python3 -m pytest test_adjust.py
+"""
+import json
+from collections import Counter
+
+from corpus_store import misc_value, read_conllu_sentences
+from main import align_chapter, adjust_sentence, create_adposition_abstract_node, parse_tsv
+
+
+def stanza_book_from_conllu(file_path="little_prince_ko.conllu"):
+    """
+    :return: the words of file_path as Stanza annotations in JSON format, one list of sentences per chapter
+    """
+    chapters = {}
+    for comments, lines, _ in read_conllu_sentences(file_path):
+        header = dict(comment[2:].split(" = ", 1) for comment in comments)
+        rows = [line.split("\t") for line in lines if "." not in line.split("\t", 1)[0]]
+        new_id, pieces = {}, []
+        for row in rows:
+            new_id[row[0]] = len(pieces) + 1
+            pieces += [(row, text) for text in (row[1] if set(row[1]) == {"."} else [row[1]])]
+        sentence, end = [], 0
+        for n, (row, text) in enumerate(pieces):
+            start = header["text"].index(text, end)
+            end = start + len(text)
+            lemma = (misc_value(row[9], "MSeg") or row[2]).replace("-", "+")
+            sentence.append({"id": n + 1, "text": text, "lemma": lemma, "upos": row[3], "xpos": row[4],
+                             "head": 0 if row[6] == "0" else new_id[row[6]], "deprel": row[7],
+                             "start_char": start, "end_char": end})
+        chapters.setdefault(header["sent_id"].rsplit("-", 1)[0], []).append(sentence)
+    return list(chapters.values())
+
+
+def merged_book():
+    return [align_chapter(og_chapter, stanza_chapter, mismatches=[])
+            for og_chapter, stanza_chapter in zip(parse_tsv("little_prince_ko.tsv"), stanza_book_from_conllu())]
+
+
+def two_pass_adjust(sentence):
+    """
+    adjust_token_boundaries() before adjust_sentence(), for one sentence.
+    """
+    i = 0
+    new_index = 1
+    id2nid = {}
+    joined = []
+    while i < len(sentence):
+        if sentence[i]["text"] == "." and i < len(sentence) - 1:
+            j = 1
+            while i + j < len(sentence) and sentence[i + j]["text"] == ".":
+                j += 1
+            joined.append({
+                "token_id": sentence[i]["token_id"], "form": sentence[i]["form"], "morph": sentence[i]["morph"],
+                "p": "_", "gold_scene": "_", "gold_function": "_", "id": new_index,
+                "text": "".join([p["text"] for p in sentence[i:i + j]]),
+                "lemma": "".join([p["lemma"] for p in sentence[i:i + j]]),
+                "upos": "PUNCT", "xpos": "sf", "head": sentence[i]["head"], "deprel": sentence[i]["deprel"],
+                "start_char": sentence[i]["start_char"], "end_char": sentence[i + j - 1]["end_char"]})
+            id2nid[sentence[i]["id"]] = new_index
+            i += j
+            new_index += 1
+        elif "-2" in sentence[i]["token_id"] or "-3" in sentence[i]["token_id"]:
+            joined.append({**sentence[i], "id": new_index})
+            id2nid[sentence[i]["id"]] = new_index
+            i += 1
+        else:
+            joined.append({**sentence[i], "id": new_index})
+            id2nid[sentence[i]["id"]] = new_index
+            i += 1
+            new_index += 1
+    for token in joined:
+        if token["head"] != 0:
+            token["head"] = id2nid[token["head"]]
+
+    adjusted = []
+    errors = Counter(xpos_errors=0, match_errors=0)
+    for token in joined:
+        if "-" not in token["token_id"] or "-1" in token["token_id"]:
+            full_token = json.loads(json.dumps(token))
+            full_token.update(p="_", gold_scene="_", gold_function="_")
+            del full_token["form"], full_token["morph"], full_token["token_id"]
+            adjusted.append(full_token)
+            if token["p"] != "_" and token["upos"] not in ["PUNCT"]:
+                p_node, match_errors, xpos_errors = create_adposition_abstract_node(token, 1)
+                errors.update(match_errors=match_errors, xpos_errors=xpos_errors)
+                adjusted.append(p_node)
+        else:
+            adjusted.append(create_adposition_abstract_node(token, int(token["token_id"][-1]))[0])
+    return adjusted, errors
+
+
+def test_matches_two_passes():
+    sentences = [sentence for chapter in merged_book() for sentence in chapter]
+    assert any(a["text"] == b["text"] == "." for sentence in sentences for a, b in zip(sentence, sentence[1:]))
+    assert any(token["token_id"].endswith("-2") for sentence in sentences for token in sentence)
+    for sentence in sentences:
+        before = json.dumps(sentence, ensure_ascii=False)
+        adjusted, errors = adjust_sentence(sentence)
+        assert json.dumps(sentence, ensure_ascii=False) == before  # the merged sentence is left as it was
+        expected, expected_errors = two_pass_adjust(json.loads(before))
+        assert json.dumps(adjusted, ensure_ascii=False) == json.dumps(expected, ensure_ascii=False)
+        assert errors == expected_errors
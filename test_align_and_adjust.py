@@ -0,0 +1,41 @@
+"""
+Checks that main.align_and_adjust() gives the same merged and adjusted books and artifacts with a process pool as
+the aligner followed by adjust_token_boundaries(), on Stanza annotations rebuilt from little_prince_ko.conllu.
+
+Usage:
+    python3 -m pytest test_align_and_adjust.py
+"""
+import pytest
+
+from main import (adjust_token_boundaries, align_and_adjust, align_original_with_stanza,
+                  align_pretokenized_with_stanza, parse_tsv)
+from test_adjust import stanza_book_from_conllu
+
+ARTIFACTS = ["little_prince_merged.json", "little_prince_annotation_ready.json"]
+
+
+def read_artifacts():
+    contents = []
+    for file_name in ARTIFACTS:
+        with open(file_name, "rb") as f:
+            contents.append(f.read())
+    return contents
+
+
+@pytest.mark.parametrize("pretokenized", [False, True])
+def test_workers_match_serial(tmp_path, monkeypatch, pretokenized):
+    og_book = parse_tsv("little_prince_ko.tsv")
+    stanza_book = stanza_book_from_conllu()
+    monkeypatch.chdir(tmp_path)
+
+    aligner = align_pretokenized_with_stanza if pretokenized else align_original_with_stanza
+    merged_book = aligner(og_book, stanza_book)
+    adjusted_doc, adjust_errors = adjust_token_boundaries(merged_book)
+    serial = read_artifacts()
+
+    for workers in [1, 3]:
+        merged, adjusted, errors = align_and_adjust(og_book, stanza_book, pretokenized=pretokenized, workers=workers)
+        assert merged == merged_book
+        assert adjusted == adjusted_doc
+        assert {key: errors[key] for key in adjust_errors} == adjust_errors
+        assert read_artifacts() == serial
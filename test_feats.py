@@ -0,0 +1,81 @@
+"""
+Checks that util.FeatsRuleEngine gives the FEATS of the if/elif chains it replaced, on the tokens of the corpus and on
+tokens that mix their UPOS, XPOS and lemmas.
+
+Usage:
+    python3 -m pytest test_feats.py
+"""
+import random
+
+from corpus_store import misc_value
+from test import TokenObject
+from util import FeatsRuleEngine, conllu2json
+
+
+def chain_features(t):
+    """
+    The FEATS chains of syntactic_features() before the rule table.
+    """
+    feats = []
+    if type(t.id) == int and t.upos not in ["ADP", "CCONJ", "NUM", "AUX", "ADV"]:
+        if "jxt" in t.xpos or "jcs" in t.xpos:
+            feats.append("Case=Nom")
+    if type(t.id) == int and t.upos not in ["ADP", "CCONJ", "NUM", "ADV"]:
+        if "jco" in t.xpos:
+            feats.append("Case=Acc")
+        elif "jcm" in t.xpos:
+            feats.append("Case=Gen")
+    if t.upos == "VERB":
+        inflected_lemma = "+".join(t.lemma[1:])
+        if "라" in inflected_lemma:
+            feats.append("Mood=Imp")
+            feats.append("VerbForm=Fin")
+        elif "다" in inflected_lemma:
+            feats.append("Mood=Ind")
+            feats.append("VerbForm=Fin")
+        if "ㅆ" in inflected_lemma:
+            feats.append("Tense=Past")
+        elif "ㄹ" in inflected_lemma:
+            feats.append("Tense=Fut")
+        if "ㅁ" in t.lemma:
+            feats.append("VerbForm=Ger")
+    return "|".join(sorted(feats)) if feats else "_"
+
+
+def corpus_tokens():
+    """
+    :return: token dicts of the corpus, with the lemma split into morphemes as in the annotation JSON
+    """
+    tokens = [token for chapter in conllu2json("little_prince_ko.conllu") for sent in chapter for token in sent]
+    for token in tokens:
+        mseg = misc_value(token["misc"], "MSeg")
+        if mseg:
+            token["lemma"] = mseg.replace("-", "+")
+    return tokens
+
+
+def assert_same_feats(tokens):
+    engine = FeatsRuleEngine()
+    for token in tokens:
+        assert engine(TokenObject(dict(token))).feats == chain_features(TokenObject(dict(token))), token
+    return engine.hits
+
+
+def test_corpus():
+    hits = assert_same_feats(corpus_tokens())
+    assert hits["Case=Nom"] > 0 and hits["Case=Acc"] > 0 and hits["Mood=Ind"] > 0 and hits["Tense=Past"] > 0
+
+
+def test_mixed_tokens():
+    tokens = corpus_tokens()
+    rng = random.Random(0)
+    upos = sorted({token["upos"] for token in tokens})
+    variants = []
+    for _ in range(20000):
+        token = dict(rng.choice(tokens))
+        token.update(upos=rng.choice(upos), xpos=rng.choice(tokens)["xpos"], lemma=rng.choice(tokens)["lemma"])
+        if rng.random() < 0.1:
+            token["id"] = f"{token['id']}.1"
+        variants.append(token)
+    hits = assert_same_feats(variants)
+    assert all(hits.values()), hits
@@ -0,0 +1,38 @@
+"""
+Checks that util.json2conllu() writes the same CoNLL-U file with a process pool as serially.
+
+Usage:
+    python3 -m pytest test_json2conllu.py
+"""
+import gzip
+import os
+import tempfile
+
+from util import conllu2json, json2conllu
+
+
+def test_parallel_matches_serial():
+    book = conllu2json("little_prince_ko.conllu")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        outputs = []
+        for workers, file_name in [(1, "serial.conllu"), (3, "parallel.conllu"), (2, "parallel.conllu.gz")]:
+            file_path = os.path.join(tmp_dir, file_name)
+            json2conllu(book, file_path, workers=workers)
+            with (gzip.open if file_name.endswith(".gz") else open)(file_path, "rb") as f:
+                outputs.append(f.read())
+    assert outputs[0].count(b"# sent_id = ") == sum(len(chapter) for chapter in book)
+    assert outputs[0] == outputs[1] == outputs[2]
+
+
+def test_empty_chapters():
+    book = conllu2json("little_prince_ko.conllu")[:3]
+    book.insert(1, [])
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        outputs = []
+        for workers in [1, 2]:
+            file_path = os.path.join(tmp_dir, f"{workers}.conllu")
+            json2conllu(book, file_path, workers=workers)
+            with open(file_path, "rb") as f:
+                outputs.append(f.read())
+    assert outputs[0] == outputs[1]
+    assert b"# sent_id = lpp.ko02-" not in outputs[0]
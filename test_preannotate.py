@@ -0,0 +1,44 @@
+"""
+Checks that the TSV written by preannotate.py annotate reads back with main.parse_tsv() as the sentences it was made
+from, in the tags of little_prince_ko.tsv.
+
+Usage:
+    python3 -m pytest test_preannotate.py
+"""
+import os
+import tempfile
+
+from main import parse_tsv
+from preannotate import FeatureHasher, annotate, read_sentences, train, write_tsv
+
+
+def test_annotate_round_trip():
+    sentences = read_sentences("little_prince_ko.conllulex")
+    hasher = FeatureHasher()
+    models = train(sentences[:100], hasher)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tsv_path = os.path.join(tmp_dir, "annotated.tsv")
+        write_tsv(annotate(*models, sentences, hasher), tsv_path)
+        docs = parse_tsv(tsv_path, keep_last_sentence=True)
+
+    read_back = [sent for doc in docs for sent in doc]
+    assert len(read_back) == len(sentences)
+    assert len(docs) == len({sent_id.rsplit("-", 1)[0] for sent_id, _, _ in sentences})
+    for (_, words, _), sent in zip(sentences, read_back):
+        # a word with several proposed adpositions has one row per adposition, with token ids <id>-1, <id>-2, ...
+        assert [word[1] for word in words] == [token["form"] for token in sent
+                                               if "-" not in token["token_id"] or token["token_id"].endswith("-1")]
+
+
+def test_annotate_uses_tsv_tags():
+    tsv_tags = set()
+    for doc in parse_tsv("little_prince_ko.tsv"):
+        for sent in doc:
+            for token in sent:
+                tsv_tags.update(morpheme.rsplit("/", 1)[-1].strip('"') for morpheme in token["morph"].split(" + "))
+
+    sentences = read_sentences("little_prince_ko.conllulex")
+    hasher = FeatureHasher()
+    rows = annotate(*train(sentences[:100], hasher), sentences, hasher)
+    annotated_tags = {morpheme.rsplit("/", 1)[-1] for row in rows for morpheme in row[4].split(" + ")}
+    assert annotated_tags <= tsv_tags, annotated_tags - tsv_tags
@@ -0,0 +1,56 @@
+"""
+Checks of the pretokenized Stanza mode that need no Stanza models: the tokens it feeds Stanza must come back with
+the same sentence text, character offsets and xpos_error_fix corrections as those of the Stanza tokenizer.
+
+Usage:
+    python3 -m pytest test_pretokenized.py
+"""
+from main import (is_stacked_duplicate, parse_tsv, restore_pretokenized_spacing, sentence_inputs,
+                  split_punctuation)
+from util import Romanizer, sentence2conllu, xpos_error_fix
+
+
+def sentences_with_attached_punctuation():
+    return [og_sent for doc in parse_tsv("little_prince_ko.tsv") for og_sent in doc
+            if any(len(split_punctuation(og_token["form"])) > 1 for og_token in og_sent
+                   if not is_stacked_duplicate(og_token))]
+
+
+def parsed_tokens(texts):
+    return [{"id": i + 1, "text": text, "lemma": text, "upos": "X", "xpos": "x", "head": 0 if i == 0 else 1,
+             "deprel": "root" if i == 0 else "dep"} for i, text in enumerate(texts)]
+
+
+def tokenized_from_raw(raw_text, texts):
+    """
+    :return: tokens as the Stanza tokenizer gives them for raw_text, with offsets and SpaceAfter=No
+    """
+    tokens = parsed_tokens(texts)
+    end = 0
+    for token in tokens:
+        start = raw_text.index(token["text"], end)
+        end = start + len(token["text"])
+        token.update({"start_char": start, "end_char": end})
+        if end < len(raw_text) and raw_text[end] != " ":
+            token["misc"] = "SpaceAfter=No"
+    return tokens
+
+
+def test_text_matches_raw_mode():
+    og_sents = sentences_with_attached_punctuation()
+    assert og_sents
+    r = Romanizer()
+    for og_sent in og_sents:
+        raw_text, texts = sentence_inputs(og_sent)
+        raw_mode = tokenized_from_raw(raw_text, texts)
+        pretokenized_mode = parsed_tokens(texts)
+        restore_pretokenized_spacing(og_sent, pretokenized_mode)
+        assert sentence2conllu(pretokenized_mode, r)[0] == sentence2conllu(raw_mode, r)[0] == raw_text
+        assert [(t["start_char"], t["end_char"], t.get("misc")) for t in pretokenized_mode] == \
+               [(t["start_char"], t["end_char"], t.get("misc")) for t in raw_mode]
+
+
+def test_xpos_error_fix_covers_split_forms():
+    for form in xpos_error_fix:
+        for piece in split_punctuation(form):
+            assert piece in xpos_error_fix, (form, piece)
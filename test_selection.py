@@ -0,0 +1,100 @@
+"""
+Checks of util.Selection, and that a run on selected sentences updates the artifacts of a full run to what a full
+run on the new input writes.
+
+Usage:
+    python3 -m pytest test_selection.py
+"""
+import copy
+
+import pytest
+
+from main import align_and_adjust, parse_tsv
+from test_adjust import stanza_book_from_conllu
+from util import Selection, conllu2json, format_sent_id, generate_col19, json2conllu, parse_sent_id
+
+ITEMS = ["2", "lpp.ko03-005", "lpp.ko04-010:lpp.ko04-012"]
+
+
+def test_selection_items(tmp_path):
+    selection = Selection(ITEMS)
+    assert (1, 0) in selection and (1, 61) in selection
+    assert (2, 4) in selection and (2, 3) not in selection and (2, 5) not in selection
+    assert [(3, s) in selection for s in range(8, 13)] == [False, True, True, True, False]
+    assert selection.sentences([[None] * 5] * 4) == {1: [0, 1, 2, 3, 4], 2: [4]}
+    assert parse_sent_id(format_sent_id(3, 11)) == (3, 11)
+    with pytest.raises(ValueError):
+        Selection(["lpp.ko3"])
+
+    selection_file = tmp_path / "selection.txt"
+    selection_file.write_text("# chapters and sentences\n" + "\n".join(ITEMS[1:]) + "\n", encoding="utf-8")
+    from_file = Selection.from_arguments(ITEMS[:1], str(selection_file))
+    assert from_file.ranges == selection.ranges
+    assert Selection.from_arguments() is None
+
+
+def edit(book, selection, token_key, value):
+    """
+    :return: copy of book with token_key set to value in every token of the selected sentences
+    """
+    book = copy.deepcopy(book)
+    for c, sentence_numbers in selection.sentences(book).items():
+        for s in sentence_numbers:
+            for token in book[c][s]:
+                token[token_key] = value
+    return book
+
+
+def read(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+
+def test_json2conllu(tmp_path):
+    selection = Selection(ITEMS)
+    book = conllu2json("little_prince_ko.conllu")
+    new_book = edit(book, selection, "deprel", "dep")
+    json2conllu(new_book, str(tmp_path / "full.conllu"))
+    json2conllu(book, str(tmp_path / "selected.conllu"))
+    json2conllu(new_book, str(tmp_path / "selected.conllu"), selection=selection)
+    assert read(tmp_path / "selected.conllu") == read(tmp_path / "full.conllu")
+    assert read(tmp_path / "full.conllu").count(b"\tdep\t") > 0
+
+
+def test_generate_col19(tmp_path, monkeypatch):
+    selection = Selection(ITEMS)
+    with open("little_prince_ko.conllulex", encoding="utf-8") as f:
+        old = f.read()
+    blocks = old.split("\n\n")
+    for n, block in enumerate(blocks):
+        lines = block.split("\n")
+        if lines[0].startswith("# sent_id = ") and parse_sent_id(lines[0][len("# sent_id = "):]) in selection:
+            lines = [line if line.startswith("#") or "\t" not in line
+                     else "\t".join(line.split("\t")[:13] + ["locus", "locus"] + line.split("\t")[15:])
+                     for line in lines]
+            blocks[n] = "\n".join(lines)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "old.conllulex").write_text(old, encoding="utf-8")
+    (tmp_path / "new.conllulex").write_text("\n\n".join(blocks), encoding="utf-8")
+
+    generate_col19("new.conllulex")
+    full = read("little_prince_ko.conllulex")
+    generate_col19("old.conllulex")
+    assert read("little_prince_ko.conllulex") != full
+    generate_col19("new.conllulex", selection=selection)
+    assert read("little_prince_ko.conllulex") == full
+
+
+def test_align_and_adjust(tmp_path, monkeypatch):
+    selection = Selection(ITEMS)
+    og_book = parse_tsv("little_prince_ko.tsv")
+    stanza_book = stanza_book_from_conllu()
+    new_stanza_book = edit(stanza_book, selection, "deprel", "dep")
+    monkeypatch.chdir(tmp_path)
+
+    full = align_and_adjust(og_book, new_stanza_book)[:2]
+    full_artifacts = [read("little_prince_merged.json"), read("little_prince_annotation_ready.json")]
+    align_and_adjust(og_book, stanza_book)
+    assert read("little_prince_merged.json") != full_artifacts[0]
+    assert align_and_adjust(og_book, new_stanza_book, workers=2, selection=selection)[:2] == full
+    assert [read("little_prince_merged.json"), read("little_prince_annotation_ready.json")] == full_artifacts
@@ -0,0 +1,35 @@
+"""
+Checks of treebank_diff.py on a retokenized sentence: HEAD/DEPS are compared in the ids of the new version, and a
+change whose old head was deleted says so instead of showing the same value on both sides.
+
+Usage:
+    python3 -m pytest test_treebank_diff.py
+"""
+from treebank_diff import diff_sentence
+
+
+def block(rows):
+    return "\n".join(["# sent_id = s1"] + ["\t".join([_id, form, "_", "_", "_", "_", head, "_", deps, "_"])
+                                           for _id, form, head, deps in rows])
+
+
+OLD = block([("1", "그것은", "3", "3:nsubj"), ("1.1", "은", "_", "1:case"), ("2", "그림", "3", "3:obj"),
+             ("3", "이었다", "0", "0:root")])
+
+
+def test_renumbered_heads_are_not_changes():
+    new = block([("1", "아", "4", "4:discourse"), ("2", "그것은", "4", "4:nsubj"), ("2.1", "은", "_", "2:case"),
+                 ("3", "그림", "4", "4:obj"), ("4", "이었다", "0", "0:root")])
+    diff = diff_sentence("s1", OLD, new)
+    assert diff["tokens"] == []
+    assert diff["inserted"] == [{"id": "1", "form": "아"}]
+    assert diff["renumbered"] == 4
+
+
+def test_unmapped_head_is_flagged():
+    new = block([("1", "그것", "4", "4:nsubj"), ("2", "이", "1", "1:dep"), ("2.1", "은", "_", "1:case"),
+                 ("3", "그림", "4", "4:obj"), ("4", "이었다", "0", "0:root")])
+    diff = diff_sentence("s1", OLD, new)
+    assert diff["deleted"] == [{"id": "1", "form": "그것은"}]
+    assert diff["tokens"] == [{"old_id": "1.1", "new_id": "2.1", "form": "은", "column": "deps", "old": "1:case",
+                               "new": "1:case", "old_translated": "?1:case", "unmapped_head": True}]
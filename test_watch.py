@@ -0,0 +1,34 @@
+"""
+Checks of the validation that watch.py runs on every sentence it converts: the tree checks of trees.check_trees()
+and the SNACS checks of check_adpositions(), reported per sent_id.
+
+Usage:
+    python3 -m pytest test_watch.py
+"""
+from watch import validate_sentences
+
+
+def line(_id, form, xpos, head, deprel, deps, misc="_"):
+    return "\t".join([_id, form, "_", "_", xpos, "_", head, deprel, deps, misc])
+
+
+GOOD = [line("1", "그것은", "npd+jxt", "2", "nsubj", "2:nsubj"),
+        line("1.1", "은", "jxt", "_", "_", "1:case", "Adp_lemma=은|Funct=topical|Scene=topical"),
+        line("2", "그림이었다", "ncn+jp+ep+ef", "0", "root", "0:root")]
+
+
+def test_good_sentence():
+    assert validate_sentences({"lpp.ko01-001": GOOD}) == {"lpp.ko01-001": []}
+
+
+def test_problems_are_reported_by_sentence():
+    cycle = [line("1", "그것은", "npd+jxt", "2", "nsubj", "2:nsubj"), GOOD[1],
+             line("2", "그림이었다", "ncn+jp+ep+ef", "1", "root", "1:root")]
+    wrong_xpos = GOOD[:1] + [GOOD[1].replace("\tjxt\t", "\tjco\t")] + GOOD[2:]
+    unreadable = GOOD[:2] + [line("2", "그림이었다", "ncn+jp+ep+ef", "x", "root", "0:root")]
+    problems = validate_sentences({"lpp.ko01-001": GOOD, "lpp.ko01-002": cycle, "lpp.ko01-003": wrong_xpos,
+                                   "lpp.ko01-004": unreadable})
+    assert problems["lpp.ko01-001"] == []
+    assert "0 roots" in problems["lpp.ko01-002"]
+    assert problems["lpp.ko01-003"] == ["adposition 1.1 은 has XPOS jco, expected jxt"]
+    assert len(problems["lpp.ko01-004"]) == 1 and "cannot read" in problems["lpp.ko01-004"][0]
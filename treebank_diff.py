@@ -0,0 +1,225 @@
+"""
+Structural diff between two versions of a .conllu/.conllulex treebank.
+
+Sentences are matched by sent_id through a dict, so the whole diff is linear in the size of the treebanks. Only
+sentences whose text blocks differ are split into token columns. Within such a sentence, token rows are compared one
+by one only for the columns that differ as a whole.
+
+When the tokenization of a sentence is unchanged, rows are compared position by position. Otherwise rows are aligned
+on their forms, and HEAD/DEPS ids of the old version are translated through that alignment before comparing, so that
+abstract nodes shifting from 5.1 to 6.1 are not reported as head changes of every later token. Such changes carry
+the translated old value as "old_translated", with "?<id>" for a head whose token was deleted, and "unmapped_head" if
+there is one.
+
+Reported columns: FORM, LEMMA, UPOS, XPOS, FEATS, HEAD, DEPREL, DEPS, the Adp/Scene/Funct values in MISC, and
+column 19 of CoNLL-U-Lex.
+
+Usage:
+    python3 treebank_diff.py old.conllulex little_prince_ko.conllulex [--out diff.json]
+"""
+import argparse
+import json
+from collections import Counter
+from difflib import SequenceMatcher
+
+from corpus_store import misc_value
+
+DIFF_COLUMNS = ["form", "lemma", "upos", "xpos", "feats", "head", "deprel", "deps", "adp", "scene", "function", "col19"]
+MISC_KEYS = {"adp": ("Adp_lemma", "Adp"), "scene": ("Scene",), "function": ("Funct",)}
+
+
+def read_treebank(file_path):
+    """
+    :param file_path: .conllu or .conllulex file
+    :return: dict of sent_id -> sentence block (comments and token lines), in file order
+    """
+    with open(file_path, encoding="utf-8") as f:
+        data = f.read()
+
+    sentences = {}
+    for n, block in enumerate(data.split("\n\n")):
+        block = block.strip("\n")
+        if not block:
+            continue
+        sent_id = None
+        for line in block.split("\n", 2)[:2]:
+            if line.startswith("# sent_id"):
+                sent_id = line.split("=", 1)[1].strip()
+        if sent_id is None:
+            sent_id = f"#{n}"  # sentences without sent_id are matched by position
+        if sent_id in sentences:
+            raise ValueError(f"Duplicate sent_id {sent_id} in {file_path}")
+        sentences[sent_id] = block
+    return sentences
+
+
+def split_sentence(block):
+    """
+    :return: text of the sentence, token ids, and dict of column name -> list of values
+    """
+    text = ""
+    rows = []
+    for line in block.split("\n"):
+        if line.startswith("#"):
+            if line.startswith("# text"):
+                text = line.split("=", 1)[1].strip()
+        elif line:
+            rows.append(line.split("\t"))
+
+    miscs = [row[9] for row in rows]
+    columns = {
+        "form": [row[1] for row in rows],
+        "lemma": [row[2] for row in rows],
+        "upos": [row[3] for row in rows],
+        "xpos": [row[4] for row in rows],
+        "feats": [row[5] for row in rows],
+        "head": [row[6] for row in rows],
+        "deprel": [row[7] for row in rows],
+        "deps": [row[8] for row in rows],
+        **{column: [misc_value(misc, *keys) or "_" for misc in miscs] for column, keys in MISC_KEYS.items()},
+        "col19": [row[18] if len(row) > 18 else "_" for row in rows],
+    }
+    return text, [row[0] for row in rows], columns
+
+
+def align_rows(old_ids, old_forms, new_ids, new_forms):
+    """
+    Pair up the token rows of two versions of a sentence.
+
+    :return: list of (old index, new index) pairs, old indices without a partner, new indices without a partner
+    """
+    if old_ids == new_ids and old_forms == new_forms:
+        return [(i, i) for i in range(len(old_ids))], [], []
+
+    pairs, deleted, inserted = [], [], []
+    matcher = SequenceMatcher(None, old_forms, new_forms, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal" or (tag == "replace" and i2 - i1 == j2 - j1):
+            pairs += zip(range(i1, i2), range(j1, j2))
+        else:
+            deleted += range(i1, i2)
+            inserted += range(j1, j2)
+    return pairs, deleted, inserted
+
+
+def translate_head(head, id_map):
+    """
+    :return: head in the ids of the new version, or "?<head>" if its token has no partner there
+    """
+    if head in ["_", "0"]:
+        return head
+    return id_map.get(head, f"?{head}")
+
+
+def translate_deps(deps, id_map):
+    if deps == "_":
+        return deps
+    translated = []
+    for dep in deps.split("|"):
+        head, _, rel = dep.partition(":")
+        translated.append(f"{translate_head(head, id_map)}:{rel}")
+    return "|".join(translated)
+
+
+def diff_sentence(sent_id, old_block, new_block):
+    """
+    :return: dict describing the changes between two versions of a sentence
+    """
+    old_text, old_ids, old_columns = split_sentence(old_block)
+    new_text, new_ids, new_columns = split_sentence(new_block)
+    pairs, deleted, inserted = align_rows(old_ids, old_columns["form"], new_ids, new_columns["form"])
+    retokenized = bool(deleted or inserted or old_ids != new_ids)
+    id_map = {old_ids[i]: new_ids[j] for i, j in pairs}
+
+    changes = []
+    changed_columns = []
+    for column in DIFF_COLUMNS:
+        old_values, new_values = old_columns[column], new_columns[column]
+        if not retokenized and old_values == new_values:
+            continue
+        n_changes = len(changes)
+        for i, j in pairs:
+            old_value = old_values[i]
+            if column == "head":
+                translated = translate_head(old_value, id_map)
+            elif column == "deps":
+                translated = translate_deps(old_value, id_map)
+            else:
+                translated = old_value
+            if translated != new_values[j]:
+                change = {"old_id": old_ids[i], "new_id": new_ids[j], "form": new_columns["form"][j],
+                          "column": column, "old": old_value, "new": new_values[j]}
+                if translated != old_value:
+                    change["old_translated"] = translated
+                    if any(dep.startswith("?") for dep in translated.split("|")):
+                        change["unmapped_head"] = True
+                changes.append(change)
+        if len(changes) > n_changes:
+            changed_columns.append(column)
+
+    diff = {"sent_id": sent_id, "columns": changed_columns, "tokens": changes}
+    if old_text != new_text:
+        diff["text"] = {"old": old_text, "new": new_text}
+    if retokenized:
+        diff["deleted"] = [{"id": old_ids[i], "form": old_columns["form"][i]} for i in deleted]
+        diff["inserted"] = [{"id": new_ids[j], "form": new_columns["form"][j]} for j in inserted]
+        diff["renumbered"] = sum(old_ids[i] != new_ids[j] for i, j in pairs)
+    return diff
+
+
+def diff_treebanks(old_sentences, new_sentences):
+    """
+    :param old_sentences: read_treebank() of the old version
+    :param new_sentences: read_treebank() of the new version
+    :return: dict with a summary, added and removed sent_ids, and one diff_sentence() per changed sentence
+    """
+    changed = []
+    for sent_id, new_block in new_sentences.items():
+        old_block = old_sentences.get(sent_id)
+        if old_block is None or old_block == new_block:
+            continue
+        changed.append(diff_sentence(sent_id, old_block, new_block))
+
+    added = [sent_id for sent_id in new_sentences if sent_id not in old_sentences]
+    removed = [sent_id for sent_id in old_sentences if sent_id not in new_sentences]
+
+    token_changes = Counter({column: 0 for column in DIFF_COLUMNS})
+    for diff in changed:
+        token_changes.update(change["column"] for change in diff["tokens"])
+    summary = {
+        "old_sentences": len(old_sentences),
+        "new_sentences": len(new_sentences),
+        "changed": len(changed),
+        "added": len(added),
+        "removed": len(removed),
+        "text_changed": sum("text" in diff for diff in changed),
+        "retokenized": sum("deleted" in diff for diff in changed),
+        "token_changes": dict(token_changes),
+        "sentence_changes": {column: sum(column in diff["columns"] for diff in changed) for column in DIFF_COLUMNS},
+    }
+    return {"summary": summary, "added": added, "removed": removed, "changed": changed}
+
+
+def summary_table(diff):
+    summary = diff["summary"]
+    lines = [f"{summary['old_sentences']} -> {summary['new_sentences']} sentences: {summary['changed']} changed, "
+             f"{summary['added']} added, {summary['removed']} removed, {summary['text_changed']} with new text, "
+             f"{summary['retokenized']} retokenized",
+             f"{'column':<10}{'tokens':>8}{'sentences':>11}"]
+    for column in DIFF_COLUMNS:
+        lines.append(f"{column:<10}{summary['token_changes'][column]:>8}{summary['sentence_changes'][column]:>11}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-column diff of two versions of a .conllu/.conllulex treebank.")
+    parser.add_argument("old", help="old version of the treebank")
+    parser.add_argument("new", help="new version of the treebank")
+    parser.add_argument("--out", help="write the full diff to this JSON file")
+    args = parser.parse_args()
+
+    treebank_diff = diff_treebanks(read_treebank(args.old), read_treebank(args.new))
+    print(summary_table(treebank_diff))
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(treebank_diff, f, ensure_ascii=False, indent=4)
@@ -0,0 +1,318 @@
+"""
+Array-based validation of the dependency trees of a treebank, and CSR export of its basic and enhanced graphs.
+
+The corpus is read into a ColumnarCorpus (see corpus_store.py) and every check runs on the whole corpus at once:
+ * ids: words are numbered 1..n, abstract nodes N.1, N.2, ... follow their word N,
+ * dangling_head: every HEAD is 0 or a word of the same sentence,
+ * roots: exactly one word per sentence has HEAD 0, and it is the only one with DEPREL root,
+ * cycle: every word reaches the root, checked by pointer jumping over a global parent array, which needs
+   log2(longest sentence) gathers instead of one walk per word,
+ * deps: DEPS heads exist, and the DEPS of every word include its HEAD:DEPREL,
+ * abstract_node: abstract ADP nodes have no HEAD/DEPREL and a single DEPS edge N:case to their word.
+Non-projective arcs (crossing another arc of the sentence, including the arc from 0 to the root) are reported
+separately, since they are allowed in UD.
+
+The CSR export numbers nodes by their row in the corpus (words and abstract nodes alike): the dependents of node i are
+indices[indptr[i]:indptr[i + 1]], with relation codes into the relations array in the same slice. Arcs from 0 are
+kept out of the adjacency and listed as roots. scipy.sparse.csr_matrix((relation + 1, indices, indptr)) reads it.
+
+Usage:
+    python3 trees.py little_prince_ko.conllulex [--out problems.json] [--csr graphs.npz]
+"""
+import argparse
+import json
+import math
+from collections import Counter
+
+import numpy as np
+
+from corpus_store import ColumnarCorpus
+
+PROBLEM_KINDS = ["ids", "dangling_head", "roots", "cycle", "deps", "abstract_node"]
+ROOT = -1  # head row of arcs from 0
+MISSING = -2  # head row of arcs whose head does not exist
+
+
+def node_keys(sentence, id_major, id_minor):
+    return (sentence.astype(np.int64) << 32) | (id_major.astype(np.int64) << 16) | id_minor.astype(np.int64)
+
+
+class TreeArrays:
+    """
+    The basic trees of a corpus as integer arrays over its words (rows with an integer id).
+    """
+    def __init__(self, corpus: ColumnarCorpus):
+        self.corpus = corpus
+        self.row_sentence = corpus.sentence_of_token()
+        self.word_rows = np.flatnonzero(corpus.id_minor == 0)
+        self.word_sentence = self.row_sentence[self.word_rows]
+        self.n_words = np.bincount(self.word_sentence, minlength=corpus.n_sentences)
+        self.word_offsets = np.zeros(corpus.n_sentences + 1, dtype=np.int64)
+        np.cumsum(self.n_words, out=self.word_offsets[1:])
+        self.position = np.arange(len(self.word_rows)) - self.word_offsets[self.word_sentence] + 1
+
+        head = corpus.head[self.word_rows].astype(np.int64)
+        self.is_root = head == 0
+        self.dangling = (head < 0) | (head > self.n_words[self.word_sentence])
+        # parent word of every word; roots and words with dangling heads point to themselves
+        self.parent = np.where(self.is_root | self.dangling, np.arange(len(self.word_rows)),
+                               self.word_offsets[self.word_sentence] + head - 1)
+        self.head_row = np.where(self.is_root, ROOT, np.where(self.dangling, MISSING, self.word_rows[self.parent]))
+
+        order = np.argsort(node_keys(self.row_sentence, corpus.id_major, corpus.id_minor), kind="stable")
+        self._sorted_keys = node_keys(self.row_sentence, corpus.id_major, corpus.id_minor)[order]
+        self._sorted_rows = order
+
+    def find_rows(self, sentence, id_major, id_minor):
+        """
+        :return: corpus rows of the nodes with the given ids, or MISSING
+        """
+        keys = node_keys(sentence, id_major, id_minor)
+        where = np.minimum(np.searchsorted(self._sorted_keys, keys), len(self._sorted_keys) - 1)
+        found = self._sorted_keys[where] == keys if len(self._sorted_keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, self._sorted_rows[where] if len(self._sorted_rows) else MISSING, MISSING)
+
+    def ancestors(self):
+        """
+        :return: for every word, the root or dangling word it hangs from, or a word on a cycle
+        """
+        longest = int(self.n_words.max()) if len(self.n_words) else 1
+        anc = self.parent
+        for _ in range(max(1, math.ceil(math.log2(max(longest, 2)))) + 1):
+            anc = anc[anc]  # now points 2^(k + 1) steps up
+        return anc
+
+    def arc_spans(self):
+        """
+        :return: padded (sentences, longest sentence) arrays of the left and right ends of the arc into each word,
+            with the arc from 0 for the root and -1 for padding and dangling heads
+        """
+        longest = int(self.n_words.max()) if len(self.n_words) else 0
+        left = np.full((self.corpus.n_sentences, longest), -1, dtype=np.int32)
+        right = np.full((self.corpus.n_sentences, longest), -1, dtype=np.int32)
+        head_position = np.where(self.is_root, 0, self.position[self.parent])
+        valid = ~self.dangling
+        column = self.position - 1
+        left[self.word_sentence[valid], column[valid]] = np.minimum(self.position, head_position)[valid]
+        right[self.word_sentence[valid], column[valid]] = np.maximum(self.position, head_position)[valid]
+        return left, right
+
+
+def nonprojective_words(trees, batch_size=256):
+    """
+    :return: corpus rows of the words whose arc from their head crosses another arc
+    """
+    left, right = trees.arc_spans()
+    crossing = np.zeros(left.shape, dtype=bool)
+    for start in range(0, left.shape[0], batch_size):
+        stop = start + batch_size
+        longest = int(trees.n_words[start:stop].max()) if stop > start else 0
+        l, r = left[start:stop, :longest], right[start:stop, :longest]
+        l1, r1, l2, r2 = l[:, :, None], r[:, :, None], l[:, None, :], r[:, None, :]
+        valid = (l1 >= 0) & (l2 >= 0)
+        crosses = valid & (((l1 < l2) & (l2 < r1) & (r1 < r2)) | ((l2 < l1) & (l1 < r2) & (r2 < r1)))
+        crossing[start:stop, :longest] = crosses.any(axis=2)
+    sentence, column = np.nonzero(crossing)
+    return trees.word_rows[trees.word_offsets[sentence] + column]
+
+
+def parse_deps(deps_vocab, relations):
+    """
+    :param deps_vocab: distinct values of the DEPS column
+    :param relations: list of relation names, extended in place with new ones
+    :return: for every value, a list of (head major, head minor, relation code); head major -1 if unparseable
+    """
+    index = {relation: n for n, relation in enumerate(relations)}
+    parsed = []
+    for deps in deps_vocab:
+        edges = []
+        for dep in ([] if deps == "_" else deps.split("|")):
+            head, _, relation = dep.partition(":")
+            major, _, minor = head.partition(".")
+            if not major.isdigit() or (minor and not minor.isdigit()):
+                major, minor = "-1", "0"
+            if relation not in index:
+                index[relation] = len(relations)
+                relations.append(relation)
+            edges.append((int(major), int(minor or 0), index[relation]))
+        parsed.append(edges)
+    return parsed
+
+
+def enhanced_edges(trees, relations):
+    """
+    :return: dependent rows, head rows (ROOT for 0, MISSING if the head does not exist) and relation codes of all
+        DEPS edges, and the number of edges of every row
+    """
+    corpus = trees.corpus
+    parsed = parse_deps(corpus.deps.vocab.tolist(), relations)
+    vocab_counts = np.array([len(edges) for edges in parsed], dtype=np.int64)
+    vocab_offsets = np.zeros(len(parsed) + 1, dtype=np.int64)
+    np.cumsum(vocab_counts, out=vocab_offsets[1:])
+    flat = np.array([edge for edges in parsed for edge in edges], dtype=np.int64).reshape(-1, 3)
+
+    codes = corpus.deps.codes.astype(np.int64)
+    counts = vocab_counts[codes]
+    dependent = np.repeat(np.arange(corpus.n_tokens), counts)
+    first_edge = np.repeat(np.cumsum(counts) - counts, counts)
+    edge = np.repeat(vocab_offsets[codes], counts) + np.arange(len(dependent)) - first_edge
+    head_major, head_minor, relation = flat[edge, 0], flat[edge, 1], flat[edge, 2]
+
+    head = trees.find_rows(trees.row_sentence[dependent], np.maximum(head_major, 0), head_minor)
+    head = np.where(head_major == 0, ROOT, np.where(head_major < 0, MISSING, head))
+    return dependent, head, relation, counts
+
+
+def check_trees(corpus):
+    """
+    :return: list of problems as dicts with sent_id, id, kind and message, and the rows of non-projective words
+    """
+    trees = TreeArrays(corpus)
+    sent_ids = corpus.sent_ids()
+    problems = []
+
+    def report(rows, kind, messages):
+        for row, message in zip(rows.tolist(), messages):
+            major, minor = int(corpus.id_major[row]), int(corpus.id_minor[row])
+            problems.append({"sent_id": sent_ids[trees.row_sentence[row]],
+                             "id": str(major) if minor == 0 else f"{major}.{minor}",
+                             "kind": kind, "message": message})
+
+    def token_id(rows):
+        return [str(major) if minor == 0 else f"{major}.{minor}"
+                for major, minor in zip(corpus.id_major[rows].tolist(), corpus.id_minor[rows].tolist())]
+
+    # ids
+    misnumbered = corpus.id_major[trees.word_rows] != trees.position
+    bad = trees.word_rows[misnumbered]
+    report(bad, "ids", [f"word {i} is word number {p}"
+                        for i, p in zip(token_id(bad), trees.position[misnumbered].tolist())])
+    abstract = np.flatnonzero(corpus.id_minor > 0)
+    previous = np.maximum(abstract - 1, 0)
+    in_sequence = ((abstract > 0) & (trees.row_sentence[previous] == trees.row_sentence[abstract])
+                   & (corpus.id_major[previous] == corpus.id_major[abstract])
+                   & (corpus.id_minor[previous] == corpus.id_minor[abstract] - 1))
+    bad = abstract[~in_sequence]
+    report(bad, "ids", [f"abstract node {i} does not follow its word or the previous abstract node"
+                        for i in token_id(bad)])
+
+    # heads and roots
+    heads = corpus.head[trees.word_rows]
+    bad = trees.word_rows[trees.dangling]
+    report(bad, "dangling_head", [f"word {i} has head {'_' if h < 0 else h}, which does not exist"
+                                  for i, h in zip(token_id(bad), heads[trees.dangling].tolist())])
+    n_roots = np.bincount(trees.word_sentence[trees.is_root], minlength=corpus.n_sentences)
+    for s in np.flatnonzero(n_roots != 1).tolist():
+        problems.append({"sent_id": sent_ids[s], "id": None, "kind": "roots", "message": f"{n_roots[s]} roots"})
+    root_code = corpus.deprel.code_of("root")
+    bad = trees.word_rows[trees.is_root != (corpus.deprel.codes[trees.word_rows] == root_code)]
+    report(bad, "roots", [f"word {i} has head {h} and deprel {d}" for i, h, d in zip(
+        token_id(bad), corpus.head[bad].tolist(), [corpus.deprel[row] for row in bad.tolist()])])
+
+    # cycles
+    anc = trees.ancestors()
+    detached = ~(trees.is_root | trees.dangling)[anc]
+    for s in np.unique(trees.word_sentence[detached]).tolist():
+        rows = trees.word_rows[detached & (trees.word_sentence == s)]
+        problems.append({"sent_id": sent_ids[s], "id": token_id(rows)[0], "kind": "cycle",
+                         "message": f"words {', '.join(token_id(rows))} do not reach the root"})
+
+    # enhanced graph
+    relations = corpus.deprel.vocab.tolist()
+    dependent, head, relation, n_edges = enhanced_edges(trees, relations)
+    bad = dependent[head == MISSING]
+    report(bad, "deps", [f"DEPS {corpus.deps[row]} of {i} point to a head that does not exist"
+                         for row, i in zip(bad.tolist(), token_id(bad))])
+    n_rows = corpus.n_tokens + 2
+    n_relations = len(relations)
+    edge_keys = (dependent * n_rows + (head + 2)) * n_relations + relation
+    with_head = ~trees.dangling
+    rows = trees.word_rows[with_head]
+    basic_keys = ((rows * n_rows + (trees.head_row[with_head] + 2)) * n_relations
+                  + corpus.deprel.codes[rows].astype(np.int64))
+    bad = rows[~np.isin(basic_keys, edge_keys)]
+    report(bad, "deps", [f"DEPS {corpus.deps[row]} of word {i} lack {corpus.head[row]}:{corpus.deprel[row]}"
+                         for row, i in zip(bad.tolist(), token_id(bad))])
+
+    # abstract nodes
+    anchors = trees.find_rows(trees.row_sentence[abstract], corpus.id_major[abstract],
+                              np.zeros(len(abstract), dtype=np.int64))
+    case = relations.index("case") if "case" in relations else -1
+    first_edge = np.cumsum(n_edges) - n_edges
+    single = n_edges[abstract] == 1
+    edge_of_node = np.where(single, first_edge[abstract], 0)
+    good = (single & (anchors >= 0) & (head[edge_of_node] == anchors) & (relation[edge_of_node] == case)
+            if len(head) else np.zeros(len(abstract), dtype=bool))
+    good &= (corpus.head[abstract] == -1) & (corpus.deprel.codes[abstract] == corpus.deprel.code_of("_"))
+    bad = abstract[~good]
+    report(bad, "abstract_node", [f"abstract node {i} has HEAD {corpus.head[row] if corpus.head[row] >= 0 else '_'}, "
+                                  f"DEPREL {corpus.deprel[row]}, DEPS {corpus.deps[row]}"
+                                  for row, i in zip(bad.tolist(), token_id(bad))])
+
+    return problems, nonprojective_words(trees)
+
+
+def to_csr(heads, dependents, values, n_nodes):
+    """
+    :return: indptr, indices and data of the adjacency of heads to dependents, each row in input order
+    """
+    order = np.argsort(heads, kind="stable")
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(heads, minlength=n_nodes), out=indptr[1:])
+    return indptr, dependents[order].astype(np.int32), values[order].astype(np.int32)
+
+
+def export_csr(corpus, file_path):
+    """
+    Save the basic and enhanced graphs of the corpus as CSR arrays in an .npz.
+    """
+    trees = TreeArrays(corpus)
+    relations = corpus.deprel.vocab.tolist()
+    dependent, head, relation, _ = enhanced_edges(trees, relations)
+
+    arrays = {"sentence_offsets": corpus.sentence_offsets}
+    attached = trees.head_row >= 0
+    basic = to_csr(trees.head_row[attached], trees.word_rows[attached],
+                   corpus.deprel.codes[trees.word_rows[attached]], corpus.n_tokens)
+    enhanced = to_csr(head[head >= 0], dependent[head >= 0], relation[head >= 0], corpus.n_tokens)
+    for name, (indptr, indices, data) in [("basic", basic), ("enhanced", enhanced)]:
+        arrays.update({f"{name}_indptr": indptr, f"{name}_indices": indices, f"{name}_relation": data})
+    arrays["basic_roots"] = trees.word_rows[trees.is_root].astype(np.int32)
+    arrays["enhanced_roots"] = dependent[head == ROOT].astype(np.int32)
+    arrays["relations"] = np.array(relations)
+    np.savez(file_path, **arrays)
+    return arrays
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the trees of a treebank and export its graphs.")
+    parser.add_argument("treebank", nargs="?", default="little_prince_ko.conllulex",
+                        help=".conllu, .conllulex or corpus_store .npz")
+    parser.add_argument("--out", help="write all problems and non-projective words to this JSON file")
+    parser.add_argument("--csr", help="write the basic and enhanced graphs to this .npz")
+    args = parser.parse_args()
+
+    if args.treebank.endswith(".npz"):
+        treebank = ColumnarCorpus.load(args.treebank)
+    else:
+        treebank = ColumnarCorpus.from_conllu(args.treebank)
+    found, nonprojective = check_trees(treebank)
+    kinds = Counter(problem["kind"] for problem in found)
+    print(f"{treebank.n_sentences} sentences, {treebank.n_tokens} nodes")
+    for kind in PROBLEM_KINDS:
+        print(f"{kind:<15}{kinds[kind]:>6}")
+    nonprojective_sentences = np.unique(treebank.sentence_of_token()[nonprojective])
+    print(f"{len(nonprojective)} non-projective arcs in {len(nonprojective_sentences)} sentences")
+    for problem in found[:20]:
+        print(f"{problem['sent_id']}: {problem['message']}")
+
+    if args.out:
+        sent_id_list = treebank.sent_ids()
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"problems": found,
+                       "nonprojective": [{"sent_id": sent_id_list[treebank.sentence_of_token()[row]],
+                                          "id": str(treebank.id_major[row])} for row in nonprojective.tolist()]},
+                      f, ensure_ascii=False, indent=4)
+    if args.csr:
+        export_csr(treebank, args.csr)
+        print(f"Wrote {args.csr}")
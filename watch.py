@@ -0,0 +1,343 @@
+"""
+Watch mode for the hand-corrected annotation JSON.
+
+Keeps the corpus, the Romanizer and the FEATS rule table resident, polls little_prince_hand_corrected.json for
+changes and rewrites little_prince_ko.conllu and little_prince_ko.conllulex after every save. All three names go
+through util.artifact_path(), so with --compress gz the watcher uses the same .gz artifacts as util.py.
+
+On a change, the old and new file contents are compared to find the edited region. Only the chapters overlapping it
+are parsed again, and only sentences whose JSON changed are converted; chapters after the region are kept and just
+shifted, or renumbered if chapters were added or removed. Changed sentences are validated with trees.check_trees()
+and check_adpositions(), and the results printed.
+
+The wMWE columns 16-18 of the .conllulex are not in the JSON; they are carried over from the .conllulex as it was
+when the watcher started, by sent_id and token id.
+
+Usage:
+    python3 watch.py [--interval 0.2] [--compress .gz]
+    python3 util.py --watch [--compress .gz]
+"""
+import argparse
+import json
+import os
+import re
+import time
+from bisect import bisect_left, bisect_right
+
+import util
+from corpus_store import ColumnarCorpus, misc_value
+from trees import check_trees
+from util import COMPRESSED_OPENERS, Romanizer, conllulex_line, format_sent_id, p2xpos, replace_file, \
+    sentence2conllu, smart_open
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"[ \t\n\r]*")
+_BLOCK = 1 << 16
+
+
+def common_prefix_length(a, b):
+    """
+    Compares block by block, then narrows down the first differing block by bisection, so that all character
+    comparisons happen in C.
+    """
+    n = min(len(a), len(b))
+    lo = 0
+    while lo < n and a[lo:lo + _BLOCK] == b[lo:lo + _BLOCK]:
+        lo += _BLOCK
+    lo, hi = min(lo, n), min(lo + _BLOCK, n)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def common_suffix_length(a, b, limit):
+    """
+    :param limit: longest suffix to consider, so that prefix and suffix do not overlap
+    """
+    lo = 0
+    while lo < limit and a[len(a) - min(lo + _BLOCK, limit):len(a) - lo] == \
+            b[len(b) - min(lo + _BLOCK, limit):len(b) - lo]:
+        lo = min(lo + _BLOCK, limit)
+    hi = min(lo + _BLOCK, limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _skip(text, pos):
+    return _whitespace.match(text, pos).end()
+
+
+def scan_chapters(text, pos, stop_at=None):
+    """
+    Find the chapters of the book from pos on, without converting anything.
+
+    :param text: contents of the annotation JSON
+    :param pos: position just inside the opening [ of the book, or just after a chapter
+    :param stop_at: position of a chapter start at which to stop scanning
+    :return: (start, end, sentence sources) per chapter, where sources are the JSON texts of its sentences, and
+        whether scanning stopped at stop_at
+    """
+    chapters = []
+    while True:
+        pos = _skip(text, pos)
+        if text[pos:pos + 1] == ",":
+            pos = _skip(text, pos + 1)
+        if text[pos:pos + 1] == "]":
+            return chapters, False
+        if pos == stop_at:
+            return chapters, True
+        if text[pos:pos + 1] != "[":
+            raise ValueError(f"Expected a chapter at position {pos}")
+
+        start = pos
+        sources = []
+        pos = _skip(text, pos + 1)
+        while text[pos:pos + 1] != "]":
+            if text[pos:pos + 1] == ",":
+                pos = _skip(text, pos + 1)
+            sentence, end = _decoder.raw_decode(text, pos)
+            if not isinstance(sentence, list):
+                raise ValueError(f"Expected a sentence at position {pos}")
+            sources.append(text[pos:end])
+            pos = _skip(text, end)
+        pos += 1
+        chapters.append((start, pos, sources))
+
+
+def check_adpositions(token_lines):
+    """
+    :param token_lines: CoNLL-U token lines of a sentence
+    :return: list of problems with the SNACS annotation of its adpositions
+    """
+    problems = []
+    for row in (line.split("\t") for line in token_lines):
+        if "." not in row[0]:
+            continue
+        p = misc_value(row[9], "Adp", "Adp_lemma")
+        if p is None:
+            continue
+        scene, function = misc_value(row[9], "Scene"), misc_value(row[9], "Funct")
+        if not scene or not function:
+            problems.append(f"adposition {row[0]} {p} lacks a scene or function")
+            continue
+        try:
+            expected = p2xpos(p, function)
+        except KeyError:
+            problems.append(f"adposition {row[0]} {p} is not in p2xpos()")
+            continue
+        if expected != row[4]:
+            problems.append(f"adposition {row[0]} {p} has XPOS {row[4]}, expected {expected}")
+    return problems
+
+
+def validate_sentences(token_lines):
+    """
+    Run trees.check_trees() and check_adpositions() on some sentences.
+
+    :param token_lines: dict of sent_id -> CoNLL-U token lines of the sentence
+    :return: dict of sent_id -> list of problems found
+    """
+    if not token_lines:
+        return {}
+    try:
+        corpus = ColumnarCorpus.from_sentences(([f"# sent_id = {sent_id}"], lines, True)
+                                               for sent_id, lines in token_lines.items())
+    except ValueError as e:  # an id or head that is not a number, or missing columns
+        if len(token_lines) == 1:
+            return {sent_id: [f"cannot read the token lines: {e}"] for sent_id in token_lines}
+        problems = {}
+        for sent_id, lines in token_lines.items():
+            problems.update(validate_sentences({sent_id: lines}))
+        return problems
+
+    problems = {sent_id: [] for sent_id in token_lines}
+    for problem in check_trees(corpus)[0]:
+        problems[problem["sent_id"]].append(problem["message"])
+    for sent_id, lines in token_lines.items():
+        problems[sent_id] += check_adpositions(lines)
+    return problems
+
+
+class LiveConverter:
+    """
+    The annotation JSON and its CoNLL-U(-Lex) conversion, kept in memory and updated from new versions of the JSON.
+    """
+    def __init__(self, mwe=None):
+        """
+        :param mwe: dict of (sent_id, token id) -> cols 16-18 of the .conllulex, for tokens in wMWEs
+        """
+        self.r = Romanizer()
+        self.mwe = mwe or {}
+        self.text = ""
+        self.chapters = []  # (start, end, sentence sources)
+        self.converted = {}  # sentence source -> (text of the sentence, CoNLL-U token lines)
+        self.conllu_blocks = []
+        self.conllulex_blocks = []
+
+    def update(self, text):
+        """
+        :param text: new contents of the annotation JSON
+        :return: sent_ids of the sentences that were converted
+        """
+        old = self.text
+        prefix = common_prefix_length(old, text)
+        suffix = common_suffix_length(old, text, min(len(old), len(text)) - prefix)
+        delta = len(text) - len(old)
+
+        first = bisect_right([end for _, end, _ in self.chapters], prefix)  # first chapter that may have changed
+        kept = bisect_left([start for start, _, _ in self.chapters], len(old) - suffix, lo=first)  # unchanged after
+        if first > 0:
+            resume = self.chapters[first - 1][1]
+        else:
+            resume = _skip(text, 0)
+            if text[resume:resume + 1] != "[":
+                raise ValueError("Expected [ at the start of the book")
+            resume += 1
+        stop_at = self.chapters[kept][0] + delta if kept < len(self.chapters) else None
+        scanned, stopped = scan_chapters(text, resume, stop_at)
+
+        tail = [(start + delta, end + delta, sources) for start, end, sources in self.chapters[kept:]] if stopped else []
+        chapters = self.chapters[:first] + scanned + tail
+        renumbered = len(scanned) != kept - first
+
+        # convert into copies, so that a sentence that fails to convert leaves the last good version in place
+        conllu_blocks = self.conllu_blocks[:len(chapters)]
+        conllulex_blocks = self.conllulex_blocks[:len(chapters)]
+        converted = []
+        for c in range(first, len(chapters) if renumbered else first + len(scanned)):
+            conllu_block, conllulex_block, chapter_converted = self._render_chapter(c, chapters[c][2])
+            conllu_blocks[c:c + 1] = [conllu_block]
+            conllulex_blocks[c:c + 1] = [conllulex_block]
+            converted += chapter_converted
+
+        self.text = text
+        self.chapters = chapters
+        self.conllu_blocks = conllu_blocks
+        self.conllulex_blocks = conllulex_blocks
+        live = {source for _, _, sources in chapters for source in sources}
+        self.converted = {source: value for source, value in self.converted.items() if source in live}
+        return converted
+
+    def _render_chapter(self, c, sources):
+        """
+        :return: CoNLL-U and CoNLL-U-Lex text of chapter c, and the sent_ids of the sentences that had to be converted
+        """
+        conllu_lines, conllulex_lines = [], []
+        converted = []
+        for s, source in enumerate(sources):
+            sent_id = format_sent_id(c, s)
+            if source not in self.converted:
+                sentence_text, token_lines = sentence2conllu(json.loads(source), self.r)
+                self.converted[source] = (sentence_text, [tok.conllu_line() for tok in token_lines])
+                converted.append(sent_id)
+            sentence_text, token_lines = self.converted[source]
+            header = [f"# sent_id = {sent_id}", f"# text = {sentence_text}"]
+            conllu_lines += header + token_lines + [""]
+            conllulex_lines += header + [conllulex_line(line, self.mwe.get((sent_id, line.split("\t", 1)[0]),
+                                                                           ("_", "_", "_")))
+                                         for line in token_lines] + [""]
+        return ("\n".join(conllu_lines) + "\n" if conllu_lines else "",
+                "\n".join(conllulex_lines) + "\n" if conllulex_lines else "", converted)
+
+    def validate(self, sent_ids):
+        """
+        :return: dict of sent_id -> problems, for the given sentences
+        """
+        sources = {format_sent_id(c, s): source
+                   for c, (_, _, chapter_sources) in enumerate(self.chapters) for s, source in enumerate(chapter_sources)}
+        return validate_sentences({sent_id: self.converted[sources[sent_id]][1] for sent_id in sent_ids})
+
+    def write(self, conllu_path, conllulex_path=None):
+        for file_path, blocks in [(conllu_path, self.conllu_blocks), (conllulex_path, self.conllulex_blocks)]:
+            if file_path is None:
+                continue
+            # write next to the target and rename, so that readers never see a half-written file
+            replace_file(file_path, "".join(blocks))
+
+
+def read_mwe_columns(conllulex_path):
+    """
+    :return: dict of (sent_id, token id) -> cols 16-18, for tokens of a .conllulex with wMWE annotations
+    """
+    mwe = {}
+    if not os.path.exists(conllulex_path):
+        return mwe
+    sent_id = None
+    with smart_open(conllulex_path, encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("# sent_id = "):
+                sent_id = line[len("# sent_id = "):].strip()
+            elif line.strip() and not line.startswith("#"):
+                cols = line.rstrip("\n").split("\t")
+                if len(cols) >= 18 and cols[15:18] != ["_", "_", "_"]:
+                    mwe[(sent_id, cols[0])] = tuple(cols[15:18])
+    return mwe
+
+
+def watch(json_path=None, conllu_path=None, conllulex_path=None, interval=0.2):
+    """
+    Convert json_path whenever it changes, until interrupted.
+
+    :param json_path: annotation JSON, util.artifact_path("little_prince_hand_corrected.json") if not given
+    :param conllu_path: output, util.artifact_path("little_prince_ko.conllu") if not given
+    :param conllulex_path: output, util.artifact_path("little_prince_ko.conllulex") if not given
+    """
+    json_path = json_path or util.artifact_path("little_prince_hand_corrected.json")
+    conllu_path = conllu_path or util.artifact_path("little_prince_ko.conllu")
+    conllulex_path = conllulex_path or util.artifact_path("little_prince_ko.conllulex")
+    converter = LiveConverter(read_mwe_columns(conllulex_path))
+    signature = None
+    print(f"Watching {json_path}")
+    try:
+        while True:
+            try:
+                stat = os.stat(json_path)
+            except FileNotFoundError:
+                time.sleep(interval)
+                continue
+            if (stat.st_mtime_ns, stat.st_size) != signature:
+                signature = (stat.st_mtime_ns, stat.st_size)
+                start = time.perf_counter()
+                with smart_open(json_path, encoding="utf-8") as f:
+                    text = f.read()
+                initial = not converter.chapters
+                try:
+                    converted = converter.update(text)
+                except (ValueError, KeyError, TypeError, AttributeError, IndexError) as e:
+                    print(f"{json_path} is not valid annotation JSON, keeping the last version: {e!r}")
+                    continue
+                converter.write(conllu_path, conllulex_path)
+                problems = {sent_id: p for sent_id, p in converter.validate(converted).items() if p}
+                print(f"Converted {len(converted)} sentences in {(time.perf_counter() - start) * 1000:.0f} ms, "
+                      f"{len(problems)} with problems")
+                for sent_id, sentence_problems in problems.items():
+                    if not initial:
+                        print(f"  {sent_id}: {'; '.join(sentence_problems)}")
+                if not initial:
+                    for sent_id in converted:
+                        if sent_id not in problems:
+                            print(f"  {sent_id}: ok")
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconvert the hand-corrected JSON to CoNLL-U whenever it changes.")
+    parser.add_argument("--json", help="annotation JSON; little_prince_hand_corrected.json plus the --compress suffix "
+                                       "by default")
+    parser.add_argument("--interval", type=float, default=0.2, help="seconds between checks of the file")
+    parser.add_argument("--compress", choices=COMPRESSED_OPENERS, default="",
+                        help="watch and write compressed artifacts, e.g. little_prince_ko.conllu.gz")
+    args = parser.parse_args()
+    util.artifact_compression = args.compress
+    watch(args.json, interval=args.interval)